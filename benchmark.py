@@ -0,0 +1,432 @@
+"""
+Офлайн-бенчмарк основных сценариев бота.
+
+Локальный сервер-заглушка отдает прайс-листы MarketCSGO и Skinport, цены Steam Market и Telegram Bot API,
+поэтому замеры не зависят от сети и лимитов внешних API. Для каждого размера портфеля создается
+синтетическая база (позиции, год истории стоимости, история цен, уведомления и список отслеживания)
+и замеряются сценарии целиком: отчет по портфелю, проверки уведомлений, график, экспорт и /api/portfolio.
+
+Результаты пишутся в JSON вместе с коммитом, чтобы сравнивать их между версиями:
+
+    python benchmark.py --sizes 10,1000,10000 --repeat 3 --output benchmark_results.json
+
+Вместо синтетических прайс-листов можно подставить записанные ответы (--feeds DIR):
+marketcsgo.json и skinport.json - ответы прайс-листов как есть, steam.json (необязательно) -
+{market_hash_name: ответ priceoverview}.
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+# Токен нужен при импорте main (создание Bot); запросы к Bot API уходят на заглушку
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:" + "A" * 35)
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import CallbackQuery, Chat, Message, User
+
+import main
+
+DEFAULT_SIZES = "10,1000,10000"
+HISTORY_DAYS = 365
+PRICE_HISTORY_ITEMS = 500  # Для скольких предметов пишется дневная история цен из мультиисточников
+WATCHLIST_SIZE = 20
+RANDOM_SEED = 42
+
+WEAPONS = ["AK-47", "M4A4", "M4A1-S", "AWP", "Desert Eagle", "USP-S", "Glock-18", "P250", "MP9", "FAMAS"]
+WEARS = ["Factory New", "Minimal Wear", "Field-Tested", "Well-Worn", "Battle-Scarred"]
+
+
+# --- ПРАЙС-ЛИСТЫ ---
+def synthetic_catalog(size):
+    """Каталог предметов с детерминированными ценами (USD)."""
+    rng = random.Random(RANDOM_SEED)
+    catalog = {}
+    for index in range(size):
+        name = f"{WEAPONS[index % len(WEAPONS)]} | Bench Skin {index:05d} ({WEARS[index % len(WEARS)]})"
+        catalog[name] = round(rng.uniform(0.05, 500), 2)
+    return catalog
+
+
+def build_feeds(catalog_size, feeds_dir=None):
+    """
+    Тела ответов заглушки: {'marketcsgo': bytes, 'skinport': bytes, 'steam': {название: dict}}
+    и список названий, из которых собираются портфели.
+    """
+    if feeds_dir:
+        with open(os.path.join(feeds_dir, "marketcsgo.json"), "rb") as f:
+            marketcsgo = f.read()
+        with open(os.path.join(feeds_dir, "skinport.json"), "rb") as f:
+            skinport = f.read()
+        steam = {}
+        steam_path = os.path.join(feeds_dir, "steam.json")
+        if os.path.exists(steam_path):
+            with open(steam_path, encoding="utf-8") as f:
+                steam = json.load(f)
+        _, names = main.parse_marketcsgo_prices(json.loads(marketcsgo))
+        return {'marketcsgo': marketcsgo, 'skinport': skinport, 'steam': steam}, sorted(names.values())
+
+    catalog = synthetic_catalog(catalog_size)
+    rng = random.Random(RANDOM_SEED + 1)
+    marketcsgo = json.dumps({
+        'success': True,
+        'currency': 'USD',
+        'items': [{'market_hash_name': name, 'price': str(price)} for name, price in catalog.items()]
+    }).encode()
+    skinport = json.dumps([
+        {'market_hash_name': name, 'min_price': round(price * rng.uniform(0.9, 1.1), 2)}
+        for name, price in catalog.items()
+    ]).encode()
+    steam = {name: {'success': True, 'median_price': f"${price * 1.15:,.2f}"} for name, price in catalog.items()}
+    return {'marketcsgo': marketcsgo, 'skinport': skinport, 'steam': steam}, list(catalog)
+
+
+# --- СЕРВЕР-ЗАГЛУШКА ---
+def create_stub_app(feeds):
+    """Прайс-листы (с ETag, как у настоящих API), Steam priceoverview и Telegram Bot API."""
+    message_ids = iter(range(1, 10 ** 9))
+    etags = {key: '"' + hashlib.md5(feeds[key]).hexdigest() + '"' for key in ('marketcsgo', 'skinport')}
+
+    def price_list(key):
+        async def handler(request):
+            if request.headers.get('If-None-Match') == etags[key]:
+                return web.Response(status=304, headers={'ETag': etags[key]})
+            return web.Response(body=feeds[key], content_type='application/json', headers={'ETag': etags[key]})
+        return handler
+
+    async def steam_price(request):
+        data = feeds['steam'].get(request.query.get('market_hash_name'))
+        return web.json_response(data or {'success': False})
+
+    async def telegram(request):
+        method = request.match_info['method']
+        data = await request.post()
+        if method in ('deleteMessage', 'answerCallbackQuery'):
+            return web.json_response({'ok': True, 'result': True})
+        chat_id = int(data.get('chat_id', 0))
+        result = {
+            'message_id': int(data['message_id']) if method == 'editMessageText' else next(message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'bench'},
+            'text': data.get('text', '')
+        }
+        return web.json_response({'ok': True, 'result': result})
+
+    app = web.Application(client_max_size=256 * 1024 * 1024)
+    app.router.add_get('/marketcsgo/prices.json', price_list('marketcsgo'))
+    app.router.add_get('/skinport/items', price_list('skinport'))
+    app.router.add_get('/steam/market/priceoverview/', steam_price)
+    app.router.add_post('/bot{token}/{method}', telegram)
+    return app
+
+
+class StubServer:
+    """
+    Заглушка в отдельном потоке со своим event loop: ее обработка не попадает в замеры
+    сценариев, выполняющихся в loop бота.
+    """
+
+    def __init__(self, feeds):
+        self.feeds = feeds
+        self.loop = asyncio.new_event_loop()
+        self.runner = None
+        self.port = None
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="benchmark-stub", daemon=True)
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.start())
+        self.ready.set()
+        self.loop.run_forever()
+
+    async def start(self):
+        self.runner = web.AppRunner(create_stub_app(self.feeds), access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    def __enter__(self):
+        self.thread.start()
+        self.ready.wait()
+        return self
+
+    def __exit__(self, *exc_info):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+
+def point_bot_to_stub(stub):
+    """Перенаправляет все внешние адреса бота на заглушку."""
+    main.MARKETCSGO_PRICES_URL = f"{stub.base_url}/marketcsgo/prices.json"
+    main.SKINPORT_ITEMS_URL = f"{stub.base_url}/skinport/items"
+    main.STEAM_COMMUNITY_URL = f"{stub.base_url}/steam"
+    main.bot.session.api = TelegramAPIServer.from_base(stub.base_url)
+
+
+# --- СИНТЕТИЧЕСКИЕ БАЗЫ ---
+def create_dataset(path, user_id, size, names):
+    """
+    База с портфелем из size позиций, часовой историей стоимости за год, дневной историей цен,
+    настройками уведомлений, списком отслеживания и уведомлениями о ценах.
+    """
+    rng = random.Random(RANDOM_SEED + size)
+    if os.path.exists(path):
+        os.remove(path)
+    main.DB_NAME = path
+    main.init_db()
+
+    now = datetime.now().replace(minute=0, second=0, microsecond=0)
+    portfolio = [names[index % len(names)] for index in range(size)]
+    with sqlite3.connect(path) as conn:
+        conn.execute("INSERT INTO users (user_id, is_subscribed, last_value_uah) VALUES (?, 1, ?)",
+                     (user_id, size * 1000.0))
+        items = []
+        for name in portfolio:
+            buy_uah = round(rng.uniform(10, 20000), 2)
+            items.append((user_id, name, rng.randint(1, 5), buy_uah, round(buy_uah / main.USD_TO_UAH, 2),
+                          (now - timedelta(days=rng.randint(0, HISTORY_DAYS))).isoformat()))
+        conn.executemany(
+            "INSERT INTO items (user_id, name, quantity, buy_price_uah, buy_price_usd, added_at) VALUES (?, ?, ?, ?, ?, ?)",
+            items)
+
+        value = size * 1000.0
+        history = []
+        for hour in range(HISTORY_DAYS * 24, 0, -1):
+            value *= rng.uniform(0.995, 1.005)
+            history.append(((now - timedelta(hours=hour)).isoformat(), round(value, 2), user_id))
+        conn.executemany("INSERT INTO portfolio_history (timestamp, value_uah, user_id) VALUES (?, ?, ?)", history)
+
+        price_history = []
+        for name in portfolio[:PRICE_HISTORY_ITEMS]:
+            price = rng.uniform(1, 100)
+            for day in range(HISTORY_DAYS, 0, -1):
+                price *= rng.uniform(0.97, 1.03)
+                timestamp = (now - timedelta(days=day)).isoformat()
+                for source in ('marketcsgo', 'skinport'):
+                    price_history.append((name, timestamp, source, round(price * rng.uniform(0.95, 1.05), 2),
+                                          round(price, 2)))
+        conn.executemany(
+            "INSERT INTO price_history_multisource (item_name, timestamp, source, price_usd, median_price_usd) "
+            "VALUES (?, ?, ?, ?, ?)", price_history)
+
+        # Прошлые цены отличаются от текущих, чтобы проверка изменений формировала уведомления
+        last_prices = {name: rng.uniform(10, 20000) for name in portfolio}
+        conn.execute(
+            "INSERT INTO user_notification_settings (user_id, threshold_percent, check_individual_items, "
+            "check_portfolio_total, last_item_prices) VALUES (?, 5.0, 1, 1, ?)",
+            (user_id, json.dumps(last_prices)))
+        conn.executemany(
+            "INSERT INTO item_watch_list (user_id, item_name, last_price_uah, created_at) VALUES (?, ?, ?, ?)",
+            [(user_id, name, rng.uniform(10, 20000), now.isoformat()) for name in names[-WATCHLIST_SIZE:]])
+        conn.executemany(
+            "INSERT INTO price_alerts (user_id, item_name, target_price, direction) VALUES (?, ?, ?, ?)",
+            [(user_id, name, rng.uniform(10, 20000), rng.choice(('up', 'down')))
+             for name in portfolio[:max(1, size // 100)]])
+
+
+def reset_caches():
+    """Холодный старт: пустые кэши цен, оценок и ответов API, прайс-листы скачиваются заново."""
+    main.marketcsgo_prices_cache = {}
+    main.last_cache_update = None
+    main.skinport_prices_cache = {}
+    main.last_skinport_update = None
+    main.http_validators.clear()
+    main.steam_price_state.clear()
+    main.steam_request_times.clear()
+    main.steam_refresh_queue.clear()
+    for cache_name in ('item_prices_cache', 'multisource_prices_cache', 'report_valuations', 'report_fragments',
+                       'portfolio_valuations', 'api_response_cache'):
+        cache = getattr(main, cache_name)
+        setattr(main, cache_name, main.TTLCache(cache.max_size, cache.ttl_seconds))
+
+
+# --- СЦЕНАРИИ ---
+class BenchJob:
+    """Фоновая задача для вызова run-функций напрямую, без JobManager."""
+
+    async def progress(self, text):
+        pass
+
+
+def user_message(user_id, text):
+    """Сообщение пользователя, привязанное к боту (ответы уходят на заглушку)."""
+    return Message(message_id=1, date=datetime.now(), chat=Chat(id=user_id, type='private'),
+                   from_user=User(id=user_id, is_bot=False, first_name='bench'), text=text).as_(main.bot)
+
+
+async def press_export_button(user_id, export_format):
+    """
+    Нажатие кнопки формата экспорта, как в боте: сообщение с кнопками отправлено ботом,
+    задача проходит через JobManager. Ошибка, если файл так и не был отправлен.
+    """
+    bot_message = Message(message_id=1, date=datetime.now(), chat=Chat(id=user_id, type='private'),
+                          from_user=User(id=main.bot.id, is_bot=True, first_name='bench'),
+                          text="📤 Выбери формат экспорта").as_(main.bot)
+    callback = CallbackQuery(id='1', from_user=User(id=user_id, is_bot=False, first_name='bench'),
+                             chat_instance='bench', data=f"export_{export_format}", message=bot_message).as_(main.bot)
+    documents_before = main.telegram_api_calls.get('sendDocument', 0)
+    await main.export_format_callback(callback)
+    job = main.jobs.jobs.get((user_id, 'export', export_format))
+    if job:
+        await job.task
+    if main.telegram_api_calls.get('sendDocument', 0) == documents_before:
+        raise RuntimeError(f"Экспорт {export_format} не отправил файл")
+
+
+def webapp_init_data(user_id):
+    """initData Mini App, подписанный токеном бота так же, как это делает Telegram."""
+    fields = {'auth_date': str(int(time.time())), 'user': json.dumps({'id': user_id})}
+    data_check_string = "\n".join(f"{key}={value}" for key, value in sorted(fields.items()))
+    secret_key = hmac.new(b"WebAppData", main.API_TOKEN.encode(), hashlib.sha256).digest()
+    fields['hash'] = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+
+def build_scenarios(user_id, api_client):
+    """{название: (корутина-фабрика, сбрасывать ли кэши перед каждым повтором)}."""
+
+    async def api_portfolio():
+        response = await api_client.get('/api/portfolio', headers={'X-Telegram-Init-Data': webapp_init_data(user_id)})
+        await response.read()
+        if response.status != 200:
+            raise RuntimeError(f"/api/portfolio вернул {response.status}")
+
+    return {
+        'generate_portfolio_report_cold': (
+            lambda: main.generate_portfolio_report(user_message(user_id, "📊 Портфель"), user_id, page=0), True),
+        'generate_portfolio_report_warm': (
+            lambda: main.generate_portfolio_report(user_message(user_id, "📊 Портфель"), user_id, page=0), False),
+        'check_individual_price_changes': (main.check_individual_price_changes, True),
+        'check_price_alerts': (main.check_price_alerts, True),
+        'history_cmd': (lambda: main.run_history_chart(user_message(user_id, "📈 График"), BenchJob()), False),
+        'export_excel_cmd': (lambda: press_export_button(user_id, 'xlsx'), True),
+        'export_excel_history': (lambda: press_export_button(user_id, 'xlsx_history'), True),
+        'api_portfolio': (api_portfolio, True),
+    }
+
+
+async def run_scenario(factory, cold, repeat):
+    """Замеры одного сценария: длительности повторов и число вызовов Telegram API на один прогон."""
+    timings = []
+    api_calls_before = sum(main.telegram_api_calls.values())
+    for _ in range(repeat):
+        if cold:
+            reset_caches()
+        started = time.perf_counter()
+        await factory()
+        timings.append(time.perf_counter() - started)
+    return {
+        'runs': repeat,
+        'cold_caches': cold,
+        'min_seconds': round(min(timings), 4),
+        'median_seconds': round(statistics.median(timings), 4),
+        'max_seconds': round(max(timings), 4),
+        'telegram_api_calls_per_run': (sum(main.telegram_api_calls.values()) - api_calls_before) / repeat,
+    }
+
+
+async def run_benchmark(sizes, repeat, workdir, names, only):
+    results = {}
+    web_app = web.Application()
+    web_app.add_routes(main.web_routes)
+    async with TestClient(TestServer(web_app)) as api_client:
+        for index, size in enumerate(sizes):
+            # У каждого набора свой пользователь: кэши по user_id не пересекаются между базами
+            user_id = 100000 + index
+            path = os.path.join(workdir, f"portfolio_{size}.db")
+            started = time.perf_counter()
+            create_dataset(path, user_id, size, names)
+            logging.warning(f"База на {size} позиций создана за {time.perf_counter() - started:.1f} с.")
+
+            results[str(size)] = {}
+            for name, (factory, cold) in build_scenarios(user_id, api_client).items():
+                if only and name not in only:
+                    continue
+                try:
+                    results[str(size)][name] = await run_scenario(factory, cold, repeat)
+                except Exception as e:
+                    results[str(size)][name] = {'error': f"{type(e).__name__}: {e}"}
+                logging.warning(f"{size} позиций, {name}: {results[str(size)][name]}")
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк сценариев бота на синтетических портфелях.")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="Размеры портфелей через запятую")
+    parser.add_argument("--repeat", type=int, default=3, help="Повторов каждого сценария")
+    parser.add_argument("--output", default="benchmark_results.json", help="Файл с результатами (JSON)")
+    parser.add_argument("--feeds", help="Каталог с записанными ответами marketcsgo.json, skinport.json, steam.json")
+    parser.add_argument("--scenarios", help="Только эти сценарии (через запятую)")
+    parser.add_argument("--workdir", help="Где создавать базы (по умолчанию - временный каталог)")
+    return parser.parse_args()
+
+
+def main_cli():
+    args = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    only = set(args.scenarios.split(",")) if args.scenarios else None
+
+    feeds, names = build_feeds(max(sizes), args.feeds)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bot-benchmark-")
+    os.makedirs(workdir, exist_ok=True)
+    with StubServer(feeds) as stub:
+        point_bot_to_stub(stub)
+        started = time.perf_counter()
+
+        async def run():
+            try:
+                return await run_benchmark(sizes, args.repeat, workdir, names, only)
+            finally:
+                await main.bot.session.close()
+
+        results = asyncio.run(run())
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'feeds': args.feeds or 'synthetic',
+        'total_seconds': round(time.perf_counter() - started, 2),
+        'results': results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены в {args.output}")
+
+
+if __name__ == "__main__":
+    main_cli()
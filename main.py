@@ -1,105 +1,169 @@
+import time
+PROCESS_STARTED_AT = time.perf_counter()  # Момент старта процесса для замера холодного старта
+import bisect
+import contextvars
+import functools
+import inspect
+import itertools
+import math
 import logging
 import sqlite3
 from datetime import datetime, timedelta
 import aiohttp
 import asyncio
 from aiogram import Bot, Dispatcher, F, Router
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, BufferedInputFile, WebAppInfo
+from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, BufferedInputFile, FSInputFile, WebAppInfo
+from aiogram.types import InlineQuery, InlineQueryResultArticle, InputTextMessageContent
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.client.default import DefaultBotProperties
+from aiogram.exceptions import TelegramBadRequest
 from contextlib import contextmanager
-import matplotlib.pyplot as plt
+from collections import OrderedDict, deque
 import io
-import requests
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
-from aiogram.fsm.context import FSMContext
-from aiogram.fsm.state import State, StatesGroup
-from matplotlib.dates import DateFormatter
-from matplotlib.ticker import FuncFormatter
 import statistics
 import os
-
-from flask import Flask, render_template, jsonify
+import sys
+import importlib
+import json
+import csv
+import tempfile
 import threading
-
-app = Flask(__name__)
-
-
-@app.route('/')
-def home():
-    return "Bot is alive!"
-
-@app.route('/webapp')
-def webapp():
-    """Telegram Mini App страница."""
-    return render_template("webapp.html")
-
-@app.route('/api/portfolio')
-def api_portfolio():
-    """API endpoint для получения данных портфеля."""
-    try:
-        items = get_items_from_db()
-        if not items:
-            return jsonify({
-                'totalValue': '0₴',
-                'totalItems': '0', 
-                'totalProfit': '0₴',
-                'profitPercent': '0%'
-            })
-        
-        total_buy_uah = 0
-        total_now_uah = 0
-        total_items = len(items)
-        
-        for user_id, name, qty, buy_uah, buy_usd in items:
-            pos_buy_uah = buy_uah * qty
-            total_buy_uah += pos_buy_uah
-            
-            # Получаем текущую цену из MarketCSGO кэша
-            item_name_lower = name.lower()
-            if item_name_lower in marketcsgo_prices_cache:
-                current_price_usd = marketcsgo_prices_cache[item_name_lower]
-                if current_price_usd:
-                    total_now_uah += current_price_usd * USD_TO_UAH * qty
-                else:
-                    total_now_uah += pos_buy_uah
-            else:
-                total_now_uah += pos_buy_uah
-        
-        total_profit_uah = total_now_uah - total_buy_uah
-        profit_pct = (total_profit_uah / total_buy_uah) * 100 if total_buy_uah > 0 else 0
-        
-        return jsonify({
-            'totalValue': f'{total_now_uah:,.0f}₴',
-            'totalItems': str(total_items),
-            'totalProfit': f'{total_profit_uah:+,.0f}₴',
-            'profitPercent': f'{profit_pct:+.1f}%'
-        })
-        
-    except Exception as e:
-        return jsonify({
-            'totalValue': 'Ошибка',
-            'totalItems': '0',
-            'totalProfit': 'Ошибка', 
-            'profitPercent': 'Ошибка'
-        })
-
-
-def run_flask():
-    app.run(host='0.0.0.0', port=8080)
-
-
-threading.Thread(target=run_flask, daemon=True).start()
+import gzip
+import hashlib
+import base64
+import hmac
+import html
+import traceback
+import warnings
+import re
+from urllib.parse import parse_qsl
+
+from aiohttp import web
 
 # --- КОНФИГУРАЦИЯ ---
 API_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 DB_NAME = "portfolio.db"
+# Владелец предметов, добавленных до разделения портфелей по пользователям
+# (если не задан - первый пользователь из таблицы users)
+PORTFOLIO_OWNER_ID = os.getenv("PORTFOLIO_OWNER_ID")
+# Telegram ID администраторов через запятую: им доступны диагностические команды
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}
 USD_TO_UAH = 41.5  # Фиксированный курс USD к UAH
 NOTIFICATION_THRESHOLD_PERCENT = 2.0  # Порог изменения портфеля для уведомлений
-ITEMS_PER_PAGE = 2  # Количество предметов на одной странице отчета
+# Страницы отчета заполняются позициями до лимита длины сообщения Telegram
+REPORT_MESSAGE_LIMIT = 4096
+REPORT_FOOTER_RESERVE = 64  # Запас под строку с номером страницы
+REPORT_FRAGMENT_SEPARATOR = "\n\n---\n\n"
+REPORT_JUMP_MAX_BUTTONS = 40  # Кнопок в меню перехода к странице
+REPORT_JUMP_BUTTONS_PER_ROW = 5
+WEB_HOST = "0.0.0.0"  # Адрес веб-сервера Mini App
+WEB_PORT = 8080
+WEBAPP_AUTH_MAX_AGE = timedelta(days=1)  # Срок действия initData Telegram Mini App
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+# Адреса внешних API можно переопределить (например, на локальный сервер с записанными ответами)
+MARKETCSGO_PRICES_URL = os.getenv("MARKETCSGO_PRICES_URL", "https://market.csgo.com/api/v2/prices/USD.json")
+SKINPORT_ITEMS_URL = os.getenv("SKINPORT_ITEMS_URL", "https://api.skinport.com/v1/items?app_id=730&currency=USD&tradable=0")
+STEAM_COMMUNITY_URL = os.getenv("STEAM_COMMUNITY_URL", "https://steamcommunity.com")
+STEAM_INVENTORY_PAGE_SIZE = 2000  # Максимум, который отдает эндпоинт инвентаря за запрос
+STEAM_INVENTORY_MAX_PAGES = 25
+STEAM_RATE_LIMIT_RETRIES = 3  # Повторы при 429 от Steam
+STEAM_RATE_LIMIT_DELAY_SECONDS = 5
+# Адаптивный опрос цен Steam: интервал предмета сокращается с ростом его волатильности, близости
+# уведомлений к цели и числа заинтересованных пользователей; общий бюджет запросов к Steam в минуту
+STEAM_REFRESH_MIN_INTERVAL = timedelta(minutes=5)
+STEAM_REFRESH_MAX_INTERVAL = timedelta(hours=6)
+STEAM_REFRESH_BUDGET_PER_MINUTE = 10
+STEAM_VOLATILITY_WINDOW = timedelta(days=3)
+STEAM_VOLATILITY_REFERENCE = 0.05  # Колебание цены 5% от средней добавляет к приоритету единицу
+ALERT_PROXIMITY_PERCENT = 10  # Уведомление считается близким к цели, если цена отличается меньше чем на 10%
+ALERT_HOT_PROXIMITY = 0.5  # Уведомления ближе этого проверяются каждую минуту вместе с планом Steam
+# Агрегация цен мультиисточников: веса источников (вес уменьшается вдвое за каждый PRICE_SOURCE_HALF_LIFE
+# возраста прайс-листа), порог модифицированного z-score для выбросов и параметры достоверности медианы
+PRICE_SOURCE_WEIGHTS = {'marketcsgo': 1.0, 'skinport': 1.0, 'buff': 0.8, 'csmoney': 0.6}
+PRICE_SOURCE_HALF_LIFE = timedelta(hours=2)
+PRICE_OUTLIER_THRESHOLD = 3.5
+PRICE_OUTLIER_MIN_SPREAD = 0.02  # Отклонения меньше 2% от центра выбросами не считаются
+PRICE_REFERENCE_WINDOW = timedelta(days=1)  # Прошлая медиана предмета участвует в поиске выбросов
+# Вес свежих данных для полной достоверности: хватает одного источника не старше PRICE_SOURCE_HALF_LIFE,
+# поэтому одиночная цена снижает достоверность только устареванием, а не тем, что источник один
+PRICE_CONFIDENCE_FULL_WEIGHT = 0.5
+PRICE_CONFIDENCE_SPREAD = 0.25  # Разброс цен 25% от медианы снижает достоверность до нуля
+PRICE_MIN_CONFIDENCE = 0.5  # Медианы ниже этой достоверности не учитываются детектором крашей
+
+# Тяжелые модули, которые подгружаются в фоне после запуска поллинга (пустая строка - отключить)
+WARMUP_MODULES = [m for m in os.getenv("WARMUP_MODULES", "matplotlib.pyplot,xlsxwriter,openai").split(",") if m]
+WARMUP_DELAY_SECONDS = 5
+EXPORT_PROGRESS_INTERVAL_SECONDS = 2.0  # Как часто обновлять сообщение о прогрессе экспорта
+MESSAGE_EDIT_DEBOUNCE_SECONDS = 0.7  # Частые правки одного сообщения склеиваются в пределах этого окна
+# Метрики /metrics: если задан METRICS_TOKEN, запрос должен содержать заголовок "Authorization: Bearer <токен>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+METRIC_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+EVENT_LOOP_LAG_INTERVAL_SECONDS = 1.0
+# Сторож event loop: блокировка дольше порога фиксируется вместе со стеком выполнявшегося кода
+LOOP_BLOCK_THRESHOLD_SECONDS = float(os.getenv("LOOP_BLOCK_THRESHOLD_SECONDS", "0.25"))
+LOOP_WATCHDOG_INTERVAL_SECONDS = 0.5
+LOOP_BLOCK_REPORT_SIZE = 50  # Сколько последних блокировок хранить для отчета
+# Трассировка запросов: сколько последних трасс хранить и максимум span-ов в одной трассе
+TRACE_BUFFER_SIZE = 200
+TRACE_MAX_SPANS = 2000
+# Сэмплирующий профайлер /profile: частота снятия стеков и ограничения длительности
+PROFILE_SAMPLE_INTERVAL_SECONDS = 0.005
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 120
+# Листовые кадры простаивающих потоков (ожидание событий, сокетов, задач пула): в собственное время не входят
+PROFILE_IDLE_FRAMES = {('wait', 'threading.py'), ('select', 'selectors.py'), ('_worker', 'thread.py')}
+PROFILE_IDLE_LABEL = "(ожидание)"
+# Планировщик: случайный разброс времени запусков (не больше доли SCHEDULER_JITTER_FRACTION периода задачи),
+# сдвиг первых запусков задач друг относительно друга
+# и допустимое опоздание запуска (пропущенные запуски сливаются в один).
+# Разброс меньше половины сдвига: соседние задачи с одинаковым периодом не сходятся и не меняются местами
+SCHEDULER_JITTER_SECONDS = 15
+SCHEDULER_JITTER_FRACTION = 0.05
+SCHEDULER_STAGGER_SECONDS = 45
+SCHEDULER_MISFIRE_GRACE_SECONDS = 300
+# Бюджет времени фоновых задач планировщика в секундах: по истечении задача отменяется
+SCHEDULER_JOB_BUDGETS = {
+    'fetch_marketcsgo_prices': 120,
+    'check_price_alerts': 600,
+    'check_individual_price_changes': 900,
+    'update_background_charts': 300,
+    'keep_bot_alive': 60,
+    'refresh_steam_prices': 55,
+    'check_and_notify': 1800,
+}
+# Долгие команды выполняются фоновыми задачами: число одновременных задач каждого класса
+JOB_CLASS_LIMITS = {
+    'export': 2,
+    'ai': 2,
+    'prices': 1,
+    'chart': 2,
+    'analysis': 2,
+    'import': 1,
+    'profile': 1,
+}
+JOB_USER_LIMIT = 2  # Сколько задач один пользователь может запустить одновременно
+# AI советник: OPENAI_BASE_URL позволяет направить запросы на локальный сервер-заглушку
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
+OPENAI_TIMEOUT_SECONDS = 60
+AI_ADVICE_CACHE_SIZE = 256
+AI_ADVICE_MAX_ITEMS = 10  # Ограничиваем число позиций в промпте для экономии токенов
+# Кэши цен предметов и оценок портфелей: размер (LRU) и время жизни записей
+ITEM_PRICE_CACHE_SIZE = 5000
+ITEM_PRICE_TTL_SECONDS = 600
+VALUATION_CACHE_SIZE = 500  # Оценок портфелей (по одной на пользователя)
+REPORT_FRAGMENT_CACHE_SIZE = 20000  # Готовых HTML-фрагментов позиций отчета
+# Нечеткий поиск названий: минимальная доля триграмм запроса в названии и число подсказок
+ITEM_SEARCH_MIN_COVERAGE = 0.45
+ITEM_SUGGESTIONS_LIMIT = 5
+# Inline-режим (@бот ak redline): число результатов, сколько Telegram кэширует ответ на запрос,
+# сколько живут готовые результаты у нас и кэш пустого ответа, пока каталог еще загружается
+INLINE_RESULTS_LIMIT = 20
+INLINE_CACHE_TIME_SECONDS = 300
+INLINE_RESULTS_TTL_SECONDS = 60
+INLINE_EMPTY_CACHE_SECONDS = 5
 
 # Настройка логирования для отслеживания ошибок
 logging.basicConfig(level=logging.INFO,
@@ -107,8 +171,451 @@ logging.basicConfig(level=logging.INFO,
 # Уменьшаем уровень для логов, которые могут "флудить"
 logging.getLogger('aiogram').setLevel(logging.WARNING)
 
+# --- ЛЕНИВЫЙ ИМПОРТ ТЯЖЕЛЫХ ЗАВИСИМОСТЕЙ ---
+# matplotlib, pandas и openai нужны только отдельным обработчикам,
+# поэтому они импортируются при первом обращении, а не при старте бота.
+import_timings = {}  # {модуль: секунды импорта}
+first_update_logged = False
+telegram_api_calls = {}  # {метод Bot API: число вызовов}
+message_update_stats = {'coalesced': 0, 'unchanged': 0, 'fallback': 0}
+
+
+def lazy_import(module_name):
+    """Импортирует модуль при первом обращении и запоминает время импорта."""
+    module = sys.modules.get(module_name)
+    if module is not None:
+        return module
+    started = time.perf_counter()
+    module = importlib.import_module(module_name)
+    import_timings[module_name] = time.perf_counter() - started
+    logging.info(f"Модуль {module_name} загружен за {import_timings[module_name]:.2f} с.")
+    return module
+
+
+def get_pyplot():
+    """Возвращает matplotlib.pyplot с неинтерактивным бэкендом Agg."""
+    if 'matplotlib.pyplot' not in sys.modules:
+        lazy_import('matplotlib').use('Agg')
+    return lazy_import('matplotlib.pyplot')
+
+
+def warmup_import(module_name):
+    """Импорт модуля для фонового прогрева (pyplot - через get_pyplot, чтобы выбрать бэкенд)."""
+    if module_name == 'matplotlib.pyplot':
+        return get_pyplot()
+    return lazy_import(module_name)
+
+
+async def warmup_heavy_modules():
+    """Фоновый прогрев тяжелых модулей после запуска поллинга, чтобы первый запрос не ждал импорта."""
+    await asyncio.sleep(WARMUP_DELAY_SECONDS)
+    for module_name in WARMUP_MODULES:
+        try:
+            await asyncio.to_thread(warmup_import, module_name)
+        except ImportError as e:
+            logging.warning(f"Прогрев: не удалось импортировать {module_name}: {e}")
+    if import_timings:
+        timings = ", ".join(f"{name} {seconds:.2f} с" for name, seconds in import_timings.items())
+        logging.info(f"Прогрев модулей завершен: {timings}")
+
+
+# --- МЕТРИКИ ---
+# Счетчики и гистограммы в памяти процесса; веб-сервер отдает их в текстовом формате Prometheus по /metrics.
+# Наблюдения приходят и из потоков (asyncio.to_thread), поэтому запись идет под блокировкой.
+metrics_registry = []
+metrics_lock = threading.Lock()
+
+
+def format_metric_labels(labels):
+    """Метки в формате Prometheus: {name="value",...}; пустая строка без меток."""
+    pairs = [f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), " ")}"'
+             for name, value in labels]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render_metric_family(name, metric_type, help_text, samples):
+    """Строки одной метрики: HELP, TYPE и значения samples [(метки [(имя, значение)], число)]."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    for labels, value in samples:
+        lines.append(f"{name}{format_metric_labels(labels)} {value}")
+    return lines
+
+
+class MetricCounter:
+    """Монотонный счетчик с метками."""
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}  # {значения меток: число}
+        metrics_registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with metrics_lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        with metrics_lock:
+            values = sorted(self.values.items())
+        return render_metric_family(self.name, "counter", self.help_text,
+                                    [(zip(self.label_names, labels), value) for labels, value in values])
+
+
+class MetricHistogram:
+    """Гистограмма длительностей с метками (корзины le, сумма и количество наблюдений)."""
+
+    def __init__(self, name, help_text, label_names=(), buckets=METRIC_LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.series = {}  # {значения меток: [наблюдений по корзинам, сумма, количество]}
+        metrics_registry.append(self)
+
+    def observe(self, value, *label_values):
+        with metrics_lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with metrics_lock:
+            series_items = sorted((labels, (list(counts), total, count))
+                                  for labels, (counts, total, count) in self.series.items())
+        for label_values, (counts, total, count) in series_items:
+            labels = list(zip(self.label_names, label_values))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{format_metric_labels(labels + [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_metric_labels(labels + [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{format_metric_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{format_metric_labels(labels)} {count}")
+        return lines
+
+
+steam_refresh_requests = MetricCounter(
+    "steam_refresh_requests_total", "Запросы цен Steam: по плану или сразу для предмета без цены", ("reason",))
+price_source_latency = MetricHistogram(
+    "price_source_request_seconds", "Длительность запросов к источникам цен", ("source", "status"))
+db_query_latency = MetricHistogram(
+    "db_query_seconds", "Время работы с соединением SQLite по функциям-хелперам", ("helper",))
+handler_latency = MetricHistogram(
+    "handler_seconds", "Длительность обработки сообщений и callback-запросов", ("kind", "handler"))
+job_duration = MetricHistogram(
+    "scheduler_job_seconds", "Длительность фоновых задач планировщика", ("job", "status"))
+job_overlaps = MetricCounter(
+    "scheduler_job_overlaps_total", "Запуски задачи, начавшиеся до завершения предыдущего", ("job",))
+job_skipped = MetricCounter(
+    "scheduler_job_skipped_total", "Пропущенные запуски задач планировщика", ("job", "reason"))
+job_timeouts = MetricCounter(
+    "scheduler_job_timeouts_total", "Запуски задач, прерванные по бюджету времени", ("job",))
+event_loop_lag = MetricHistogram(
+    "event_loop_lag_seconds", "Опоздание таймера event loop относительно запланированного времени")
+running_scheduled_jobs = {}  # {имя задачи: число выполняющихся запусков}
+event_loop_lag_last = 0.0
+
+
+def observe_price_source(source, status, started):
+    """Записывает длительность запроса к источнику цен (status - HTTP-код или 'error') в метрики и трассу."""
+    price_source_latency.observe(time.perf_counter() - started, source, str(status))
+    record_span(f"source {source}", started, status=status)
+
+
+def timed_job(func):
+    """Оборачивает фоновую задачу планировщика: длительность и пересечения запусков попадают в метрики."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        name = func.__name__
+        if running_scheduled_jobs.get(name):
+            job_overlaps.inc(name)
+        running_scheduled_jobs[name] = running_scheduled_jobs.get(name, 0) + 1
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            with trace_span(f"job {name}", root=True):
+                return await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            running_scheduled_jobs[name] -= 1
+            job_duration.observe(time.perf_counter() - started, name, status)
+    return wrapper
+
+
+async def monitor_event_loop_lag():
+    """Измеряет задержку event loop: насколько позже запланированного просыпается таймер."""
+    global event_loop_lag_last
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + EVENT_LOOP_LAG_INTERVAL_SECONDS
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL_SECONDS)
+        event_loop_lag_last = max(0.0, loop.time() - expected)
+        event_loop_lag.observe(event_loop_lag_last)
+
+
+class LoopWatchdog:
+    """
+    Сторож event loop в отдельном потоке.
+    Периодически ставит в loop пустой callback; если тот не выполнился за порог, loop занят синхронным кодом -
+    сторож снимает стек потока loop (sys._current_frames) и после разблокировки записывает длительность,
+    задачу asyncio и место в коде бота, где loop был заблокирован.
+    """
+
+    def __init__(self, loop, threshold, interval, report_size):
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()  # Создается в потоке event loop
+        self.threshold = threshold
+        self.interval = interval
+        self.incidents = deque(maxlen=report_size)
+        self.sites = {}  # {место блокировки: [число блокировок, суммарная длительность, максимум]}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="loop-watchdog", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            responded = threading.Event()
+            sent = time.monotonic()
+            try:
+                self.loop.call_soon_threadsafe(responded.set)
+            except RuntimeError:
+                return  # Loop закрыт
+            if responded.wait(self.threshold):
+                self.stop_event.wait(self.interval)
+                continue
+
+            # Loop не ответил за порог: стек снимается, пока блокирующий код еще выполняется
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = traceback.extract_stack(frame) if frame else []
+            task = asyncio.current_task(self.loop)
+            while not responded.wait(1.0):
+                if self.stop_event.is_set():
+                    return
+            self.record(time.monotonic() - sent, stack, task)
+
+    def record(self, duration, stack, task):
+        # Кадры самого loop (run_forever -> Handle._run) не интересны: стек начинается с callback задачи
+        loop_frames = [index for index, frame in enumerate(stack)
+                       if frame.filename.endswith(os.path.join("asyncio", "events.py"))]
+        if loop_frames:
+            stack = stack[loop_frames[-1] + 1:]
+        # Место блокировки - самый глубокий кадр кода бота (ниже - библиотеки, которые он вызвал);
+        # для работы с БД это хелпер, открывший соединение, а не общий get_db_cursor
+        own_frames = [frame for frame in stack if frame.filename == __file__ and frame.name != 'get_db_cursor']
+        site = f"{own_frames[-1].name}:{own_frames[-1].lineno}" if own_frames else "unknown"
+        incident = {
+            'time': datetime.now(),
+            'duration': duration,
+            'site': site,
+            'task': task.get_name() if task else None,
+            'coroutine': task.get_coro().__qualname__ if task else None,
+            'stack': "".join(traceback.format_list(stack[-15:]))
+        }
+        with metrics_lock:
+            self.incidents.append(incident)
+            stats = self.sites.setdefault(site, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+        loop_blocks.inc(site)
+        loop_block_duration.observe(duration)
+        logging.warning(f"Event loop заблокирован на {duration:.2f} с в {site} (задача {incident['coroutine']}).")
+
+    def report(self):
+        """Снимок для отчета: места блокировок по суммарной длительности и последние инциденты."""
+        with metrics_lock:
+            sites = sorted(self.sites.items(), key=lambda item: item[1][1], reverse=True)
+            incidents = list(self.incidents)
+        return sites, incidents
+
+
+loop_blocks = MetricCounter(
+    "event_loop_blocks_total", "Блокировки event loop дольше порога по месту в коде", ("site",))
+loop_block_duration = MetricHistogram(
+    "event_loop_block_seconds", "Длительность блокировок event loop дольше порога")
+loop_watchdog = None
+
+
+# --- ТРАССИРОВКА ---
+# Трасса начинается в обработчике (или фоновой задаче планировщика) и через contextvars доходит до
+# запросов к источникам цен, хелперов БД и отрисовки: контекст копируется в задачи asyncio и asyncio.to_thread.
+# Готовые трассы лежат в кольцевом буфере и выгружаются администратором в JSON или формате Chrome trace.
+current_span = contextvars.ContextVar("current_span", default=None)  # (трасса, ID span-а)
+span_ids = itertools.count(1)
+recent_traces = deque(maxlen=TRACE_BUFFER_SIZE)
+
+
+class Trace:
+    """Трасса одного запроса: плоский список завершенных span-ов со ссылками на родителя."""
+
+    def __init__(self, name):
+        self.trace_id = os.urandom(8).hex()
+        self.name = name
+        self.started_at = datetime.now()
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.dropped = 0
+
+    def add(self, span):
+        # Из рабочих потоков тоже: append атомарен, а лимит защищает от трасс на десятки тысяч позиций
+        if len(self.spans) < TRACE_MAX_SPANS:
+            self.spans.append(span)
+        else:
+            self.dropped += 1
+
+    def duration(self):
+        """От начала первого до конца последнего span-а (фоновая задача может закончиться позже обработчика)."""
+        if not self.spans:
+            return 0.0
+        return max(span['end'] for span in self.spans) - min(span['start'] for span in self.spans)
+
+
+@contextmanager
+def trace_span(name, root=False, **attrs):
+    """
+    Span вокруг блока кода (подходит и для async-кода). root=True начинает трассу, если ее еще нет;
+    без активной трассы обычный span ничего не записывает.
+    """
+    parent = current_span.get()
+    if parent is None and not root:
+        yield
+        return
+    trace = parent[0] if parent else Trace(name)
+    span_id = next(span_ids)
+    token = current_span.set((trace, span_id))
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        attrs['error'] = type(e).__name__
+        raise
+    finally:
+        current_span.reset(token)
+        trace.add({'id': span_id, 'parent': parent[1] if parent else None, 'name': name, 'start': started,
+                   'end': time.perf_counter(), 'thread': threading.get_ident(), 'attrs': attrs})
+        if parent is None:
+            recent_traces.append(trace)
+
+
+def record_span(name, started, **attrs):
+    """Добавляет в текущую трассу уже завершенный участок (начало - time.perf_counter())."""
+    parent = current_span.get()
+    if parent is None:
+        return
+    parent[0].add({'id': next(span_ids), 'parent': parent[1], 'name': name, 'start': started,
+                   'end': time.perf_counter(), 'thread': threading.get_ident(), 'attrs': attrs})
+
+
+def traced(name):
+    """Декоратор: каждый вызов функции (обычной или корутины) - span текущей трассы."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with trace_span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with trace_span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def trace_to_dict(trace):
+    """Трасса для JSON: время span-ов в миллисекундах от начала трассы."""
+    return {
+        'trace_id': trace.trace_id,
+        'name': trace.name,
+        'started_at': trace.started_at.isoformat(timespec='milliseconds'),
+        'duration_ms': round(trace.duration() * 1000, 3),
+        'dropped_spans': trace.dropped,
+        'spans': [{
+            'id': span['id'],
+            'parent': span['parent'],
+            'name': span['name'],
+            'start_ms': round((span['start'] - trace.origin) * 1000, 3),
+            'duration_ms': round((span['end'] - span['start']) * 1000, 3),
+            'thread': span['thread'],
+            'attrs': span['attrs']
+        } for span in sorted(trace.spans, key=lambda span: span['start'])]
+    }
+
+
+def traces_to_chrome(traces):
+    """Трассы в формате Chrome trace (chrome://tracing, Perfetto): трасса - процесс, поток - поток ОС."""
+    events = []
+    for pid, trace in enumerate(traces, 1):
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                       'args': {'name': f"{trace.name} {trace.started_at.strftime('%d.%m %H:%M:%S')}"}})
+        for span in trace.spans:
+            events.append({
+                'name': span['name'],
+                'cat': span['name'].split()[0],
+                'ph': 'X',
+                'ts': round((span['start'] - trace.origin) * 1e6),
+                'dur': round((span['end'] - span['start']) * 1e6),
+                'pid': pid,
+                'tid': span['thread'],
+                'args': {key: str(value) for key, value in span['attrs'].items()}
+            })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def message_metric_label(message):
+    """Метка обработчика сообщения: команда или кнопка главного меню; произвольный текст не попадает в метки."""
+    text = message.text or ""
+    if text.startswith("/"):
+        return text.split()[0].split("@")[0]
+    if text in MAIN_KEYBOARD_TEXTS:
+        return text
+    if message.document:
+        return "document"
+    return "text" if text else "other"
+
+
+def callback_metric_label(data):
+    """Префикс callback_data до первого параметра (номера, названия предмета, флага): page, edit_item..."""
+    parts = []
+    for part in (data or "").split("_"):
+        if not re.fullmatch(r"[a-z]+", part):
+            break
+        parts.append(part)
+    return "_".join(parts) or "other"
+
+
 # Инициализация бота, диспетчера и роутера
 bot = Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+
+
+@bot.session.middleware()
+async def count_api_calls(make_request, bot, method):
+    """Считает вызовы Telegram API по методам: по ним видно, сколько запросов уходит на один отчет."""
+    name = method.__api_method__
+    telegram_api_calls[name] = telegram_api_calls.get(name, 0) + 1
+    return await make_request(bot, method)
+
+
 # FSM States для массовых операций
 class BulkStates(StatesGroup):
     waiting_for_bulk_add = State()
@@ -118,19 +625,171 @@ class BulkStates(StatesGroup):
 router = Router()
 dp = Dispatcher()
 dp.include_router(router)
-scheduler = AsyncIOScheduler()
+
+
+@dp.update.outer_middleware()
+async def first_update_timer(handler, event, data):
+    """Логирует время от старта процесса до первого обработанного обновления."""
+    global first_update_logged
+    try:
+        return await handler(event, data)
+    finally:
+        if not first_update_logged:
+            first_update_logged = True
+            logging.info(
+                f"Холодный старт: первое обновление обработано через "
+                f"{time.perf_counter() - PROCESS_STARTED_AT:.2f} с после запуска процесса.")
+
+
+@dp.message.outer_middleware()
+async def message_latency_timer(handler, event, data):
+    """Длительность обработки сообщения по команде или кнопке меню."""
+    started = time.perf_counter()
+    label = message_metric_label(event)
+    try:
+        with trace_span(f"message {label}", root=True, user_id=event.from_user.id if event.from_user else None):
+            return await handler(event, data)
+    finally:
+        handler_latency.observe(time.perf_counter() - started, "message", label)
+
+
+@dp.callback_query.outer_middleware()
+async def callback_latency_timer(handler, event, data):
+    """Длительность обработки callback-запроса по префиксу callback_data."""
+    started = time.perf_counter()
+    label = callback_metric_label(event.data)
+    try:
+        with trace_span(f"callback {label}", root=True, user_id=event.from_user.id, data=event.data):
+            return await handler(event, data)
+    finally:
+        handler_latency.observe(time.perf_counter() - started, "callback", label)
+
+@dp.inline_query.outer_middleware()
+async def inline_latency_timer(handler, event, data):
+    """Длительность ответа на inline-запрос."""
+    started = time.perf_counter()
+    try:
+        with trace_span("inline_query", root=True, user_id=event.from_user.id):
+            return await handler(event, data)
+    finally:
+        handler_latency.observe(time.perf_counter() - started, "inline", "inline_query")
+
+# Планировщик создается в start_scheduled_jobs, чтобы не импортировать APScheduler при загрузке модуля
+scheduler = None
+
+
+# --- КЭШИ ---
+class TTLCache:
+    """
+    Кэш с временем жизни записей и ограниченным размером.
+    При переполнении вытесняется запись, к которой дольше всего не обращались (LRU).
+    """
+
+    def __init__(self, max_size, ttl_seconds=None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds  # None - записи не устаревают, только вытесняются
+        self.entries = OrderedDict()  # {ключ: (время записи, значение)}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Значение по ключу или default, если записи нет или она устарела."""
+        entry = self.entries.get(key)
+        if entry is not None and self.ttl_seconds is not None and time.monotonic() - entry[0] > self.ttl_seconds:
+            del self.entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        """Записывает значение и вытесняет самые давние записи сверх лимита."""
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """Явно удаляет запись (например, при изменении портфеля)."""
+        self.entries.pop(key, None)
+
+    def __len__(self):
+        return len(self.entries)
+
 
 # Глобальный кэш для цен с MarketCSGO, чтобы не делать лишних запросов
 marketcsgo_prices_cache = {}
 last_cache_update = None
 CACHE_TTL = timedelta(minutes=30)
-# Кэш для цен портфеля
-portfolio_prices_cache = {}
-# Мультиисточники кэш
-multisource_prices_cache = {}
-last_multisource_update = None
+# Блокировки, чтобы одновременные запросы не скачивали один и тот же прайс-лист параллельно
+marketcsgo_refresh_lock = asyncio.Lock()
+skinport_refresh_lock = asyncio.Lock()
+# Проверки уведомлений (по расписанию и для близких к цели) не должны отправить одно уведомление дважды
+price_alerts_lock = asyncio.Lock()
+# Цены предметов портфелей {название: {'marketcsgo_usd', 'steam_usd'}} - общие для всех пользователей
+item_prices_cache = TTLCache(ITEM_PRICE_CACHE_SIZE, ITEM_PRICE_TTL_SECONDS)
+# Оценки портфелей для отчета {user_id: оценка}; сбрасываются при изменении портфеля пользователя
+report_valuations = TTLCache(VALUATION_CACHE_SIZE, ITEM_PRICE_TTL_SECONDS)
+# Отрендеренные HTML-фрагменты позиций отчета (ключ включает цены, поэтому без TTL)
+report_fragments = TTLCache(REPORT_FRAGMENT_CACHE_SIZE)
+# Каталог рынка: {название в нижнем регистре: оригинальное market_hash_name} из MarketCSGO и Skinport
+market_item_names = {}
+market_names_version = 0  # Увеличивается, когда в каталоге появляются новые названия
+market_names_normalized = {}
+market_names_normalized_version = -1
+# Триграммный индекс каталога рынка (ItemNameIndex) и задача его перестройки
+item_name_index = None
+item_name_index_task = None
+# Индексы названий портфелей для поиска {user_id: (версия портфеля, ItemNameIndex)}
+portfolio_name_indexes = TTLCache(VALUATION_CACHE_SIZE, ITEM_PRICE_TTL_SECONDS)
+# Готовые результаты inline-запросов {(ключ запроса, версия цен): [InlineQueryResultArticle]}
+inline_results_cache = TTLCache(ITEM_PRICE_CACHE_SIZE, INLINE_RESULTS_TTL_SECONDS)
+# Короткие идентификаторы предметов для deep link из inline-результатов {токен: market_hash_name}
+inline_item_tokens = {}
+catalog_refresh_task = None
+# Кэш цен Skinport (весь прайс-лист, обновляется одним запросом)
+skinport_prices_cache = {}
+last_skinport_update = None
+SKINPORT_CACHE_TTL = timedelta(minutes=5)
+# Валидаторы условных запросов (ETag / Last-Modified) по URL прайс-листов
+http_validators = {}
+# Статистика условных запросов: сколько трафика и времени разбора сэкономили ответы 304
+conditional_get_stats = {
+    'hits': 0,
+    'misses': 0,
+    'bytes_saved': 0,
+    'parse_seconds_saved': 0.0
+}
+# Мультиисточники кэш {название: {'median', 'sources', 'steam'}}
+multisource_prices_cache = TTLCache(ITEM_PRICE_CACHE_SIZE, ITEM_PRICE_TTL_SECONDS)
 # Хранилище последних известных цен для анализа роста
 last_prices_snapshot = {}
+# Версии данных: увеличиваются при изменении портфеля, цен и истории.
+# По ним определяется, можно ли отдавать уже посчитанные ответы API.
+holdings_versions = {}  # {user_id: версия портфеля}
+prices_version = 0
+history_versions = {}  # {user_id: версия истории стоимости}
+# Оценки портфелей для API Mini App по пользователям (пересчитываются при смене версий)
+portfolio_valuations = TTLCache(VALUATION_CACHE_SIZE)
+# Готовые JSON-ответы API: {ключ: {'version', 'body', 'gzip', 'etag'}}
+API_RESPONSE_CACHE_MAX = 256
+api_response_cache = TTLCache(API_RESPONSE_CACHE_MAX)
+API_CACHE_CONTROL = "private, max-age=15, must-revalidate"
+API_PAGE_LIMIT_DEFAULT = 50
+API_PAGE_LIMIT_MAX = 200
+# Подписчики потока цен Mini App (SSE): {очередь событий соединения: user_id}
+stream_subscribers = {}
+# Последние отправленные в соединение стоимости позиций {очередь событий соединения: {item_id: value_uah}}
+stream_last_positions = {}
+# Пользователи, которым нужно разослать изменения при ближайшей рассылке
+stream_pending_users = set()
+stream_update_scheduled = False
+MAX_STREAM_CONNECTIONS = 200
+STREAM_QUEUE_SIZE = 4  # Медленный клиент пропускает старые события и получает свежие
+STREAM_KEEPALIVE_SECONDS = 20
 
 
 # --- FSM (Finite State Machine) для редактирования и отслеживания цен ---
@@ -157,7 +816,129 @@ class NotificationSettingsState(StatesGroup):
     waiting_for_watchlist_item = State()
 
 
-# --- РАБОТА С БАЗОЙ ДАННЫХ ---
+class QuickAddState(StatesGroup):
+    waiting_for_details = State()
+
+
+# --- ОБНОВЛЕНИЕ СООБЩЕНИЙ ---
+class MessageUpdater:
+    """
+    Обновления одного сообщения бота.
+    Промежуточные правки (прогресс) откладываются и склеиваются: уходит только последняя.
+    Правка тем же текстом и клавиатурой не отправляется, при ошибке редактирования
+    отправляется новое сообщение, и дальнейшие правки идут в него.
+    """
+
+    def __init__(self, chat_id, message_id=None, text=None, reply_markup=None,
+                 debounce=MESSAGE_EDIT_DEBOUNCE_SECONDS):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.reply_markup = reply_markup
+        self.debounce = debounce
+        # Уже показанное сообщение не правим сразу: быстрые обработчики успеют заменить прогресс итогом
+        self.last_sent = asyncio.get_running_loop().time() if message_id is not None else 0.0
+        self.pending = None
+        self.flush_task = None
+        self.lock = asyncio.Lock()
+
+    @classmethod
+    def for_message(cls, message):
+        """Апдейтер для сообщения: свое сообщение бота редактируется, на сообщение пользователя - ответ новым."""
+        chat_id = message.chat.id
+        from_user = getattr(message, "from_user", None)
+        if not (from_user and from_user.is_bot):
+            return cls(chat_id)
+        try:
+            text = message.html_text
+        except Exception:
+            text = None
+        return cls(chat_id, message.message_id, text, message.reply_markup)
+
+    async def update(self, text, reply_markup=None):
+        """Промежуточное обновление: отправляется не чаще раза в debounce секунд, последнее побеждает."""
+        if self.pending is not None:
+            message_update_stats['coalesced'] += 1
+        self.pending = (text, reply_markup)
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def finish(self, text, reply_markup=None):
+        """Итоговое содержимое: отложенные правки отменяются, текст применяется сразу."""
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        if self.pending is not None:
+            message_update_stats['coalesced'] += 1
+        self.pending = (text, reply_markup)
+        await self.flush()
+
+    async def cancel(self):
+        """Отменяет отложенные правки: сообщение остается как есть (выход без итогового текста)."""
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        self.pending = None
+
+    async def _flush_later(self):
+        delay = self.last_sent + self.debounce - asyncio.get_running_loop().time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # Дальше отмена не нужна: finish дождется отправки через lock
+        self.flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            if self.pending is None:
+                return
+            text, reply_markup = self.pending
+            self.pending = None
+            await self._apply(text, reply_markup)
+
+    async def _apply(self, text, reply_markup):
+        if self.message_id is not None:
+            if text == self.text and reply_markup == self.reply_markup:
+                message_update_stats['unchanged'] += 1
+                return
+            try:
+                await bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id,
+                                            reply_markup=reply_markup)
+                self._sent(text, reply_markup)
+                return
+            except TelegramBadRequest as e:
+                if "message is not modified" in str(e):
+                    message_update_stats['unchanged'] += 1
+                    self._sent(text, reply_markup)
+                    return
+                logging.info(f"Не удалось отредактировать сообщение, отправляю новое: {e}")
+            except Exception as e:
+                logging.info(f"Не удалось отредактировать сообщение, отправляю новое: {e}")
+            message_update_stats['fallback'] += 1
+        sent = await bot.send_message(self.chat_id, text, reply_markup=reply_markup)
+        self.message_id = sent.message_id
+        self._sent(text, reply_markup)
+
+    def _sent(self, text, reply_markup):
+        self.text = text
+        self.reply_markup = reply_markup
+        self.last_sent = asyncio.get_running_loop().time()
+
+    async def delete(self):
+        """Удаляет сообщение (если оно уже отправлено) вместе с отложенными правками."""
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        async with self.lock:
+            self.pending = None
+            if self.message_id is not None:
+                try:
+                    await bot.delete_message(self.chat_id, self.message_id)
+                except Exception as e:
+                    logging.debug(f"Не удалось удалить сообщение: {e}")
+                self.message_id = None
+
+
 async def safe_edit_or_send(callback: CallbackQuery, *, text: str | None = None, photo: BufferedInputFile | None = None, reply_markup=None):
     """Безопасное редактирование или отправка сообщения для избежания InaccessibleMessage ошибок."""
     try:
@@ -168,13 +949,12 @@ async def safe_edit_or_send(callback: CallbackQuery, *, text: str | None = None,
         chat_id = callback.message.chat.id if getattr(callback.message, "chat", None) else callback.from_user.id
         
         if text is not None:
+            # Редактирование с пропуском повторов и откатом на новое сообщение - через MessageUpdater
             if getattr(callback.message, "chat", None) and hasattr(callback.message, "message_id"):
-                try:
-                    await bot.edit_message_text(text, chat_id=chat_id, message_id=callback.message.message_id, reply_markup=reply_markup)
-                except Exception:
-                    await bot.send_message(chat_id, text, reply_markup=reply_markup)
+                updater = MessageUpdater.for_message(callback.message)
             else:
-                await bot.send_message(chat_id, text, reply_markup=reply_markup)
+                updater = MessageUpdater(chat_id)
+            await updater.finish(text, reply_markup)
         elif photo is not None:
             await bot.send_photo(chat_id, photo, reply_markup=reply_markup)
         
@@ -188,14 +968,26 @@ async def safe_edit_or_send(callback: CallbackQuery, *, text: str | None = None,
 
 @contextmanager
 def get_db_cursor():
-    """Контекстный менеджер для работы с БД."""
+    """
+    Контекстный менеджер для работы с БД: изменения фиксируются при выходе из блока, при ошибке откатываются.
+    Время от открытия до закрытия соединения пишется в метрики по имени вызвавшей функции.
+    """
+    # Кадр 1 - __enter__ контекстного менеджера, кадр 2 - функция с блоком with
+    helper = sys._getframe(2).f_code.co_name
+    started = time.perf_counter()
     conn = sqlite3.connect(DB_NAME)
     cursor = conn.cursor()
     try:
         yield cursor, conn
-    finally:
         conn.commit()
+    except BaseException:
+        # Ошибка посреди блока: изменения откатываются целиком, а не фиксируются частично
+        conn.rollback()
+        raise
+    finally:
         conn.close()
+        db_query_latency.observe(time.perf_counter() - started, helper)
+        record_span(f"db {helper}", started)
 
 
 def init_db():
@@ -204,6 +996,7 @@ def init_db():
         cur.execute("""
             CREATE TABLE IF NOT EXISTS items (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
                 name TEXT,
                 quantity INTEGER,
                 buy_price_uah REAL,
@@ -213,14 +1006,17 @@ def init_db():
         """)
         cur.execute("""
             CREATE TABLE IF NOT EXISTS portfolio_history (
-                timestamp TEXT PRIMARY KEY,
-                value_uah REAL
+                timestamp TEXT,
+                value_uah REAL,
+                user_id INTEGER,
+                PRIMARY KEY (user_id, timestamp)
             )
         """)
         cur.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
-                is_subscribed INTEGER DEFAULT 1
+                is_subscribed INTEGER DEFAULT 1,
+                last_value_uah REAL
             )
         """)
         cur.execute("""
@@ -264,7 +1060,8 @@ def init_db():
                 timestamp TEXT,
                 source TEXT,
                 price_usd REAL,
-                median_price_usd REAL
+                median_price_usd REAL,
+                median_confidence REAL
             )
         """)
         cur.execute("""
@@ -273,81 +1070,204 @@ def init_db():
                 timestamp TEXT,
                 item_name TEXT,
                 price_usd REAL,
-                quantity INTEGER
+                quantity INTEGER,
+                user_id INTEGER
             )
         """)
+        migrate_to_user_portfolios(cur)
+        migrate_portfolio_history_key(cur)
+        add_column_if_missing(cur, 'price_history_multisource', 'median_confidence', 'REAL')
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_items_user ON items (user_id)")
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_portfolio_snapshots_user ON portfolio_snapshots (user_id, item_name, timestamp)")
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_price_history_multisource_time ON price_history_multisource (timestamp)")
     logging.info("База данных инициализирована.")
 
 
-def add_item_to_db(name, qty, buy_price_uah):
-    """Добавление предмета в базу данных."""
+def add_column_if_missing(cur, table, column, declaration):
+    """Добавляет колонку в существующую таблицу. Возвращает True, если колонка была добавлена."""
+    cur.execute(f"PRAGMA table_info({table})")
+    if column in [row[1] for row in cur.fetchall()]:
+        return False
+    cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+    return True
+
+
+def migrate_to_user_portfolios(cur):
+    """
+    Миграция базы с общим портфелем на портфели по пользователям.
+    Предметы, история и снимки без владельца передаются PORTFOLIO_OWNER_ID
+    (или первому пользователю бота), туда же переносится последняя известная стоимость.
+    """
+    for table in ('items', 'portfolio_history', 'portfolio_snapshots'):
+        add_column_if_missing(cur, table, 'user_id', 'INTEGER')
+    add_column_if_missing(cur, 'users', 'last_value_uah', 'REAL')
+
+    cur.execute("SELECT COUNT(*) FROM items WHERE user_id IS NULL")
+    orphaned_items = cur.fetchone()[0]
+    cur.execute("SELECT COUNT(*) FROM portfolio_history WHERE user_id IS NULL")
+    orphaned_history = cur.fetchone()[0]
+    if not orphaned_items and not orphaned_history:
+        return
+
+    owner_id = int(PORTFOLIO_OWNER_ID) if PORTFOLIO_OWNER_ID else None
+    if owner_id is None:
+        cur.execute("SELECT user_id FROM users ORDER BY rowid LIMIT 1")
+        row = cur.fetchone()
+        owner_id = row[0] if row else None
+    if owner_id is None:
+        logging.warning(
+            f"Миграция: {orphaned_items} предметов без владельца. "
+            f"Задай PORTFOLIO_OWNER_ID, чтобы передать их пользователю.")
+        return
+
+    for table in ('items', 'portfolio_history', 'portfolio_snapshots'):
+        cur.execute(f"UPDATE {table} SET user_id = ? WHERE user_id IS NULL", (owner_id, ))
+    cur.execute("INSERT OR IGNORE INTO users (user_id, is_subscribed) VALUES (?, 1)", (owner_id, ))
+    cur.execute("""
+        UPDATE users SET last_value_uah = (SELECT value_uah FROM last_known_value WHERE id = 1)
+        WHERE user_id = ? AND last_value_uah IS NULL
+    """, (owner_id, ))
+    logging.info(f"Миграция: {orphaned_items} предметов и история портфеля переданы пользователю {owner_id}.")
+
+
+def migrate_portfolio_history_key(cur):
+    """
+    Миграция ключа истории портфеля с timestamp на (user_id, timestamp).
+    Со старым ключом запись одного пользователя заменяла запись другого с той же отметкой времени.
+    Составной ключ заодно заменяет индекс idx_portfolio_history_user.
+    """
+    cur.execute("PRAGMA table_info(portfolio_history)")
+    key = {row[1]: row[5] for row in cur.fetchall()}
+    if key.get('user_id'):
+        return
+    cur.execute("ALTER TABLE portfolio_history RENAME TO portfolio_history_old")
+    cur.execute("""
+        CREATE TABLE portfolio_history (
+            timestamp TEXT,
+            value_uah REAL,
+            user_id INTEGER,
+            PRIMARY KEY (user_id, timestamp)
+        )
+    """)
+    cur.execute("""
+        INSERT OR REPLACE INTO portfolio_history (timestamp, value_uah, user_id)
+        SELECT timestamp, value_uah, user_id FROM portfolio_history_old
+    """)
+    cur.execute("DROP TABLE portfolio_history_old")
+    logging.info("Миграция: ключ истории портфеля заменен на (user_id, timestamp).")
+
+
+def mark_holdings_changed(user_id):
+    """Отмечает изменение портфеля пользователя, чтобы сбросить его оценки и готовые ответы API."""
+    holdings_versions[user_id] = holdings_versions.get(user_id, 0) + 1
+    report_valuations.invalidate(user_id)
+    portfolio_valuations.invalidate(user_id)
+    schedule_stream_update(user_id)
+
+
+def add_item_to_db(user_id, name, qty, buy_price_uah):
+    """Добавление предмета в портфель пользователя."""
     buy_price_usd = round(buy_price_uah / USD_TO_UAH, 2)
     with get_db_cursor() as (cur, _):
         cur.execute(
-            "INSERT INTO items (name, quantity, buy_price_uah, buy_price_usd, added_at) VALUES (?, ?, ?, ?, ?)",
-            (name, qty, buy_price_uah, buy_price_usd,
+            "INSERT INTO items (user_id, name, quantity, buy_price_uah, buy_price_usd, added_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, name, qty, buy_price_uah, buy_price_usd,
              datetime.now().isoformat()))
-    logging.info(f"Предмет '{name}' добавлен в БД.")
+    mark_holdings_changed(user_id)
+    logging.info(f"Предмет '{name}' добавлен в портфель пользователя {user_id}.")
+
+
+def add_items_bulk(user_id, rows):
+    """Добавляет все предметы в портфель пользователя одной транзакцией."""
+    with get_db_cursor() as (cur, _):
+        cur.executemany(
+            "INSERT INTO items (user_id, name, quantity, buy_price_uah, buy_price_usd, added_at) VALUES (?, ?, ?, ?, ?, ?)",
+            [(user_id, ) + row for row in rows])
+    mark_holdings_changed(user_id)
+    logging.info(f"Массово добавлено предметов пользователю {user_id}: {len(rows)}.")
 
 
-def get_items_from_db():
-    """Получение всех предметов из базы данных."""
+def get_items_from_db(user_id):
+    """Получение предметов из портфеля пользователя."""
     with get_db_cursor() as (cur, _):
         cur.execute(
-            "SELECT id, name, quantity, buy_price_uah, buy_price_usd FROM items"
-        )
+            "SELECT id, name, quantity, buy_price_uah, buy_price_usd FROM items WHERE user_id = ? ORDER BY id",
+            (user_id, ))
         rows = cur.fetchall()
     return rows
 
 
-def delete_item_by_id(item_id):
-    """Удаление предмета по ID."""
+def get_portfolio_owners():
+    """ID пользователей, у которых есть предметы в портфеле."""
     with get_db_cursor() as (cur, _):
-        cur.execute("DELETE FROM items WHERE id = ?", (item_id, ))
-        return cur.rowcount > 0
+        cur.execute("SELECT DISTINCT user_id FROM items WHERE user_id IS NOT NULL")
+        return [row[0] for row in cur.fetchall()]
+
+
+def delete_item_by_id(user_id, item_id):
+    """Удаление предмета пользователя по ID."""
+    with get_db_cursor() as (cur, _):
+        cur.execute("DELETE FROM items WHERE id = ? AND user_id = ?", (item_id, user_id))
+        deleted = cur.rowcount > 0
+    mark_holdings_changed(user_id)
+    return deleted
+
+
+def delete_all_items(user_id):
+    """Удаляет все предметы из портфеля пользователя. Возвращает количество удаленных."""
+    with get_db_cursor() as (cur, _):
+        cur.execute("DELETE FROM items WHERE user_id = ?", (user_id, ))
+        deleted = cur.rowcount
+    mark_holdings_changed(user_id)
+    return deleted
 
 
-def update_item_quantity(item_id, new_quantity):
+def update_item_quantity(user_id, item_id, new_quantity):
     """Обновление количества предмета."""
     with get_db_cursor() as (cur, _):
-        cur.execute("UPDATE items SET quantity = ? WHERE id = ?",
-                    (new_quantity, item_id))
+        cur.execute("UPDATE items SET quantity = ? WHERE id = ? AND user_id = ?",
+                    (new_quantity, item_id, user_id))
+    mark_holdings_changed(user_id)
 
 
-def update_item_price(item_id, new_price_uah):
+def update_item_price(user_id, item_id, new_price_uah):
     """Обновление цены закупки предмета."""
     new_price_usd = round(new_price_uah / USD_TO_UAH, 2)
     with get_db_cursor() as (cur, _):
         cur.execute(
-            "UPDATE items SET buy_price_uah = ?, buy_price_usd = ? WHERE id = ?",
-            (new_price_uah, new_price_usd, item_id))
+            "UPDATE items SET buy_price_uah = ?, buy_price_usd = ? WHERE id = ? AND user_id = ?",
+            (new_price_uah, new_price_usd, item_id, user_id))
+    mark_holdings_changed(user_id)
 
 
-def save_portfolio_value(value_uah):
-    """Сохранение текущей стоимости портфеля с точной датой и временем."""
+def save_portfolio_value(user_id, value_uah):
+    """Сохранение текущей стоимости портфеля пользователя с точной датой и временем."""
     timestamp = datetime.now().isoformat()
     with get_db_cursor() as (cur, conn):
         cur.execute(
-            "INSERT OR REPLACE INTO portfolio_history (timestamp, value_uah) VALUES (?, ?)",
-            (timestamp, value_uah))
+            "INSERT OR REPLACE INTO portfolio_history (timestamp, value_uah, user_id) VALUES (?, ?, ?)",
+            (timestamp, value_uah, user_id))
+    history_versions[user_id] = history_versions.get(user_id, 0) + 1
     logging.info(
-        f"Стоимость портфеля сохранена: {value_uah}₴ на момент {timestamp}.")
+        f"Стоимость портфеля пользователя {user_id} сохранена: {value_uah}₴ на момент {timestamp}.")
 
 
-def get_portfolio_history():
-    """Получение истории стоимости портфеля."""
+def get_portfolio_history(user_id):
+    """Получение истории стоимости портфеля пользователя."""
     with get_db_cursor() as (cur, _):
         cur.execute(
-            "SELECT timestamp, value_uah FROM portfolio_history ORDER BY timestamp"
-        )
+            "SELECT timestamp, value_uah FROM portfolio_history WHERE user_id = ? ORDER BY timestamp",
+            (user_id, ))
         rows = cur.fetchall()
     return rows
 
 
-def get_total_buy_price():
-    """Рассчитывает общую закупочную стоимость портфеля."""
+def get_total_buy_price(user_id):
+    """Рассчитывает общую закупочную стоимость портфеля пользователя."""
     with get_db_cursor() as (cur, _):
-        cur.execute("SELECT SUM(quantity * buy_price_uah) FROM items")
+        cur.execute("SELECT SUM(quantity * buy_price_uah) FROM items WHERE user_id = ?", (user_id, ))
         result = cur.fetchone()
         return result[0] if result and result[0] is not None else 0
 
@@ -362,27 +1282,27 @@ def get_subscribed_users():
 def subscribe_user(user_id):
     """Добавление пользователя в список для уведомлений."""
     with get_db_cursor() as (cur, _):
+        # Upsert, чтобы не затереть сохраненную стоимость портфеля
         cur.execute(
-            "INSERT OR REPLACE INTO users (user_id, is_subscribed) VALUES (?, 1)",
+            "INSERT INTO users (user_id, is_subscribed) VALUES (?, 1) "
+            "ON CONFLICT(user_id) DO UPDATE SET is_subscribed = 1",
             (user_id, ))
     logging.info(f"Пользователь {user_id} подписан на уведомления.")
 
 
-def get_last_known_value():
-    """Получение последней известной стоимости портфеля."""
+def get_last_known_value(user_id):
+    """Получение последней известной стоимости портфеля пользователя."""
     with get_db_cursor() as (cur, _):
-        cur.execute("SELECT value_uah FROM last_known_value WHERE id = 1")
+        cur.execute("SELECT last_value_uah FROM users WHERE user_id = ?", (user_id, ))
         result = cur.fetchone()
         return result[0] if result else None
 
 
-def save_last_known_value(value_uah):
-    """Сохранение последней известной стоимости портфеля."""
+def save_last_known_value(user_id, value_uah):
+    """Сохранение последней известной стоимости портфеля пользователя."""
     with get_db_cursor() as (cur, _):
-        cur.execute(
-            "INSERT OR REPLACE INTO last_known_value (id, value_uah) VALUES (1, ?)",
-            (value_uah, ))
-    logging.info(f"Сохранена последняя известная стоимость: {value_uah}₴")
+        cur.execute("UPDATE users SET last_value_uah = ? WHERE user_id = ?", (value_uah, user_id))
+    logging.info(f"Сохранена последняя известная стоимость портфеля пользователя {user_id}: {value_uah}₴")
 
 
 def get_item_category(item_name):
@@ -456,26 +1376,122 @@ def update_price_alert(alert_id, new_price=None, new_direction=None):
 
 # --- API ПОЛУЧЕНИЯ ЦЕН ---
 
+# --- УСЛОВНЫЕ ЗАПРОСЫ ДЛЯ МАССОВЫХ ПРАЙС-ЛИСТОВ ---
+async def conditional_get_json(session, url, parse, timeout, source):
+    """
+    Условный GET для больших JSON прайс-листов.
+    Отправляет If-None-Match / If-Modified-Since по сохранённым валидаторам.
+    Возвращает (status, parse(data)); при 304 вместо данных возвращается None.
+    Длительность запроса вместе с разбором пишется в метрики источника source.
+    """
+    validators = http_validators.get(url, {})
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        async with session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            status = response.status
+            if response.status == 304:
+                conditional_get_stats['hits'] += 1
+                conditional_get_stats['bytes_saved'] += validators.get('size', 0)
+                conditional_get_stats['parse_seconds_saved'] += validators.get('parse_seconds', 0.0)
+                return 304, None
+            if response.status != 200:
+                return response.status, None
+
+            body = await response.read()
+            parse_started = time.perf_counter()
+            result = parse(json.loads(body))
+            parse_seconds = time.perf_counter() - parse_started
+
+            conditional_get_stats['misses'] += 1
+            http_validators[url] = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                # content_length - размер на проводе (с учётом сжатия), если сервер его прислал
+                'size': response.content_length or len(body),
+                'parse_seconds': parse_seconds
+            }
+            return 200, result
+    finally:
+        observe_price_source(source, status, started)
+
+
+def format_conditional_get_stats():
+    """Краткая сводка по условным запросам для логов."""
+    stats = conditional_get_stats
+    return (f"304: {stats['hits']}, 200: {stats['misses']}, "
+            f"сэкономлено {stats['bytes_saved'] / 1024 / 1024:.1f} МБ и "
+            f"{stats['parse_seconds_saved']:.2f} с разбора")
+
+
 # --- МУЛЬТИИСТОЧНИКИ ДЛЯ ЦЕН ---
+def parse_skinport_prices(data):
+    """
+    Преобразует ответ Skinport /v1/items.
+    Возвращает ({название в нижнем регистре: min_price}, {название в нижнем регистре: оригинальное название}).
+    """
+    prices = {}
+    names = {}
+    for item in data or []:
+        name = item.get('market_hash_name')
+        if not name:
+            continue
+        names[name.lower()] = name
+        if item.get('min_price'):
+            prices[name.lower()] = float(item['min_price'])
+    return prices, names
+
+
+async def fetch_skinport_prices():
+    """Асинхронно получает весь прайс-лист Skinport и кэширует его."""
+
+    if last_skinport_update and datetime.now() - last_skinport_update < SKINPORT_CACHE_TTL:
+        logging.debug("Используется кэш Skinport.")
+        return
+
+    async with skinport_refresh_lock:
+        # Пока ждали блокировку, кэш мог обновить другой запрос
+        if last_skinport_update and datetime.now() - last_skinport_update < SKINPORT_CACHE_TTL:
+            return
+        await _refresh_skinport_prices()
+
+
+async def _refresh_skinport_prices():
+    """Скачивает прайс-лист Skinport (вызывается под skinport_refresh_lock)."""
+    global skinport_prices_cache, last_skinport_update
+
+    # Публичный API Skinport без авторизации
+    headers = {'User-Agent': 'CS-Portfolio-Bot/1.0'}
+    async with aiohttp.ClientSession(headers=headers) as session:
+        try:
+            status, parsed = await conditional_get_json(session, SKINPORT_ITEMS_URL, parse_skinport_prices, timeout=15,
+                                                        source='skinport')
+            if status == 304:
+                last_skinport_update = datetime.now()
+                logging.info(f"Кэш Skinport не изменился. {format_conditional_get_stats()}")
+                return
+            if status == 200:
+                skinport_prices_cache, names = parsed
+                add_market_item_names(names)
+                last_skinport_update = datetime.now()
+                logging.info(f"Кэш Skinport обновлён. Получено {len(skinport_prices_cache)} цен.")
+                return
+            logging.warning(f"Skinport API error: {status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logging.warning(f"Ошибка получения прайс-листа Skinport: {e}")
+
+
 async def fetch_skinport_price(item_name):
-    """Получение цены с Skinport API."""
+    """Получение цены с Skinport API (из кэша прайс-листа)."""
     try:
-        # Публичный API Skinport без авторизации
-        url = f"https://api.skinport.com/v1/items?app_id=730&currency=USD&tradable=0"
-        headers = {'User-Agent': 'CS-Portfolio-Bot/1.0'}
-        
-        async with aiohttp.ClientSession(headers=headers) as session:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=15)) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    for item in data:
-                        if item.get('market_hash_name', '').lower() == item_name.lower():
-                            min_price = item.get('min_price')
-                            return float(min_price) if min_price else None
-                    return None
-                else:
-                    logging.warning(f"Skinport API error: {response.status}")
-                    return None
+        await fetch_skinport_prices()
+        return skinport_prices_cache.get(item_name.lower())
     except Exception as e:
         logging.warning(f"Ошибка получения цены с Skinport для {item_name}: {e}")
         return None
@@ -499,74 +1515,154 @@ async def fetch_csmoney_price(item_name):
         logging.warning(f"Ошибка получения цены с CS.Money для {item_name}: {e}")
         return None
 
+async def fetch_item_source_prices(item_name):
+    """Цены одного предмета по источникам: ({источник: цена USD}, цена Steam)."""
+    source_names = ('marketcsgo', 'skinport', 'steam', 'buff', 'csmoney')
+    results = await asyncio.gather(
+        fetch_marketcsgo_single_price(item_name),
+        fetch_skinport_price(item_name),
+        get_planned_steam_price(item_name),
+        fetch_buff_price(item_name),
+        fetch_csmoney_price(item_name),
+        return_exceptions=True)
+    source_prices = {source: price for source, price in zip(source_names, results)
+                     if price and not isinstance(price, Exception)}
+    # Steam исключаем из медианы по требованию
+    steam_price = source_prices.pop('steam', None)
+    return source_prices, steam_price
+
+
+def get_reference_medians(item_names, since):
+    """Последняя достоверная медиана каждого предмета не старше since - опорная цена для поиска выбросов."""
+    if not item_names:
+        return {}
+    placeholders = ",".join("?" * len(item_names))
+    with get_db_cursor() as (cur, _):
+        cur.execute(f"""
+            SELECT item_name, median_price_usd
+            FROM price_history_multisource
+            WHERE item_name IN ({placeholders}) AND timestamp >= ? AND median_price_usd > 0
+              AND COALESCE(median_confidence, 1) >= ?
+            ORDER BY timestamp
+        """, (*item_names, since.isoformat(), PRICE_MIN_CONFIDENCE))
+        return dict(cur.fetchall())
+
+
+def aggregate_source_prices(source_prices, reference_prices=None, source_ages=None):
+    """
+    Устойчивая медиана цен сразу для многих предметов: матрица предметы × источники в numpy.
+    source_prices - {предмет: {источник: цена USD}}, reference_prices - {предмет: прошлая медиана},
+    source_ages - {источник: возраст прайс-листа}.
+    Выбросы отбрасываются по модифицированному z-score (MAD) относительно текущих цен и прошлой медианы,
+    остальные цены сводятся во взвешенную медиану; вес источника уменьшается с возрастом его данных.
+    Достоверность = свежесть (вес оставшихся источников) × согласие (разброс оставшихся цен).
+    Выброс отбрасывается, только если остаются хотя бы две текущие цены: иначе решающий голос был бы
+    у прошлой медианы, и краш, уже попавший в более свежий прайс-лист, скрылся бы за старой ценой.
+    Возвращает {предмет: {'median', 'confidence', 'agreement', 'sources', 'rejected'}}.
+    """
+    reference_prices = reference_prices or {}
+    source_ages = source_ages or {}
+    result = {name: {'median': None, 'confidence': 0.0, 'agreement': 0.0, 'sources': {}, 'rejected': {}}
+              for name, prices in source_prices.items() if not any(price and price > 0 for price in prices.values())}
+    names = [name for name in source_prices if name not in result]
+    if not names:
+        return result
+
+    np = lazy_import('numpy')
+    sources = sorted({source for name in names for source in source_prices[name]})
+    prices = np.array([[source_prices[name].get(source) or np.nan for source in sources] for name in names], dtype=float)
+    prices[~(prices > 0)] = np.nan
+    weights = np.array([PRICE_SOURCE_WEIGHTS.get(source, 1.0)
+                        * 0.5 ** (source_ages.get(source, timedelta(0)) / PRICE_SOURCE_HALF_LIFE) for source in sources])
+    reference = np.array([reference_prices.get(name) or np.nan for name in names], dtype=float)
+    rows = np.arange(len(names))
+
+    # Центр и разброс для поиска выбросов: текущие цены источников и прошлая медиана предмета.
+    # При двух источниках без прошлой медианы выброс не определить - остается только низкая достоверность
+    votes = np.column_stack([prices, reference])
+    center = np.nanmedian(votes, axis=1)
+    mad = np.nanmedian(np.abs(votes - center[:, None]), axis=1)
+    scale = np.maximum(mad / 0.6745, center * PRICE_OUTLIER_MIN_SPREAD)
+    with np.errstate(invalid='ignore'):
+        outliers = np.abs(prices - center[:, None]) / scale[:, None] > PRICE_OUTLIER_THRESHOLD
+    # Два источника против прошлой медианы: расхождение остается расхождением (низкая достоверность)
+    outliers[(~np.isnan(prices) & ~outliers).sum(axis=1) < 2] = False
+    kept = np.where(outliers, np.nan, prices)
+
+    # Взвешенная медиана: NaN при сортировке уходят в конец и получают нулевой вес
+    order = np.argsort(kept, axis=1)
+    sorted_prices = np.take_along_axis(kept, order, axis=1)
+    sorted_weights = np.where(np.isnan(sorted_prices), 0.0, weights[order])
+    cumulative = np.cumsum(sorted_weights, axis=1)
+    total = cumulative[:, -1]
+    half = total[:, None] / 2
+    # Веса, отличающиеся меньше чем на 1% (например, прайс-листы разного возраста в секундах), считаем равными
+    near_half = np.isclose(cumulative, half, rtol=0.01)
+    median_index = np.argmax((cumulative >= half) | near_half, axis=1)
+    lower = sorted_prices[rows, median_index]
+    upper = sorted_prices[rows, np.minimum(median_index + 1, len(sources) - 1)]
+    # Ровно половина веса слева - медиана между соседними ценами, как у statistics.median
+    on_boundary = near_half[rows, median_index] & ~np.isnan(upper) & (upper != lower)
+    median = np.where(on_boundary, (lower + upper) / 2, lower)
+
+    # Достоверность: свежесть оставшихся источников и согласие их цен между собой.
+    # Прошлая медиана здесь не участвует: реальное движение цены не должно выглядеть расхождением
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        spread = np.nanmedian(np.abs(kept - median[:, None]), axis=1) / median
+    agreement = np.clip(1 - np.nan_to_num(spread) / PRICE_CONFIDENCE_SPREAD, 0, 1)
+    confidence = np.minimum(total / PRICE_CONFIDENCE_FULL_WEIGHT, 1) * agreement
+
+    for row, name in enumerate(names):
+        item_sources = {source: float(price) for source, price in zip(sources, prices[row]) if not np.isnan(price)}
+        rejected = {source: item_sources.pop(source) for source in sources if outliers[row, sources.index(source)]}
+        result[name] = {
+            'median': None if np.isnan(median[row]) else float(median[row]),
+            'confidence': round(float(confidence[row]), 3),
+            'agreement': round(float(agreement[row]), 3),
+            'sources': item_sources,
+            'rejected': rejected,
+        }
+    return result
+
+
+@traced("fetch_multisource_prices")
+async def fetch_multisource_prices_batch(item_names):
+    """
+    Цены предметов из всех доступных источников и устойчивая медиана, посчитанная одним пакетом.
+    Возвращает {название: {'median', 'confidence', 'sources', 'rejected', 'steam'}}.
+    """
+    item_names = list(dict.fromkeys(item_names))
+    fetched = await asyncio.gather(*(fetch_item_source_prices(name) for name in item_names))
+
+    now = datetime.now()
+    source_ages = {
+        'marketcsgo': now - last_cache_update if last_cache_update else PRICE_SOURCE_HALF_LIFE * 4,
+        'skinport': now - last_skinport_update if last_skinport_update else PRICE_SOURCE_HALF_LIFE * 4,
+    }
+    reference = get_reference_medians(item_names, now - PRICE_REFERENCE_WINDOW)
+    aggregated = aggregate_source_prices({name: prices for name, (prices, _) in zip(item_names, fetched)},
+                                         reference, source_ages)
+
+    # Сохраняем данные в базу: все ответы источников, в том числе отброшенные, рядом с медианой и ее достоверностью
+    timestamp = now.isoformat()
+    rows = []
+    for name, (source_prices, steam_price) in zip(item_names, fetched):
+        aggregated[name]['steam'] = steam_price  # Steam отдельно для совместимости
+        observed = dict(source_prices, **({'steam': steam_price} if steam_price else {}))
+        for source, price in observed.items():
+            rows.append((name, timestamp, source, price, aggregated[name]['median'], aggregated[name]['confidence']))
+    with get_db_cursor() as (cur, _):
+        cur.executemany(
+            "INSERT INTO price_history_multisource (item_name, timestamp, source, price_usd, median_price_usd, median_confidence) "
+            "VALUES (?, ?, ?, ?, ?, ?)", rows)
+    return aggregated
+
+
 async def fetch_multisource_prices(item_name):
-    """Получение цен из всех доступных источников и расчет медианы."""
+    """Получение цен из всех доступных источников и расчет устойчивой медианы."""
     try:
-        # Получаем цены из всех источников параллельно
-        marketcsgo_task = asyncio.create_task(fetch_marketcsgo_single_price(item_name))
-        skinport_task = asyncio.create_task(fetch_skinport_price(item_name))
-        steam_task = asyncio.create_task(get_steam_price(item_name))
-        buff_task = asyncio.create_task(fetch_buff_price(item_name))
-        csmoney_task = asyncio.create_task(fetch_csmoney_price(item_name))
-        
-        tasks = [marketcsgo_task, skinport_task, steam_task, buff_task, csmoney_task]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        
-        # Обрабатываем результаты
-        prices = []
-        source_prices = {}
-        
-        # MarketCSGO
-        marketcsgo_price = results[0] if not isinstance(results[0], Exception) else None
-        if marketcsgo_price:
-            prices.append(marketcsgo_price)
-            source_prices['marketcsgo'] = marketcsgo_price
-        
-        # Skinport
-        skinport_price = results[1] if not isinstance(results[1], Exception) else None
-        if skinport_price:
-            prices.append(skinport_price)
-            source_prices['skinport'] = skinport_price
-        
-        # Steam (исключаем из медианы по требованию)
-        steam_price = results[2] if not isinstance(results[2], Exception) else None
-        if steam_price:
-            source_prices['steam'] = steam_price
-        
-        # BUFF
-        buff_price = results[3] if not isinstance(results[3], Exception) else None
-        if buff_price:
-            prices.append(buff_price)
-            source_prices['buff'] = buff_price
-        
-        # CS.Money
-        csmoney_price = results[4] if not isinstance(results[4], Exception) else None
-        if csmoney_price:
-            prices.append(csmoney_price)
-            source_prices['csmoney'] = csmoney_price
-        
-        # Рассчитываем медиану из доступных цен (кроме Steam)
-        median_price = None
-        if len(prices) >= 2:
-            median_price = statistics.median(prices)
-        elif len(prices) == 1:
-            median_price = prices[0]
-        
-        # Сохраняем данные в базу
-        timestamp = datetime.now().isoformat()
-        with get_db_cursor() as (cur, _):
-            for source, price in source_prices.items():
-                cur.execute(
-                    "INSERT INTO price_history_multisource (item_name, timestamp, source, price_usd, median_price_usd) VALUES (?, ?, ?, ?, ?)",
-                    (item_name, timestamp, source, price, median_price)
-                )
-        
-        return {
-            'median': median_price,
-            'sources': source_prices,
-            'steam': steam_price  # Steam отдельно для совместимости
-        }
-        
+        return (await fetch_multisource_prices_batch([item_name]))[item_name]
     except Exception as e:
         logging.error(f"Ошибка при получении мультиисточников цен для {item_name}: {e}")
         return None
@@ -576,15 +1672,44 @@ async def fetch_marketcsgo_single_price(item_name):
     await fetch_marketcsgo_prices()
     return marketcsgo_prices_cache.get(item_name.lower())
 
+def parse_marketcsgo_prices(data):
+    """
+    Преобразует ответ MarketCSGO.
+    Возвращает ({название в нижнем регистре: цена}, {название в нижнем регистре: оригинальное название}).
+    """
+    prices = {}
+    names = {}
+    if data and data.get("success"):
+        items_data = data.get("items")
+        if isinstance(items_data, dict):
+            items_data = list(items_data.values())
+        if isinstance(items_data, list):
+            for item in items_data:
+                if "market_hash_name" in item and "price" in item:
+                    name = item["market_hash_name"]
+                    prices[name.lower()] = float(item["price"])
+                    names[name.lower()] = name
+    return prices, names
+
+
 async def fetch_marketcsgo_prices():
     """Асинхронно получает цены с MarketCSGO и кэширует их."""
-    global marketcsgo_prices_cache, last_cache_update
 
     if last_cache_update and datetime.now() - last_cache_update < CACHE_TTL:
         logging.debug("Используется кэш MarketCSGO.")
         return
 
-    url = "https://market.csgo.com/api/v2/prices/USD.json"
+    async with marketcsgo_refresh_lock:
+        # Пока ждали блокировку, кэш мог обновить другой запрос
+        if last_cache_update and datetime.now() - last_cache_update < CACHE_TTL:
+            return
+        await _refresh_marketcsgo_prices()
+
+
+async def _refresh_marketcsgo_prices():
+    """Скачивает прайс-лист MarketCSGO (вызывается под marketcsgo_refresh_lock)."""
+    global marketcsgo_prices_cache, last_cache_update, prices_version
+
     headers = {
         'User-Agent':
         'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
@@ -592,91 +1717,235 @@ async def fetch_marketcsgo_prices():
 
     async with aiohttp.ClientSession(headers=headers) as session:
         try:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    prices = {}
-                    if data and data.get("success"):
-                        items_data = data.get("items")
-                        if isinstance(items_data, dict):
-                            prices = {
-                                item["market_hash_name"].lower():
-                                float(item["price"])
-                                for item in items_data.values() if
-                                "market_hash_name" in item and "price" in item
-                            }
-                        elif isinstance(items_data, list):
-                            prices = {
-                                item["market_hash_name"].lower():
-                                float(item["price"])
-                                for item in items_data if
-                                "market_hash_name" in item and "price" in item
-                            }
-
-                    marketcsgo_prices_cache = prices
-                    last_cache_update = datetime.now()
-                    logging.info(
-                        f"Кэш MarketCSGO обновлён. Получено {len(prices)} цен."
-                    )
-                    return
-                logging.error(
-                    f"Ошибка при запросе к MarketCSGO: {response.status}")
-        except aiohttp.ClientError as e:
+            status, parsed = await conditional_get_json(session, MARKETCSGO_PRICES_URL, parse_marketcsgo_prices, timeout=10,
+                                                        source='marketcsgo')
+            if status == 304:
+                # Данные не изменились: продлеваем кэш без повторного разбора
+                last_cache_update = datetime.now()
+                logging.info(f"Кэш MarketCSGO не изменился. {format_conditional_get_stats()}")
+                return
+            if status == 200:
+                marketcsgo_prices_cache, names = parsed
+                add_market_item_names(names)
+                last_cache_update = datetime.now()
+                prices_version += 1
+                schedule_stream_update()
+                logging.info(
+                    f"Кэш MarketCSGO обновлён. Получено {len(marketcsgo_prices_cache)} цен. {format_conditional_get_stats()}"
+                )
+                return
+            logging.error(f"Ошибка при запросе к MarketCSGO: {status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
             logging.error(f"Ошибка соединения при запросе к MarketCSGO: {e}")
 
 
 async def get_steam_price(name):
-    """Получает цену предмета со Steam Community Market."""
-    from urllib.parse import quote
-    url = f"https://steamcommunity.com/market/priceoverview/?currency=1&appid=730&market_hash_name={quote(name)}"
+    """Получает цену предмета со Steam Community Market (асинхронно, не блокируя event loop)."""
+    url = f"{STEAM_COMMUNITY_URL}/market/priceoverview/"
+    params = {'currency': '1', 'appid': '730', 'market_hash_name': name}
     headers = {
         'User-Agent':
         'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
     }
+    started = time.perf_counter()
+    status = 'error'
     try:
-        response = requests.get(url, headers=headers, timeout=10)
-        if response.status_code == 200:
-            data = response.json()
-            if data and data.get("success"):
-                price_str = data.get("median_price") or data.get(
-                    "lowest_price")
-                if price_str:
-                    cleaned_price = price_str.replace("$",
-                                                      "").replace(",",
-                                                                  "").strip()
-                    try:
-                        return float(cleaned_price)
-                    except ValueError:
-                        logging.error(
-                            f"Не удалось преобразовать цену '{price_str}' в число."
-                        )
-                        return None
-        logging.error(f"Ошибка при запросе к Steam: {response.status_code}")
-    except requests.exceptions.RequestException as e:
+        async with aiohttp.ClientSession(headers=headers) as session:
+            async with session.get(url, params=params, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                status = response.status
+                if response.status == 200:
+                    data = await response.json(content_type=None)
+                    if data and data.get("success"):
+                        price_str = data.get("median_price") or data.get("lowest_price")
+                        if price_str:
+                            cleaned_price = price_str.replace("$", "").replace(",", "").strip()
+                            try:
+                                return float(cleaned_price)
+                            except ValueError:
+                                logging.error(f"Не удалось преобразовать цену '{price_str}' в число.")
+                                return None
+        logging.error(f"Ошибка при запросе к Steam: {status}")
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
         logging.error(f"Ошибка соединения при запросу к Steam: {e}")
+    finally:
+        observe_price_source('steam_market', status, started)
     return None
 
+
+# --- АДАПТИВНОЕ ОБНОВЛЕНИЕ ЦЕН STEAM ---
+# Steam отдает цены по одному предмету и строго ограничивает частоту запросов, поэтому цены
+# опрашиваются фоновой задачей по плану: часто для горячих предметов и редко для стабильных.
+steam_price_state = {}  # {название: {'price': цена USD или None, 'fetched_at': datetime}}
+steam_refresh_plan = {}  # {название: {'priority', 'interval', 'volatility', 'alert_proximity', 'users'}}
+steam_request_times = deque()  # time.monotonic() запросов к Steam за последнюю минуту
+# Предметы, которым цена понадобилась при исчерпанном бюджете: их опросит ближайший запуск планировщика
+steam_refresh_queue = set()
+
+
+def get_item_volatility(since):
+    """Волатильность предметов с момента since: стандартное отклонение медианной цены к средней."""
+    with get_db_cursor() as (cur, _):
+        cur.execute("""
+            SELECT item_name, MAX(COALESCE(median_price_usd, price_usd))
+            FROM price_history_multisource
+            WHERE timestamp >= ? AND COALESCE(median_confidence, 1) >= ?
+            GROUP BY item_name, timestamp
+        """, (since.isoformat(), PRICE_MIN_CONFIDENCE))
+        rows = cur.fetchall()
+    series = {}
+    for name, price in rows:
+        if price:
+            series.setdefault(name, []).append(price)
+    return {name: statistics.pstdev(prices) / statistics.mean(prices)
+            for name, prices in series.items() if len(prices) >= 2}
+
+
+def get_item_interest():
+    """Число пользователей, которые держат предмет, отслеживают его или ждут по нему уведомления."""
+    with get_db_cursor() as (cur, _):
+        cur.execute("""
+            SELECT item_name, COUNT(DISTINCT user_id) FROM (
+                SELECT name AS item_name, user_id FROM items
+                UNION SELECT item_name, user_id FROM item_watch_list
+                UNION SELECT item_name, user_id FROM price_alerts
+            )
+            GROUP BY item_name
+        """)
+        return dict(cur.fetchall())
+
+
+def get_alert_proximity():
+    """Близость уведомлений к цели по предметам: 1 - цена у цели, 0 - дальше ALERT_PROXIMITY_PERCENT."""
+    proximity = {}
+    for _, _, item_name, target_price, _ in get_all_price_alerts():
+        price_usd = marketcsgo_prices_cache.get(item_name.lower())
+        if not price_usd or not target_price:
+            continue
+        distance_percent = abs(price_usd * USD_TO_UAH - target_price) / target_price * 100
+        closeness = max(0.0, 1 - distance_percent / ALERT_PROXIMITY_PERCENT)
+        proximity[item_name] = max(proximity.get(item_name, 0.0), closeness)
+    return proximity
+
+
+def plan_steam_refresh():
+    """
+    Пересчитывает приоритеты и интервалы опроса Steam для предметов, которые кому-то интересны.
+    Интервал = STEAM_REFRESH_MAX_INTERVAL / приоритет², в пределах [STEAM_REFRESH_MIN_INTERVAL, STEAM_REFRESH_MAX_INTERVAL].
+    """
+    global steam_refresh_plan
+    volatility = get_item_volatility(datetime.now() - STEAM_VOLATILITY_WINDOW)
+    proximity = get_alert_proximity()
+    plan = {}
+    for name, users in get_item_interest().items():
+        priority = (1 + volatility.get(name, 0.0) / STEAM_VOLATILITY_REFERENCE
+                    + 3 * proximity.get(name, 0.0) + math.log1p(users))
+        interval = max(STEAM_REFRESH_MIN_INTERVAL, min(STEAM_REFRESH_MAX_INTERVAL, STEAM_REFRESH_MAX_INTERVAL / priority ** 2))
+        plan[name] = {
+            'priority': priority,
+            'interval': interval,
+            'volatility': volatility.get(name, 0.0),
+            'alert_proximity': proximity.get(name, 0.0),
+            'users': users,
+        }
+    steam_refresh_plan = plan
+
+    # Цены предметов, которые больше никому не интересны, не храним дольше максимального интервала
+    now = datetime.now()
+    for name in [name for name, state in steam_price_state.items()
+                 if name not in plan and now - state['fetched_at'] > STEAM_REFRESH_MAX_INTERVAL]:
+        del steam_price_state[name]
+    return plan
+
+
+def steam_requests_left():
+    """Сколько запросов к Steam еще можно сделать в текущем минутном окне."""
+    now = time.monotonic()
+    while steam_request_times and now - steam_request_times[0] > 60:
+        steam_request_times.popleft()
+    return STEAM_REFRESH_BUDGET_PER_MINUTE - len(steam_request_times)
+
+
+async def refresh_steam_price(name, reason):
+    """Запрашивает цену Steam и запоминает ее вместе со временем запроса (неудачный ответ тоже)."""
+    steam_request_times.append(time.monotonic())
+    steam_refresh_requests.inc(reason)
+    price = await get_steam_price(name)
+    steam_price_state[name] = {'price': price, 'fetched_at': datetime.now()}
+    return price
+
+
+async def get_planned_steam_price(name):
+    """
+    Цена Steam по плану обновления.
+    Steam опрашивается сразу, только если цены предмета еще нет или она старше максимального интервала,
+    и только в пределах бюджета запросов; иначе возвращается устаревшая цена (или None),
+    а предмет ставится в очередь планировщика.
+    """
+    state = steam_price_state.get(name)
+    if state is None or datetime.now() - state['fetched_at'] > STEAM_REFRESH_MAX_INTERVAL:
+        if steam_requests_left() > 0:
+            return await refresh_steam_price(name, 'on_demand')
+        steam_refresh_queue.add(name)
+        return state['price'] if state else None
+    return state['price']
+
+
+async def refresh_steam_prices():
+    """Опрашивает Steam по предметам с истекшим интервалом: сначала самые просроченные, в пределах бюджета."""
+    plan = plan_steam_refresh()
+    now = datetime.now()
+    due = []
+    for name, entry in plan.items():
+        state = steam_price_state.get(name)
+        if state is None:
+            overdue = float('inf')
+        else:
+            overdue = (now - state['fetched_at']) / entry['interval']
+        if overdue >= 1:
+            due.append((overdue, entry['priority'], name))
+    # Отложенные из-за бюджета запросы идут первыми, даже если предмета нет в плане
+    due += [(float('inf'), 0.0, name) for name in steam_refresh_queue if name not in plan]
+    due.sort(reverse=True)
+
+    budget = steam_requests_left()
+    for _, _, name in due[:max(budget, 0)]:
+        await refresh_steam_price(name, 'scheduled')
+        steam_refresh_queue.discard(name)
+        # Цены в отчетах пересчитываются с новой ценой Steam
+        item_prices_cache.invalidate(name)
+        multisource_prices_cache.invalidate(name)
+    if due:
+        logging.info(f"Steam: обновлено {min(len(due), max(budget, 0))} из {len(due)} предметов к обновлению, "
+                     f"в плане {len(plan)}")
+
+    # Уведомления, близкие к цели, проверяются сразу, а не раз в 30 минут: срабатывают,
+    # как только прайс-лист MarketCSGO обновился (в том числе по запросу пользователя)
+    hot = {name for name, entry in plan.items() if entry['alert_proximity'] >= ALERT_HOT_PROXIMITY}
+    if hot:
+        await check_price_alerts(hot)
+
+
 # --- ФУНКЦИИ ДЛЯ АНАЛИЗА ПОРТФЕЛЯ ---
-def save_portfolio_snapshot():
-    """Сохранение снимка портфеля для анализа изменений."""
-    items = get_items_from_db()
+def save_portfolio_snapshot(user_id):
+    """Сохранение снимка портфеля пользователя для анализа изменений."""
+    items = get_items_from_db(user_id)
     timestamp = datetime.now().isoformat()
     
     with get_db_cursor() as (cur, _):
         for item_id, name, qty, buy_uah, buy_usd in items:
             # Пытаемся получить текущую цену из кэша
-            if name in multisource_prices_cache:
-                price_data = multisource_prices_cache[name]
+            price_data = multisource_prices_cache.get(name)
+            if price_data:
                 current_price = price_data.get('median') or price_data.get('sources', {}).get('marketcsgo')
                 
                 if current_price:
                     cur.execute(
-                        "INSERT INTO portfolio_snapshots (timestamp, item_name, price_usd, quantity) VALUES (?, ?, ?, ?)",
-                        (timestamp, name, current_price, qty)
+                        "INSERT INTO portfolio_snapshots (timestamp, item_name, price_usd, quantity, user_id) VALUES (?, ?, ?, ?, ?)",
+                        (timestamp, name, current_price, qty, user_id)
                     )
 
-def get_biggest_price_changes(limit=3):
-    """Находит предметы с наибольшими изменениями цен."""
+def get_biggest_price_changes(user_id, limit=3):
+    """Находит предметы портфеля пользователя с наибольшими изменениями цен."""
     try:
         with get_db_cursor() as (cur, _):
             # Получаем последние два снимка для каждого предмета
@@ -685,6 +1954,7 @@ def get_biggest_price_changes(limit=3):
                     SELECT item_name, price_usd, timestamp,
                            ROW_NUMBER() OVER (PARTITION BY item_name ORDER BY timestamp DESC) as rn
                     FROM portfolio_snapshots
+                    WHERE user_id = ?
                 ),
                 current_prices AS (
                     SELECT item_name, price_usd as current_price, timestamp as current_time
@@ -704,15 +1974,15 @@ def get_biggest_price_changes(limit=3):
                 WHERE pp.previous_price > 0
                 ORDER BY change_pct DESC
                 LIMIT ?
-            """, (limit,))
+            """, (user_id, limit))
             
             return cur.fetchall()
     except Exception as e:
         logging.error(f"Ошибка при получении изменений цен: {e}")
         return []
 
-def get_top_gainers_and_losers():
-    """Получает топ растущих и падающих предметов за последние сутки."""
+def get_top_gainers_and_losers(user_id):
+    """Получает топ растущих и падающих предметов портфеля пользователя за последние сутки."""
     try:
         with get_db_cursor() as (cur, _):
             # Получаем изменения за последние 24 часа
@@ -729,13 +1999,14 @@ def get_top_gainers_and_losers():
                         (ps1.price_usd - ps2.price_usd) * ps1.quantity as profit_loss_usd
                     FROM portfolio_snapshots ps1
                     JOIN portfolio_snapshots ps2 ON ps1.item_name = ps2.item_name
-                    WHERE ps1.timestamp > ps2.timestamp 
+                    WHERE ps1.user_id = ? AND ps2.user_id = ps1.user_id
+                    AND ps1.timestamp > ps2.timestamp 
                     AND ps2.timestamp >= ?
                     AND ps2.price_usd > 0
                 )
                 SELECT * FROM price_changes 
                 ORDER BY change_pct DESC
-            """, (yesterday,))
+            """, (user_id, yesterday))
             
             return cur.fetchall()
     except Exception as e:
@@ -751,16 +2022,207 @@ async def get_current_prices_and_steam(item_name):
 
     marketcsgo_price = marketcsgo_prices_cache.get(item_name.lower())
 
-    steam_price = await get_steam_price(item_name)
+    steam_price = await get_planned_steam_price(item_name)
 
     return marketcsgo_price, steam_price
 
 
-# --- КЛАВИАТУРА ---
-def get_main_keyboard():
-    """Возвращает клавиатуру с основными кнопками."""
-    kb = [[
-        KeyboardButton(text="➕ Добавить"),
+# --- ОЦЕНКА ПОРТФЕЛЯ ДЛЯ ОТЧЕТОВ ---
+async def get_item_prices(item_name):
+    """Цены предмета (MarketCSGO и Steam) из общего кэша; источники опрашиваются только при промахе."""
+    prices = item_prices_cache.get(item_name)
+    if prices is None:
+        marketcsgo_usd, steam_usd = await get_current_prices_and_steam(item_name)
+        prices = {'marketcsgo_usd': marketcsgo_usd, 'steam_usd': steam_usd}
+        item_prices_cache.set(item_name, prices)
+    return prices
+
+
+def invalidate_user_prices(user_id):
+    """Сбрасывает кэшированные цены предметов пользователя и его оценку (кнопка 'Обновить')."""
+    for _, name, _, _, _ in get_items_from_db(user_id):
+        item_prices_cache.invalidate(name)
+        multisource_prices_cache.invalidate(name)
+    report_valuations.invalidate(user_id)
+
+
+@traced("valuation report")
+async def get_report_valuation(user_id, items=None):
+    """
+    Оценка портфеля пользователя для отчета: позиции с ценами, итоги и категории.
+    Переиспользуется при листании страниц и повторном открытии, пока не изменились портфель или цены;
+    без items позиции читаются из БД только при пересчете.
+    Новая оценка непустого портфеля сохраняется в историю стоимости.
+    """
+    await fetch_marketcsgo_prices()
+    version = get_portfolio_version(user_id)
+    valuation = report_valuations.get(user_id)
+    if valuation and valuation['version'] == version:
+        return valuation
+    if items is None:
+        items = get_items_from_db(user_id)
+
+    names = list({name for _, name, _, _, _ in items})
+    prices = dict(zip(names, await asyncio.gather(*(get_item_prices(name) for name in names))))
+
+    positions = []
+    category_stats = {}
+    total_buy_uah = 0
+    total_now_uah = 0.0
+    for item_id, name, qty, buy_uah, buy_usd in items:
+        marketcsgo_usd = prices[name]['marketcsgo_usd']
+        pos_buy_uah = buy_uah * qty
+        pos_now_uah = marketcsgo_usd * USD_TO_UAH * qty if marketcsgo_usd else pos_buy_uah
+        total_buy_uah += pos_buy_uah
+        total_now_uah += pos_now_uah
+
+        category = get_item_category(name)
+        if category not in category_stats:
+            category_stats[category] = {'buy_uah': 0, 'now_uah': 0}
+        category_stats[category]['buy_uah'] += pos_buy_uah
+        category_stats[category]['now_uah'] += pos_now_uah
+
+        positions.append({
+            'id': item_id,
+            'name': name,
+            'quantity': qty,
+            'buy_uah': buy_uah,
+            'buy_usd': buy_usd,
+            'marketcsgo_usd': marketcsgo_usd,
+            'steam_usd': prices[name]['steam_usd'],
+            'now_uah': pos_now_uah,
+            'category': category
+        })
+
+    valuation = {
+        'version': version,
+        'positions': positions,
+        'categories': category_stats,
+        'total_buy_uah': total_buy_uah,
+        'total_now_uah': total_now_uah,
+        # Разметка страниц по фильтрам, считается один раз на оценку (get_report_layout)
+        'layouts': {}
+    }
+    report_valuations.set(user_id, valuation)
+    if positions:
+        # Сохраняем текущую стоимость портфеля для уведомлений и графика
+        save_portfolio_value(user_id, total_now_uah)
+    return valuation
+
+
+# --- ФОНОВЫЕ ЗАДАЧИ ПОЛЬЗОВАТЕЛЕЙ ---
+class UserJob:
+    """Долгая команда пользователя: статусное сообщение, задача asyncio и отмена."""
+
+    def __init__(self, key, user_id, job_class, status_message, owns_status):
+        self.key = key
+        self.user_id = user_id
+        self.job_class = job_class
+        self.status_message = status_message
+        # Статусное сообщение создано менеджером и удаляется после успешного завершения
+        self.owns_status = owns_status
+        self.task = None
+        self.last_text = None
+
+    async def progress(self, text):
+        """Обновляет статусное сообщение задачи; одинаковый текст повторно не отправляется."""
+        if text == self.last_text:
+            return
+        self.last_text = text
+        try:
+            await self.status_message.edit_text(text)
+        except Exception as e:
+            logging.debug(f"Не удалось обновить статус задачи {self.key}: {e}")
+
+
+class JobManager:
+    """
+    Очередь долгих команд: ограниченные пулы по классам задач, лимит задач на пользователя,
+    дедупликация одинаковых задач и отмена через /cancel.
+    """
+
+    def __init__(self, class_limits, per_user_limit):
+        self.class_limits = class_limits
+        self.per_user_limit = per_user_limit
+        self.semaphores = {}
+        self.jobs = {}
+
+    def user_jobs(self, user_id):
+        """Активные задачи пользователя."""
+        return [job for job in self.jobs.values() if job.user_id == user_id]
+
+    async def submit(self, message, user_id, job_class, key, run, status_message=None):
+        """
+        Ставит задачу в очередь и сразу возвращает управление обработчику.
+        run(job) - корутина, выполняющая работу; key - параметры для дедупликации.
+        """
+        key = (user_id, job_class) + tuple(key)
+        if key in self.jobs:
+            await message.answer("⏳ Эта задача уже выполняется. Дождись результата или отправь /cancel.")
+            return None
+        if len(self.user_jobs(user_id)) >= self.per_user_limit:
+            await message.answer(
+                f"⚠️ У тебя уже {self.per_user_limit} активные задачи. Дождись их завершения или отправь /cancel.")
+            return None
+
+        owns_status = status_message is None
+        job = UserJob(key, user_id, job_class, status_message, owns_status)
+        # Задача регистрируется до первого await: обработчики выполняются параллельно,
+        # и два быстрых нажатия иначе оба прошли бы проверки выше
+        self.jobs[key] = job
+        try:
+            if owns_status:
+                job.status_message = await message.answer("⏳ Задача поставлена в очередь...")
+            else:
+                await job.progress("⏳ Задача поставлена в очередь...")
+        except BaseException:
+            self.jobs.pop(key, None)
+            raise
+
+        job.task = asyncio.create_task(self._run(job, run))
+        return job
+
+    async def _run(self, job, run):
+        if job.job_class not in self.semaphores:
+            self.semaphores[job.job_class] = asyncio.Semaphore(self.class_limits.get(job.job_class, 1))
+        try:
+            queued = time.perf_counter()
+            async with self.semaphores[job.job_class]:
+                record_span(f"user_job_queue {job.job_class}", queued)
+                with trace_span(f"user_job {job.job_class}"):
+                    await run(job)
+            if job.owns_status:
+                try:
+                    await job.status_message.delete()
+                except Exception:
+                    pass
+        except asyncio.CancelledError:
+            await job.progress("🚫 Задача отменена.")
+        except Exception as e:
+            logging.error(f"Ошибка фоновой задачи {job.key}: {e}")
+            await job.progress(f"❌ Ошибка выполнения задачи: {str(e)}")
+        finally:
+            self.jobs.pop(job.key, None)
+
+    def cancel_user_jobs(self, user_id):
+        """Отменяет все задачи пользователя. Возвращает количество отмененных."""
+        # Задачи, для которых еще отправляется статусное сообщение, пока не запущены
+        user_jobs = [job for job in self.user_jobs(user_id) if job.task is not None]
+        for job in user_jobs:
+            job.task.cancel()
+        return len(user_jobs)
+
+
+jobs = JobManager(JOB_CLASS_LIMITS, JOB_USER_LIMIT)
+# matplotlib.pyplot не потокобезопасен: графики рисуются в рабочих потоках по одному
+pyplot_lock = threading.Lock()
+
+
+# --- КЛАВИАТУРА ---
+def get_main_keyboard():
+    """Возвращает клавиатуру с основными кнопками."""
+    kb = [[
+        KeyboardButton(text="➕ Добавить"),
         KeyboardButton(text="📊 Портфель")
     ], [KeyboardButton(text="🗑️ Удалить"),
         KeyboardButton(text="📈 График")],
@@ -788,11 +2250,19 @@ def get_main_keyboard():
     return ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True)
 
 
+# Тексты кнопок главного меню - метки обработчиков в метриках
+MAIN_KEYBOARD_TEXTS = {button.text for row in get_main_keyboard().keyboard for button in row}
+
+
 # --- ОБРАБОТЧИКИ СООБЩЕНИЙ ---
 @router.message(Command("start"))
-async def start_cmd(message: Message):
-    """Обработчик команды /start."""
+async def start_cmd(message: Message, state: FSMContext):
+    """Обработчик команды /start (в том числе deep link из inline-результатов: /start add_<токен>)."""
     subscribe_user(message.from_user.id)
+    payload = (message.text or "").partition(" ")[2].strip()
+    if payload:
+        await open_inline_deep_link(message, state, payload)
+        return
     await message.answer(
         "👋 Привет! Я бот для отслеживания твоего CS2 портфеля 💼\n\n"
         "Я буду отправлять тебе уведомления о его изменении. Используй кнопки ниже, чтобы управлять им.",
@@ -836,7 +2306,7 @@ async def add_item_parse(message: Message):
             await message.answer("⚠️ Количество и цена должны быть больше 0.")
             return
 
-        add_item_to_db(name, qty, price)
+        add_item_to_db(message.from_user.id, name, qty, price)
         await message.answer(f"✅ Предмет <b>{name}</b> добавлен в портфель!",
                              reply_markup=get_main_keyboard())
     except (ValueError, IndexError):
@@ -851,17 +2321,14 @@ async def add_item_parse(message: Message):
 @router.message(F.text == "📊 Портфель")
 async def portfolio_cmd(message: Message):
     """Обработчик кнопки 'Портфель'. Начинает отчет с первой страницы, отправляя новое сообщение."""
-    # Очищаем кэш, чтобы при следующем нажатии цены обновились
-    global portfolio_prices_cache, multisource_prices_cache
-    portfolio_prices_cache = {}
-    multisource_prices_cache = {}
-    await generate_portfolio_report(message, page=0)
+    # Свежие цены из кэша переиспользуются; принудительно обновляет кнопка '🔄 Обновить'
+    await generate_portfolio_report(message, message.from_user.id, page=0)
 
 @router.message(F.text == "📊 Топ изменений")
 async def top_changes_cmd(message: Message):
     """Показывает топ растущих/падающих предметов."""
     try:
-        changes = get_top_gainers_and_losers()
+        changes = get_top_gainers_and_losers(message.from_user.id)
         
         if not changes:
             await message.answer("📊 Недостаточно данных для анализа изменений. Подождите накопления истории цен.")
@@ -902,8 +2369,8 @@ async def trend_analysis_cmd(message: Message):
         with get_db_cursor() as (cur, _):
             thirty_days_ago = (datetime.now() - timedelta(days=30)).isoformat()
             cur.execute(
-                "SELECT timestamp, value_uah FROM portfolio_history WHERE timestamp >= ? ORDER BY timestamp",
-                (thirty_days_ago,)
+                "SELECT timestamp, value_uah FROM portfolio_history WHERE user_id = ? AND timestamp >= ? ORDER BY timestamp",
+                (message.from_user.id, thirty_days_ago)
             )
             history = cur.fetchall()
         
@@ -957,7 +2424,7 @@ async def predictions_cmd(message: Message):
     """Прогнозы и рекомендации."""
     try:
         # Простой анализ для прогнозов
-        items = get_items_from_db()
+        items = get_items_from_db(message.from_user.id)
         if not items:
             await message.answer("❌ Портфель пуст.")
             return
@@ -1003,7 +2470,7 @@ async def predictions_cmd(message: Message):
 async def detailed_stats_cmd(message: Message):
     """Детальная статистика портфеля."""
     try:
-        items = get_items_from_db()
+        items = get_items_from_db(message.from_user.id)
         if not items:
             await message.answer("❌ Портфель пуст.")
             return
@@ -1015,7 +2482,7 @@ async def detailed_stats_cmd(message: Message):
         
         # Анализ по датам добавления
         with get_db_cursor() as (cur, _):
-            cur.execute("SELECT added_at FROM items ORDER BY added_at")
+            cur.execute("SELECT added_at FROM items WHERE user_id = ? ORDER BY added_at", (message.from_user.id, ))
             dates = [datetime.fromisoformat(row[0]) for row in cur.fetchall()]
         
         if dates:
@@ -1061,14 +2528,231 @@ async def detailed_stats_cmd(message: Message):
 
 @router.message(Command("cancel"))
 async def cancel_handler(message: Message, state: FSMContext):
-    """Отмена текущего состояния."""
+    """Отмена текущего состояния и фоновых задач пользователя."""
     current_state = await state.get_state()
-    if current_state is None:
+    cancelled_jobs = jobs.cancel_user_jobs(message.from_user.id)
+    if current_state is None and not cancelled_jobs:
         await message.answer("❌ Нет активных операций для отмены.")
         return
     
     await state.clear()
-    await message.answer("✅ Операция отменена.", reply_markup=get_main_keyboard())
+    text = "✅ Операция отменена."
+    if cancelled_jobs:
+        text += f"\n🚫 Остановлено задач: {cancelled_jobs}"
+    await message.answer(text, reply_markup=get_main_keyboard())
+
+
+# --- ПРОФИЛИРОВАНИЕ ---
+class SamplingProfiler:
+    """
+    Сэмплирующий профайлер всего процесса: раз в interval снимает стеки всех потоков (sys._current_frames).
+    Работает в своем потоке и не требует перезапуска; накладные расходы - один обход стеков за сэмпл.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = {}  # {свернутый стек "поток;внешняя;...;внутренняя": число сэмплов}
+        self.samples = 0
+
+    def run(self, seconds):
+        own_thread = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack = []
+                if (frame.f_code.co_name, os.path.basename(frame.f_code.co_filename)) in PROFILE_IDLE_FRAMES:
+                    stack.append(PROFILE_IDLE_LABEL)
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        """Свернутые стеки (формат flamegraph.pl / speedscope): "стек число" по строке."""
+        return "\n".join(f"{stack} {count}" for stack, count in sorted(self.stacks.items())) + "\n"
+
+    def top_own(self, limit):
+        """
+        Функции, в которых чаще всего находились потоки (собственное время): [(функция, доля)].
+        Доля считается от стеков занятых потоков, простаивающие в ожидании не учитываются.
+        """
+        totals = {}
+        for stack, count in self.stacks.items():
+            leaf = stack.rsplit(";", 1)[-1]
+            if leaf != PROFILE_IDLE_LABEL:
+                totals[leaf] = totals.get(leaf, 0) + count
+        busy = sum(totals.values()) or 1
+        top = sorted(totals.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [(name, count / busy) for name, count in top]
+
+
+def render_flamegraph_svg(stacks, title, width=1200, row_height=16):
+    """SVG flamegraph из свернутых стеков: ширина блока - доля сэмплов, подсказка с числом сэмплов."""
+    root = {'count': 0, 'children': {}}
+    max_depth = 0
+    for stack, count in stacks.items():
+        node = root
+        node['count'] += count
+        frames = stack.split(";")
+        max_depth = max(max_depth, len(frames))
+        for frame_name in frames:
+            node = node['children'].setdefault(frame_name, {'count': 0, 'children': {}})
+            node['count'] += count
+
+    total = root['count'] or 1
+    height = (max_depth + 1) * row_height + 40
+    elements = []
+
+    def add_node(name, node, x, level):
+        node_width = node['count'] / total * width
+        if node_width < 0.5:
+            return
+        y = height - 10 - (level + 1) * row_height
+        # Теплая палитра, цвет зависит от имени функции, чтобы одинаковые функции совпадали
+        digest = hashlib.md5(name.encode()).digest()
+        color = f"rgb({205 + digest[0] % 50},{80 + digest[1] % 120},{30 + digest[2] % 50})"
+        label = html.escape(name)
+        element = (f'<g><title>{label} ({node["count"]} сэмплов, {node["count"] / total * 100:.1f}%)</title>'
+                   f'<rect x="{x:.1f}" y="{y}" width="{node_width:.1f}" height="{row_height - 1}" fill="{color}" rx="2"/>')
+        max_chars = int(node_width / 7)
+        if max_chars >= 3:
+            text = name if len(name) <= max_chars else name[:max_chars - 2] + ".."
+            element += f'<text x="{x + 3:.1f}" y="{y + row_height - 4}">{html.escape(text)}</text>'
+        elements.append(element + '</g>')
+        child_x = x
+        for child_name, child in sorted(node['children'].items()):
+            add_node(child_name, child, child_x, level + 1)
+            child_x += child['count'] / total * width
+
+    add_node("all", root, 0, 0)
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+            f'font-family="monospace" font-size="11">'
+            f'<rect width="100%" height="100%" fill="#f8f8f8"/>'
+            f'<text x="{width / 2}" y="18" text-anchor="middle" font-size="14">{html.escape(title)}</text>'
+            + "".join(elements) + '</svg>')
+
+
+# --- АДМИНИСТРИРОВАНИЕ ---
+def is_admin(user_id):
+    """Пользователь указан в ADMIN_IDS."""
+    return user_id in ADMIN_IDS
+
+
+@router.message(Command("loopblocks"))
+async def loop_blocks_cmd(message: Message):
+    """Отчет сторожа event loop: где и насколько loop блокировался синхронным кодом (для администраторов)."""
+    if not is_admin(message.from_user.id):
+        await message.answer("⛔ Команда доступна только администраторам.")
+        return
+    if loop_watchdog is None:
+        await message.answer("❌ Сторож event loop не запущен.")
+        return
+
+    sites, incidents = loop_watchdog.report()
+    if not incidents:
+        await message.answer(
+            f"✅ Блокировок event loop дольше {LOOP_BLOCK_THRESHOLD_SECONDS:.2f} с не было. "
+            f"Текущая задержка: {event_loop_lag_last * 1000:.0f} мс.")
+        return
+
+    text = f"🧭 <b>Блокировки event loop</b> (порог {LOOP_BLOCK_THRESHOLD_SECONDS:.2f} с)\n\n"
+    for site, (count, total, longest) in sites[:10]:
+        text += f"• <code>{html.escape(site)}</code>: {count} раз, всего {total:.2f} с, максимум {longest:.2f} с\n"
+
+    last = incidents[-1]
+    text += (f"\n<b>Последняя:</b> {last['time'].strftime('%d.%m %H:%M:%S')}, {last['duration']:.2f} с, "
+             f"задача <code>{html.escape(str(last['coroutine']))}</code>\n")
+    # Стек обрезается с начала: важнее всего нижние кадры, где loop и был занят
+    text += f"<pre>{html.escape(last['stack'][-2500:])}</pre>"
+    await message.answer(text)
+
+
+@router.message(Command("traces"))
+async def traces_cmd(message: Message):
+    """
+    Самые долгие из последних трасс с разбивкой по участкам и выгрузка файлом (для администраторов).
+    /traces - формат Chrome trace (chrome://tracing, ui.perfetto.dev), /traces json - JSON.
+    """
+    if not is_admin(message.from_user.id):
+        await message.answer("⛔ Команда доступна только администраторам.")
+        return
+    traces = list(recent_traces)
+    if not traces:
+        await message.answer("❌ Трасс пока нет.")
+        return
+
+    text = f"🧵 <b>Самые долгие запросы</b> (из последних {len(traces)})\n"
+    for trace in sorted(traces, key=lambda trace: trace.duration(), reverse=True)[:10]:
+        # Время участков суммируется по названию; вложенные участки входят и во внешние
+        totals = {}
+        for span in trace.spans:
+            if span['parent'] is not None:
+                total, count = totals.get(span['name'], (0.0, 0))
+                totals[span['name']] = (total + span['end'] - span['start'], count + 1)
+        top = sorted(totals.items(), key=lambda item: item[1][0], reverse=True)[:3]
+        breakdown = ", ".join(f"{html.escape(name)} {total:.2f} с ×{count}" for name, (total, count) in top)
+        text += (f"\n• <b>{trace.duration():.2f} с</b> - {html.escape(trace.name)} "
+                 f"({trace.started_at.strftime('%H:%M:%S')})\n  {breakdown or 'без вложенных участков'}\n")
+    await message.answer(text)
+
+    if (message.text or "").split()[1:2] == ["json"]:
+        payload = [trace_to_dict(trace) for trace in traces]
+        filename = "traces.json"
+    else:
+        payload = traces_to_chrome(traces)
+        filename = "traces_chrome.json"
+    await message.answer_document(BufferedInputFile(json.dumps(payload, ensure_ascii=False).encode(), filename=filename))
+
+
+@router.message(Command("profile"))
+async def profile_cmd(message: Message):
+    """/profile [секунды] - сэмплирующее профилирование работающего бота (для администраторов)."""
+    if not is_admin(message.from_user.id):
+        await message.answer("⛔ Команда доступна только администраторам.")
+        return
+    args = (message.text or "").split()[1:]
+    try:
+        seconds = int(args[0]) if args else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        seconds = 0
+    if not 1 <= seconds <= PROFILE_MAX_SECONDS:
+        await message.answer(f"❌ Укажи длительность от 1 до {PROFILE_MAX_SECONDS} секунд: /profile 30")
+        return
+    await jobs.submit(message, message.from_user.id, 'profile', (),
+                      lambda job: run_profile(message, seconds, job))
+
+
+async def run_profile(message: Message, seconds, job):
+    """Снимает стеки всех потоков процесса seconds секунд и присылает flamegraph и свернутые стеки."""
+    await job.progress(f"🔬 Профилирую бота {seconds} с (стеки каждые {PROFILE_SAMPLE_INTERVAL_SECONDS * 1000:.0f} мс)...")
+    profiler = SamplingProfiler(PROFILE_SAMPLE_INTERVAL_SECONDS)
+    await asyncio.to_thread(profiler.run, seconds)
+
+    started_at = datetime.now().strftime('%Y%m%d_%H%M%S')
+    title = f"Профиль бота: {seconds} с, {profiler.samples} сэмплов ({started_at})"
+    svg = await asyncio.to_thread(render_flamegraph_svg, profiler.stacks, title)
+
+    # Подпись ограничена 1024 символами: строки добавляются целиком, чтобы не разрезать HTML
+    caption = f"🔥 <b>Flamegraph</b>: {seconds} с, {profiler.samples} сэмплов\n\n<b>Собственное время:</b>"
+    for name, share in profiler.top_own(5):
+        line = f"\n• <code>{html.escape(name[:120])}</code>: {share * 100:.0f}%"
+        if len(caption) + len(line) > 1024:
+            break
+        caption += line
+    await message.answer_document(
+        BufferedInputFile(svg.encode(), filename=f"flamegraph_{started_at}.svg"), caption=caption)
+    await message.answer_document(
+        BufferedInputFile(profiler.collapsed().encode(), filename=f"profile_{started_at}.collapsed.txt"),
+        caption="Свернутые стеки (flamegraph.pl, speedscope)")
+
 
 @router.message(F.text == "🔍 Поиск предметов")
 async def search_items_cmd(message: Message):
@@ -1080,8 +2764,8 @@ async def search_items_cmd(message: Message):
         reply_markup=get_main_keyboard()
     )
 
-# Обработчик поиска предметов
-@router.message(F.text.regexp(r"^[A-Za-z0-9\s\-\|()]+$"))
+# Обработчик поиска предметов (только вне диалогов, иначе он перехватывает ввод SteamID и списков)
+@router.message(StateFilter(None), F.text.regexp(r"^[A-Za-z0-9\s\-\|()]+$"))
 async def search_handler(message: Message):
     """Обработчик поиска предметов в портфеле."""
     if not message.text:
@@ -1095,23 +2779,35 @@ async def search_handler(message: Message):
                  "🔍 поиск предметов", "⚙️ настройки"]:
         return
     
-    items = get_items_from_db()
+    items = get_items_from_db(message.from_user.id)
     if not items:
         await message.answer("❌ Портфель пуст.")
         return
     
-    # Поиск совпадений
-    found_items = []
-    for item_id, name, qty, buy_uah, buy_usd in items:
-        if query in name.lower():
-            found_items.append((item_id, name, qty, buy_uah, buy_usd))
+    # Нечеткий поиск по индексу названий портфеля: опечатки и части слов тоже находятся.
+    # Короткому запросу (меньше триграммы) или запросу без совпавших триграмм ("47" при ключе ak47)
+    # индекс ничего не даст - тогда ищем подстроку в названиях, как раньше
+    matches = []
+    if len(item_search_key(query)) >= 3:
+        matches = get_portfolio_name_index(message.from_user.id, items).search(query)
+    if matches:
+        items_by_name = {}
+        for item in items:
+            items_by_name.setdefault(item[1], []).append(item)
+        found_items = [item for name in matches for item in items_by_name[name]]
+    else:
+        found_items = [item for item in items if query in item[1].lower()]
+        matches = [item[1] for item in found_items]
     
     if not found_items:
         await message.answer(f"🔍 По запросу '<b>{message.text}</b>' ничего не найдено.")
         return
     
     # Формируем ответ
-    text = f"🔍 <b>Найдено по запросу '{message.text}':</b>\n\n"
+    if any(query in name.lower() or normalize_item_name(query) in normalize_item_name(name) for name in matches):
+        text = f"🔍 <b>Найдено по запросу '{message.text}':</b>\n\n"
+    else:
+        text = f"🔍 <b>Точных совпадений с '{message.text}' нет, похожие предметы:</b>\n\n"
     
     for item_id, name, qty, buy_uah, buy_usd in found_items[:10]:  # Максимум 10 результатов
         total_buy = buy_uah * qty
@@ -1131,19 +2827,24 @@ async def refresh_portfolio_callback(callback: CallbackQuery):
     if not callback.data:
         return
     page = int(callback.data.split("_")[-1])
-    global portfolio_prices_cache, multisource_prices_cache
-    portfolio_prices_cache = {}
-    multisource_prices_cache = {}
+    # Сбрасываем цены только предметов этого пользователя
+    invalidate_user_prices(callback.from_user.id)
     
-    await safe_edit_or_send(callback, text="⏳ Обновляю портфель...")
-    await generate_portfolio_report(callback.message, page=page)
+    # Прогресс откладывается: если отчет готов быстро, сообщение правится один раз - сразу итогом
+    updater = MessageUpdater.for_message(callback.message)
+    await updater.update("⏳ Обновляю портфель...")
+    try:
+        await generate_portfolio_report(callback.message, callback.from_user.id, page=page, updater=updater)
+    finally:
+        # Пустой портфель или ошибка: отчет не вызвал finish, и отложенный прогресс не должен затереть сообщение
+        await updater.cancel()
     await callback.answer("✅ Портфель обновлён!")
 
 @router.callback_query(lambda c: c.data == "show_chart")
 async def show_chart_callback(callback: CallbackQuery):
     """Показать график портфеля."""
     try:
-        chart_buffer = await generate_portfolio_chart()
+        chart_buffer = await generate_portfolio_chart(callback.from_user.id)
         if chart_buffer:
             chart_file = BufferedInputFile(chart_buffer.getvalue(), filename="portfolio_chart.png")
             await safe_edit_or_send(callback, photo=chart_file)
@@ -1156,146 +2857,326 @@ async def show_chart_callback(callback: CallbackQuery):
 
 # ===== НОВЫЕ ФУНКЦИИ =====
 
+# --- ЭКСПОРТ ПОРТФЕЛЯ ---
+EXPORT_FORMATS = {
+    'xlsx': ('📊 Excel', '.xlsx'),
+    'xlsx_history': ('📊 Excel + история цен', '.xlsx'),
+    'csv': ('📄 CSV', '.csv'),
+    'parquet': ('🗃 Parquet', '.parquet'),
+}
+EXPORT_COLUMNS = [
+    'Предмет', 'Количество', 'Цена покупки (₴)', 'Цена покупки ($)',
+    'Текущая цена (₴)', 'Текущая цена ($)', 'Steam цена ($)',
+    'Инвестировано (₴)', 'Текущая стоимость (₴)', 'Прибыль/Убыток (₴)',
+    'Прибыль/Убыток (%)', 'Категория', 'Дата экспорта'
+]
+HISTORY_COLUMNS = ['Предмет', 'Дата', 'Медиана ($)', 'Минимум ($)', 'Максимум ($)', 'Замеров']
+
+
+def get_cached_steam_price(item_name):
+    """Steam цена из уже собранных кэшей отчета (без сетевого запроса)."""
+    price_data = multisource_prices_cache.get(item_name)
+    if price_data and price_data.get('steam'):
+        return price_data['steam']
+    cached = item_prices_cache.get(item_name)
+    return cached.get('steam_usd') if cached else None
+
+
+@traced("export build_rows")
+async def build_export_rows(items):
+    """
+    Готовит строки экспорта одним проходом по массовым кэшам цен.
+    Прайс-листы MarketCSGO и Skinport скачиваются не более одного раза на весь экспорт.
+    """
+    await asyncio.gather(fetch_marketcsgo_prices(), fetch_skinport_prices())
+
+    export_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    rows = []
+    total_buy_uah = 0
+    total_now_uah = 0
+
+    for _, name, qty, buy_uah, buy_usd in items:
+        current_price_usd = marketcsgo_prices_cache.get(name.lower()) or skinport_prices_cache.get(name.lower())
+        steam_price_usd = get_cached_steam_price(name)
+        current_price_uah = current_price_usd * USD_TO_UAH if current_price_usd else buy_uah
+
+        pos_buy_uah = buy_uah * qty
+        pos_now_uah = current_price_uah * qty
+        profit_uah = pos_now_uah - pos_buy_uah
+        profit_pct = (profit_uah / pos_buy_uah) * 100 if pos_buy_uah > 0 else 0
+
+        total_buy_uah += pos_buy_uah
+        total_now_uah += pos_now_uah
+
+        rows.append((
+            name, qty, buy_uah, buy_usd,
+            round(current_price_uah, 2),
+            round(current_price_usd, 2) if current_price_usd else 0,
+            round(steam_price_usd, 2) if steam_price_usd else 0,
+            pos_buy_uah, round(pos_now_uah, 2), round(profit_uah, 2),
+            round(profit_pct, 2), get_item_category(name), export_date
+        ))
+
+    return rows, total_buy_uah, total_now_uah
+
+
+def get_daily_price_history(item_names):
+    """Дневные агрегаты цен из price_history_multisource для листа истории."""
+    names = sorted(set(item_names))
+    history = []
+    with get_db_cursor() as (cur, _):
+        # Ограничение SQLite на число параметров - обрабатываем названия пачками
+        for start in range(0, len(names), 500):
+            chunk = names[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            cur.execute(f"""
+                SELECT item_name, substr(timestamp, 1, 10) AS day,
+                       AVG(median_price_usd), MIN(price_usd), MAX(price_usd), COUNT(*)
+                FROM price_history_multisource
+                WHERE item_name IN ({placeholders})
+                GROUP BY item_name, day
+                ORDER BY item_name, day
+            """, chunk)
+            history.extend(cur.fetchall())
+    return history
+
+
+@traced("render export_file")
+def write_export_file(path, export_format, rows, totals, progress):
+    """
+    Пишет файл экспорта построчно (вызывается в рабочем потоке).
+    XLSX пишется в режиме constant_memory: строки сбрасываются на диск сразу.
+    """
+    total_buy_uah, total_now_uah = totals
+    stats_rows = [
+        ('Общая сумма инвестиций', total_buy_uah, round(total_buy_uah / USD_TO_UAH, 2)),
+        ('Текущая стоимость', round(total_now_uah, 2), round(total_now_uah / USD_TO_UAH, 2)),
+        ('Общая прибыль/убыток', round(total_now_uah - total_buy_uah, 2),
+         round((total_now_uah - total_buy_uah) / USD_TO_UAH, 2)),
+    ]
+
+    if export_format == 'csv':
+        # utf-8-sig, чтобы Excel корректно открыл кириллицу
+        with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.writer(f)
+            writer.writerow(EXPORT_COLUMNS)
+            for index, row in enumerate(rows, 1):
+                writer.writerow(row)
+                progress(index, len(rows))
+        return
+
+    if export_format == 'parquet':
+        pa = lazy_import('pyarrow')
+        pq = lazy_import('pyarrow.parquet')
+        table = pa.Table.from_pylist([dict(zip(EXPORT_COLUMNS, row)) for row in rows])
+        pq.write_table(table, path)
+        progress(len(rows), len(rows))
+        return
+
+    xlsxwriter = lazy_import('xlsxwriter')
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    try:
+        sheet = workbook.add_worksheet('Портфель')
+        sheet.write_row(0, 0, EXPORT_COLUMNS)
+        for index, row in enumerate(rows, 1):
+            sheet.write_row(index, 0, row)
+            progress(index, len(rows))
+
+        stats_sheet = workbook.add_worksheet('Статистика')
+        stats_sheet.write_row(0, 0, ['Показатель', 'Значение (₴)', 'Значение ($)'])
+        for index, row in enumerate(stats_rows, 1):
+            stats_sheet.write_row(index, 0, row)
+
+        if export_format == 'xlsx_history':
+            history_sheet = workbook.add_worksheet('История цен')
+            history_sheet.write_row(0, 0, HISTORY_COLUMNS)
+            for index, row in enumerate(get_daily_price_history([row[0] for row in rows]), 1):
+                history_sheet.write_row(index, 0, row)
+    finally:
+        workbook.close()
+
+
+def make_thread_progress(loop, job, label):
+    """
+    Колбэк прогресса для рабочего потока: не чаще раза в EXPORT_PROGRESS_INTERVAL_SECONDS
+    передает обновление статуса задачи в event loop бота.
+    """
+    last_update = [0.0]
+
+    def progress(done, total):
+        now = time.monotonic()
+        if done < total and now - last_update[0] < EXPORT_PROGRESS_INTERVAL_SECONDS:
+            return
+        last_update[0] = now
+        percent = done * 100 // total if total else 100
+        asyncio.run_coroutine_threadsafe(
+            job.progress(f"⏳ {label}: {done}/{total} ({percent}%)"), loop)
+
+    return progress
+
+
 @router.message(F.text == "📤 Экспорт Excel")
 async def export_excel_cmd(message: Message):
-    """Экспорт портфеля в Excel файл."""
-    await message.answer("⏳ Создаю Excel файл с твоим портфелем...")
-    
-    items = get_items_from_db()
+    """Экспорт портфеля: выбор формата файла."""
+    buttons = [[InlineKeyboardButton(text=title, callback_data=f"export_{fmt}")]
+               for fmt, (title, _) in EXPORT_FORMATS.items()]
+    await message.answer("📤 <b>Экспорт портфеля</b>\n\nВыбери формат файла:",
+                         reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
+
+
+@router.callback_query(lambda c: (c.data or "").startswith("export_"))
+async def export_format_callback(callback: CallbackQuery):
+    """Экспорт портфеля в выбранном формате."""
+    export_format = callback.data[len("export_"):]
+    if export_format not in EXPORT_FORMATS:
+        await callback.answer("❌ Неизвестный формат")
+        return
+    await callback.answer()
+    await jobs.submit(callback.message, callback.from_user.id, 'export', (export_format,),
+                      lambda job: export_portfolio(callback.message, export_format, job))
+
+
+async def export_portfolio(message: Message, export_format, job):
+    """Экспорт портфеля в файл: цены одним пакетом, запись файла в рабочем потоке."""
+    title, suffix = EXPORT_FORMATS[export_format]
+    await job.progress(f"⏳ Создаю файл ({title}) с твоим портфелем...")
+
+    # Сообщение с кнопками форматов отправлено ботом, поэтому владелец портфеля берется из задачи
+    items = get_items_from_db(job.user_id)
     if not items:
         await message.answer("❌ Портфель пуст. Нечего экспортировать.")
         return
-    
+
+    path = None
     try:
-        import pandas as pd
-        from datetime import datetime
-        import io
-        
-        # Создаем данные для экспорта
-        data = []
-        total_buy_uah = 0
-        total_now_uah = 0
-        
-        for user_id, name, qty, buy_uah, buy_usd in items:
-            # Получаем текущие цены
-            result = await get_current_prices_and_steam(name)
-            current_price_usd, steam_price_usd = result
-            current_price_uah = current_price_usd * USD_TO_UAH if current_price_usd else buy_uah
-            
-            pos_buy_uah = buy_uah * qty
-            pos_now_uah = current_price_uah * qty
-            profit_uah = pos_now_uah - pos_buy_uah
-            profit_pct = (profit_uah / pos_buy_uah) * 100 if pos_buy_uah > 0 else 0
-            
-            total_buy_uah += pos_buy_uah
-            total_now_uah += pos_now_uah
-            
-            data.append({
-                'Предмет': name,
-                'Количество': qty,
-                'Цена покупки (₴)': buy_uah,
-                'Цена покупки ($)': buy_usd,
-                'Текущая цена (₴)': round(current_price_uah, 2),
-                'Текущая цена ($)': round(current_price_usd, 2) if current_price_usd else 0,
-                'Steam цена ($)': round(steam_price_usd, 2) if steam_price_usd else 0,
-                'Инвестировано (₴)': pos_buy_uah,
-                'Текущая стоимость (₴)': round(pos_now_uah, 2),
-                'Прибыль/Убыток (₴)': round(profit_uah, 2),
-                'Прибыль/Убыток (%)': round(profit_pct, 2),
-                'Категория': get_item_category(name),
-                'Дата экспорта': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            })
-        
-        # Создаем DataFrame
-        df = pd.DataFrame(data)
-        
-        # Создаем Excel файл в памяти
-        excel_buffer = io.BytesIO()
-        with pd.ExcelWriter(excel_buffer, engine='xlsxwriter') as writer:
-            # Основной лист с портфелем
-            df.to_excel(writer, sheet_name='Портфель', index=False)
-            
-            # Лист со статистикой
-            stats_data = [{
-                'Показатель': 'Общая сумма инвестиций',
-                'Значение (₴)': total_buy_uah,
-                'Значение ($)': round(total_buy_uah / USD_TO_UAH, 2)
-            }, {
-                'Показатель': 'Текущая стоимость',
-                'Значение (₴)': round(total_now_uah, 2),
-                'Значение ($)': round(total_now_uah / USD_TO_UAH, 2)
-            }, {
-                'Показатель': 'Общая прибыль/убыток',
-                'Значение (₴)': round(total_now_uah - total_buy_uah, 2),
-                'Значение ($)': round((total_now_uah - total_buy_uah) / USD_TO_UAH, 2)
-            }]
-            
-            stats_df = pd.DataFrame(stats_data)
-            stats_df.to_excel(writer, sheet_name='Статистика', index=False)
-        
-        excel_buffer.seek(0)
-        
-        # Отправляем файл пользователю
+        rows, total_buy_uah, total_now_uah = await build_export_rows(items)
+
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmp:
+            path = tmp.name
+        progress = make_thread_progress(asyncio.get_running_loop(), job, "Записываю строки")
+        await asyncio.to_thread(write_export_file, path, export_format, rows,
+                                (total_buy_uah, total_now_uah), progress)
+
+        # Отправляем файл с диска, не загружая его целиком в память
         await message.answer_document(
-            document=BufferedInputFile(
-                excel_buffer.getvalue(),
-                filename=f"portfolio_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+            document=FSInputFile(
+                path,
+                filename=f"portfolio_{datetime.now().strftime('%Y%m%d_%H%M%S')}{suffix}"
             ),
             caption=f"📊 <b>Экспорт портфеля завершен!</b>\n\n"
                    f"📈 Общая стоимость: {total_now_uah:,.0f}₴\n"
                    f"💰 Инвестировано: {total_buy_uah:,.0f}₴\n"
                    f"💹 Прибыль: {total_now_uah - total_buy_uah:+,.0f}₴"
         )
-        
+
+    except ImportError as e:
+        await message.answer(f"❌ Формат {title} недоступен на сервере: {e.name}")
     except Exception as e:
-        await message.answer(f"❌ Ошибка при создании Excel: {str(e)}")
+        logging.error(f"Ошибка экспорта портфеля: {e}")
+        await message.answer(f"❌ Ошибка при создании файла: {str(e)}")
+    finally:
+        if path and os.path.exists(path):
+            os.remove(path)
 
-@router.message(F.text == "🤖 AI Советы")
-async def ai_advice_cmd(message: Message):
-    """AI анализ портфеля с рекомендациями.""" 
-    await message.answer("🧠 Анализирую твой портфель с помощью AI...")
-    
-    items = get_items_from_db()
-    if not items:
-        await message.answer("❌ Портфель пуст. AI нечего анализировать.")
-        return
-    
-    try:
-        import os
-        from openai import OpenAI
-        
-        # Проверяем API ключ
-        if not os.environ.get("OPENAI_API_KEY"):
-            await message.answer("❌ OpenAI API ключ не настроен. Обратись к администратору.")
-            return
-        
-        # Using GPT-4 as the most reliable model for production use
-        client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-        
-        # Собираем данные портфеля для анализа
-        portfolio_data = []
-        total_value = 0
-        
-        for user_id, name, qty, buy_uah, buy_usd in items[:10]:  # Ограничиваем для экономии токенов
-            result = await get_current_prices_and_steam(name)
-            current_price_usd, steam_price_usd = result
-            
-            if current_price_usd:
-                current_value = current_price_usd * USD_TO_UAH * qty
-                profit_pct = ((current_price_usd * USD_TO_UAH - buy_uah) / buy_uah) * 100
-                total_value += current_value
-                
-                portfolio_data.append({
-                    'name': name,
-                    'quantity': qty,
-                    'buy_price_uah': buy_uah,
-                    'current_price_usd': current_price_usd,
-                    'profit_percent': round(profit_pct, 2),
-                    'category': get_item_category(name),
-                    'value_uah': round(current_value, 2)
-                })
-        
-        # Создаем промпт для AI
+# --- AI СОВЕТНИК ---
+AI_SYSTEM_PROMPT = "Ты профессиональный аналитик рынка CS:GO скинов с 10+ летним опытом торговли. Даешь конкретные, практичные советы."
+
+
+def round_price_for_digest(price_usd):
+    """Округляет цену до двух значащих цифр: мелкие колебания не меняют дайджест портфеля."""
+    return float(f"{price_usd:.2g}")
+
+
+def build_ai_portfolio_digest(items):
+    """
+    Собирает данные портфеля для промпта по кэшу MarketCSGO.
+    Возвращает (позиции, общая стоимость, дайджест) - дайджест зависит от позиций,
+    округленных цен и даты, поэтому при несущественных изменениях совет берется из кэша.
+    """
+    portfolio_data = []
+    total_value = 0
+
+    for _, name, qty, buy_uah, buy_usd in items[:AI_ADVICE_MAX_ITEMS]:
+        current_price_usd = marketcsgo_prices_cache.get(name.lower())
+        if not current_price_usd:
+            continue
+        current_value = current_price_usd * USD_TO_UAH * qty
+        profit_pct = ((current_price_usd * USD_TO_UAH - buy_uah) / buy_uah) * 100 if buy_uah > 0 else 0
+        total_value += current_value
+
+        portfolio_data.append({
+            'name': name,
+            'quantity': qty,
+            'buy_price_uah': buy_uah,
+            'current_price_usd': current_price_usd,
+            'profit_percent': round(profit_pct, 0),
+            'category': get_item_category(name),
+            'value_uah': round(current_value, 0)
+        })
+
+    # В промпт идут точные цены, а в дайджест - округленные: мелкие колебания не меняют ключ кэша.
+    # Прибыль и стоимость позиции выводятся из цены, поэтому в дайджест не входят
+    digest_positions = [{
+        'name': position['name'],
+        'quantity': position['quantity'],
+        'buy_price_uah': position['buy_price_uah'],
+        'current_price_usd': round_price_for_digest(position['current_price_usd']),
+        'category': position['category'],
+    } for position in portfolio_data]
+    digest_source = json.dumps({
+        'date': datetime.now().strftime('%Y-%m-%d'),
+        'model': OPENAI_MODEL,
+        'positions': sorted(digest_positions, key=lambda p: p['name'])
+    }, ensure_ascii=False, sort_keys=True)
+    digest = hashlib.sha256(digest_source.encode('utf-8')).hexdigest()
+    return portfolio_data, total_value, digest
+
+
+class AIAdvisor:
+    """Асинхронный AI советник: один клиент OpenAI на процесс, таймаут и кэш советов по дайджесту портфеля."""
+
+    def __init__(self, model, base_url, timeout, cache_size):
+        self.model = model
+        self.base_url = base_url
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.client = None
+        self.cache = {}
+        # Одинаковые портфели, запрошенные одновременно, ждут один и тот же ответ
+        self.inflight = {}
+
+    def get_client(self):
+        """Создает AsyncOpenAI при первом обращении и дальше переиспользует его соединения."""
+        if self.client is None:
+            AsyncOpenAI = lazy_import('openai').AsyncOpenAI
+            self.client = AsyncOpenAI(
+                api_key=os.environ.get("OPENAI_API_KEY"),
+                base_url=self.base_url,
+                timeout=self.timeout,
+                max_retries=1
+            )
+        return self.client
+
+    async def advise(self, portfolio_data, total_value, digest):
+        """Возвращает (совет, из_кэша)."""
+        if digest in self.cache:
+            return self.cache[digest], True
+        if digest not in self.inflight:
+            self.inflight[digest] = asyncio.create_task(self._request(portfolio_data, total_value))
+        task = self.inflight[digest]
+        try:
+            # shield: отмена одной задачи пользователя не обрывает запрос для остальных
+            advice = await asyncio.shield(task)
+        finally:
+            if task.done():
+                self.inflight.pop(digest, None)
+
+        if len(self.cache) >= self.cache_size:
+            self.cache.pop(next(iter(self.cache)))
+        self.cache[digest] = advice
+        return advice, False
+
+    async def _request(self, portfolio_data, total_value):
         prompt = f"""Проанализируй CS:GO/CS2 портфель игрока и дай профессиональные рекомендации.
 
 ДАННЫЕ ПОРТФЕЛЯ:
@@ -1312,21 +3193,52 @@ async def ai_advice_cmd(message: Message):
 
 Отвечай на русском языке, будь конкретным и профессиональным."""
 
-        response = client.chat.completions.create(
-            model="gpt-4",
+        response = await self.get_client().chat.completions.create(
+            model=self.model,
             messages=[
-                {"role": "system", "content": "Ты профессиональный аналитик рынка CS:GO скинов с 10+ летним опытом торговли. Даешь конкретные, практичные советы."},
+                {"role": "system", "content": AI_SYSTEM_PROMPT},
                 {"role": "user", "content": prompt}
             ],
             max_tokens=1000,
             temperature=0.7
         )
+        return response.choices[0].message.content
+
+
+ai_advisor = AIAdvisor(OPENAI_MODEL, OPENAI_BASE_URL, OPENAI_TIMEOUT_SECONDS, AI_ADVICE_CACHE_SIZE)
+
+
+@router.message(F.text == "🤖 AI Советы")
+async def ai_advice_cmd(message: Message):
+    """AI анализ портфеля с рекомендациями (фоновая задача)."""
+    await jobs.submit(message, message.from_user.id, 'ai', (), lambda job: run_ai_advice(message, job))
+
+
+async def run_ai_advice(message: Message, job):
+    """AI анализ портфеля с рекомендациями.""" 
+    await job.progress("🧠 Анализирую твой портфель с помощью AI...")
+    
+    items = get_items_from_db(message.from_user.id)
+    if not items:
+        await message.answer("❌ Портфель пуст. AI нечего анализировать.")
+        return
+    
+    try:
+        # Проверяем API ключ
+        if not os.environ.get("OPENAI_API_KEY"):
+            await message.answer("❌ OpenAI API ключ не настроен. Обратись к администратору.")
+            return
         
-        ai_advice = response.choices[0].message.content
+        # Цены всех позиций берем из общего прайс-листа одним запросом
+        await fetch_marketcsgo_prices()
+        portfolio_data, total_value, digest = build_ai_portfolio_digest(items)
+        ai_advice, from_cache = await ai_advisor.advise(portfolio_data, total_value, digest)
         
         # Форматируем и отправляем ответ
         final_message = f"🤖 <b>AI Анализ твоего портфеля</b>\n\n{ai_advice}\n\n"
-        final_message += f"💡 <i>Анализ выполнен GPT-4 на основе {len(portfolio_data)} предметов</i>"
+        final_message += f"💡 <i>Анализ выполнен {OPENAI_MODEL} на основе {len(portfolio_data)} предметов</i>"
+        if from_cache:
+            final_message += "\n♻️ <i>Портфель не изменился существенно - показан сегодняшний анализ</i>"
         
         await message.answer(final_message, parse_mode="HTML")
         
@@ -1335,28 +3247,40 @@ async def ai_advice_cmd(message: Message):
 
 @router.message(F.text == "⚡ Краш детектор")
 async def crash_detector_cmd(message: Message):
+    """Детектор рыночных крашей и возможностей (фоновая задача)."""
+    await jobs.submit(message, message.from_user.id, 'analysis', ('crash_detector',),
+                      lambda job: run_crash_detector(message, job))
+
+
+def get_crash_candidates(current_time):
+    """
+    Средние медианные цены за последние сутки и за сутки до этого по каждому предмету.
+    Медианы с низкой достоверностью (источники расходятся) не учитываются, чтобы выброс не выглядел крашем.
+    """
+    yesterday = current_time - timedelta(days=1)
+    with get_db_cursor() as (cur, _):
+        # Находим предметы с большими изменениями цен
+        cur.execute('''
+            SELECT DISTINCT item_name, 
+                   AVG(CASE WHEN timestamp > ? THEN median_price_usd END) as current_avg,
+                   AVG(CASE WHEN timestamp <= ? THEN median_price_usd END) as prev_avg
+            FROM price_history_multisource 
+            WHERE timestamp > ? AND median_price_usd > 0 AND COALESCE(median_confidence, 1) >= ?
+            GROUP BY item_name 
+            HAVING current_avg IS NOT NULL AND prev_avg IS NOT NULL
+            ORDER BY (current_avg - prev_avg) / prev_avg
+        ''', (yesterday.isoformat(), yesterday.isoformat(), (current_time - timedelta(days=2)).isoformat(),
+              PRICE_MIN_CONFIDENCE))
+        return cur.fetchall()
+
+
+async def run_crash_detector(message: Message, job):
     """Детектор рыночных крашей и возможностей."""
-    await message.answer("⚡ Анализирую рынок на предмет крашей и возможностей...")
+    await job.progress("⚡ Анализирую рынок на предмет крашей и возможностей...")
     
     try:
-        # Получаем данные о ценах за последние 24 часа
-        current_time = datetime.now()
-        yesterday = current_time - timedelta(days=1)
-        
-        with get_db_cursor() as (cur, _):
-            # Находим предметы с большими изменениями цен
-            cur.execute('''
-                SELECT DISTINCT item_name, 
-                       AVG(CASE WHEN timestamp > ? THEN median_price_usd END) as current_avg,
-                       AVG(CASE WHEN timestamp <= ? THEN median_price_usd END) as prev_avg
-                FROM price_history_multisource 
-                WHERE timestamp > ? AND median_price_usd > 0
-                GROUP BY item_name 
-                HAVING current_avg IS NOT NULL AND prev_avg IS NOT NULL
-                ORDER BY (current_avg - prev_avg) / prev_avg
-            ''', (yesterday.isoformat(), yesterday.isoformat(), (current_time - timedelta(days=2)).isoformat()))
-            
-            results = cur.fetchall()
+        # Получаем данные о ценах за последние 24 часа (запрос к БД - в рабочем потоке)
+        results = await asyncio.to_thread(get_crash_candidates, datetime.now())
         
         if not results:
             await message.answer("📊 Недостаточно данных для анализа крашей.")
@@ -1422,6 +3346,18 @@ async def mini_app_cmd(message: Message):
 
 # ===== ОБРАБОТЧИКИ CALLBACK ДЛЯ МАССОВЫХ ОПЕРАЦИЙ =====
 
+@router.message(F.text == "🛒 Массовые операции")
+async def bulk_operations_cmd(message: Message):
+    """Меню массовых операций с портфелем."""
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="➕ Массовое добавление", callback_data="bulk_add")],
+        [InlineKeyboardButton(text="🗑 Массовое удаление", callback_data="bulk_remove")],
+        [InlineKeyboardButton(text="🔄 Обновить все цены", callback_data="bulk_update_prices")],
+        [InlineKeyboardButton(text="🧹 Очистить портфель", callback_data="bulk_clear")]
+    ])
+    await message.answer("🛒 <b>Массовые операции</b>\n\nВыбери действие:", reply_markup=kb)
+
+
 @router.callback_query(lambda c: c.data == "bulk_add")
 async def bulk_add_callback(callback: CallbackQuery, state: FSMContext):
     """Массовое добавление предметов."""
@@ -1431,65 +3367,247 @@ async def bulk_add_callback(callback: CallbackQuery, state: FSMContext):
         "📝 Отправь список предметов в формате:\n"
         "<code>Название предмета | Количество | Цена в ₴</code>\n\n"
         "📋 <b>Пример:</b>\n"
-        "<code>AK-47 Redline (Field-Tested) | 1 | 2500\n"
-        "AWP Dragon Lore (Factory New) | 1 | 45000</code>\n\n"
-        "⚠️ <i>По одному предмету на строку</i>\n"
+        "<code>AK-47 | Redline (Field-Tested) | 1 | 2500\n"
+        "AWP | Dragon Lore (Factory New) | 1 | 45000</code>\n\n"
+        "⚠️ <i>По одному предмету на строку. Длинный список можно прислать .txt файлом</i>\n"
         "🚫 Отправь /cancel для отмены",
         parse_mode="HTML"
     )
 
-@router.message(StateFilter(BulkStates.waiting_for_bulk_add))
-async def process_bulk_add(message: Message, state: FSMContext):
-    """Обработка массового добавления предметов."""
+
+def normalize_item_name(name):
+    """Ключ для нестрогого сравнения названий: без '|', регистра и лишних пробелов."""
+    return " ".join(name.replace("|", " ").split()).lower()
+
+
+def add_market_item_names(names):
+    """Пополняет каталог рынка названиями из прайс-листа; версия каталога меняется, только если есть новые."""
+    global market_names_version
+    size = len(market_item_names)
+    market_item_names.update(names)
+    if len(market_item_names) != size:
+        market_names_version += 1
+
+
+def find_catalog_name(name):
+    """
+    Ищет предмет в каталоге рынка и возвращает его точное market_hash_name.
+    None - предмета нет в каталоге.
+    """
+    global market_names_normalized, market_names_normalized_version
+    exact = market_item_names.get(name.lower())
+    if exact:
+        return exact
+    # Нормализованный индекс перестраивается только когда каталог пополнился. Сравнивать размеры нельзя:
+    # разные названия с одинаковым нормализованным ключом навсегда оставили бы их неравными
+    if market_names_normalized_version != market_names_version:
+        market_names_normalized = {normalize_item_name(original): original
+                                   for original in market_item_names.values()}
+        market_names_normalized_version = market_names_version
+    return market_names_normalized.get(normalize_item_name(name))
+
+
+def item_search_key(name):
+    """Ключ для нечеткого поиска: нижний регистр, без дефисов (AK-47 = ak47) и знаков препинания."""
+    return " ".join(re.sub(r"\W+", " ", name.lower().replace("-", "")).split())
+
+
+def item_name_trigrams(text):
+    """Множество триграмм строки."""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class ItemNameIndex:
+    """
+    Триграммный инвертированный индекс названий предметов для нечеткого поиска и автодополнения.
+    Для каждой триграммы нормализованного названия хранится массив номеров названий (numpy),
+    поэтому запрос оценивается одним bincount по спискам своих триграмм без перебора каталога.
+    """
+
+    def __init__(self, names):
+        np = lazy_import('numpy')
+        self.names = sorted(set(names))
+        postings = {}
+        trigram_counts = []
+        for number, name in enumerate(self.names):
+            trigrams = item_name_trigrams(f" {item_search_key(name)} ")
+            trigram_counts.append(len(trigrams))
+            for trigram in trigrams:
+                postings.setdefault(trigram, []).append(number)
+        self.postings = {trigram: np.array(numbers, dtype=np.int32) for trigram, numbers in postings.items()}
+        self.trigram_counts = np.array(trigram_counts, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.names)
+
+    def search(self, query, limit=None, min_coverage=ITEM_SEARCH_MIN_COVERAGE):
+        """
+        Названия, похожие на query, от лучшего к худшему.
+        Оценка - доля триграмм запроса, найденных в названии (запрос дополняется пробелом только слева,
+        чтобы начало слова работало как автодополнение), плюс сходство Дайса: из равных совпадений
+        выше короткие названия. Опечатки в нескольких буквах оставляют большую часть триграмм.
+        """
+        np = lazy_import('numpy')
+        trigrams = item_name_trigrams(f" {item_search_key(query)}")
+        postings = [self.postings[trigram] for trigram in trigrams if trigram in self.postings]
+        if not postings:
+            return []
+        counts = np.bincount(np.concatenate(postings), minlength=len(self.names))
+        coverage = counts / len(trigrams)
+        candidates = np.flatnonzero(coverage >= min_coverage)
+        dice = 2 * counts[candidates] / (len(trigrams) + self.trigram_counts[candidates])
+        scores = coverage[candidates] + 0.5 * dice
+        # Стабильная сортировка: при равной оценке - по алфавиту
+        ranked = candidates[np.argsort(-scores, kind='stable')]
+        return [self.names[number] for number in ranked[:limit]]
+
+
+async def build_item_name_index():
+    """Перестраивает индекс каталога рынка в рабочем потоке."""
+    global item_name_index, item_name_index_task
     try:
-        lines = message.text.strip().split('\n')
-        added_items = []
-        errors = []
-        
-        for line_num, line in enumerate(lines, 1):
-            line = line.strip()
-            if not line:
-                continue
-                
-            try:
-                parts = [p.strip() for p in line.split('|')]
-                if len(parts) != 3:
-                    errors.append(f"Строка {line_num}: Неверный формат")
-                    continue
-                
-                item_name, quantity_str, price_str = parts
-                quantity = int(quantity_str)
-                price_uah = float(price_str)
-                price_usd = price_uah / USD_TO_UAH
-                
-                if quantity <= 0 or price_uah <= 0:
-                    errors.append(f"Строка {line_num}: Неверные числовые значения")
-                    continue
-                
-                # Добавляем в базу
-                with get_db_cursor() as (cur, conn):
-                    cur.execute(
-                        "INSERT INTO portfolio (user_id, item_name, quantity, buy_price_uah, buy_price_usd) VALUES (?, ?, ?, ?, ?)",
-                        (message.from_user.id, item_name, quantity, price_uah, price_usd)
-                    )
-                
-                added_items.append(f"• {item_name} x{quantity} ({price_uah:,.0f}₴)")
-                
-            except ValueError:
-                errors.append(f"Строка {line_num}: Ошибка в числах")
-            except Exception as e:
-                errors.append(f"Строка {line_num}: {str(e)}")
-        
-        # Очищаем кэш
-        global portfolio_prices_cache, multisource_prices_cache
-        portfolio_prices_cache = {}
-        multisource_prices_cache = {}
-        
-        # Формируем ответ
-        result = "🛒 <b>Результат массового добавления</b>\n\n"
-        
-        if added_items:
-            result += f"✅ <b>Добавлено {len(added_items)} предметов:</b>\n"
+        item_name_index = await asyncio.to_thread(ItemNameIndex, list(market_item_names.values()))
+        logging.info(f"Индекс названий каталога перестроен: {len(item_name_index)} предметов.")
+    finally:
+        item_name_index_task = None
+
+
+async def get_item_name_index():
+    """
+    Индекс названий каталога рынка.
+    Когда каталог пополнился, индекс перестраивается в фоне, а до готовности используется предыдущий;
+    ждать приходится только самой первой сборки.
+    """
+    global item_name_index_task
+    if item_name_index is None or len(item_name_index) != len(market_item_names):
+        if item_name_index_task is None:
+            item_name_index_task = asyncio.create_task(build_item_name_index())
+        if item_name_index is None:
+            await asyncio.shield(item_name_index_task)
+    return item_name_index
+
+
+def get_portfolio_name_index(user_id, items):
+    """Индекс названий предметов портфеля пользователя; перестраивается только после изменения портфеля."""
+    version = holdings_versions.get(user_id, 0)
+    cached = portfolio_name_indexes.get(user_id)
+    if cached and cached[0] == version:
+        return cached[1]
+    index = ItemNameIndex([name for _, name, _, _, _ in items])
+    portfolio_name_indexes.set(user_id, (version, index))
+    return index
+
+
+async def suggest_catalog_names(message: Message, state: FSMContext, item_name, callback_prefix):
+    """
+    Проверяет название по каталогу рынка.
+    Возвращает точное market_hash_name или None, если вместо него показаны похожие предметы
+    (кнопки callback_prefix<номер>, варианты сохраняются в данных FSM). Без каталога название принимается как есть.
+    """
+    await fetch_marketcsgo_prices()
+    if not market_item_names:
+        return item_name
+    catalog_name = find_catalog_name(item_name)
+    if catalog_name:
+        return catalog_name
+
+    suggestions = (await get_item_name_index()).search(item_name, limit=ITEM_SUGGESTIONS_LIMIT)
+    if not suggestions:
+        await message.answer(f"❌ Предмет '<b>{html.escape(item_name)}</b>' не найден на рынке.\n\n"
+                             "Проверь название и попробуй еще раз или отправь /cancel:")
+        return None
+    await state.update_data(suggestions=suggestions)
+    kb = [[InlineKeyboardButton(text=name[:64], callback_data=f"{callback_prefix}{number}")]
+          for number, name in enumerate(suggestions)]
+    await message.answer(f"❓ Предмет '<b>{html.escape(item_name)}</b>' не найден на рынке.\n\n"
+                         "Возможно, имелось в виду (или отправь название еще раз):",
+                         reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
+    return None
+
+
+async def pop_suggestion(callback: CallbackQuery, state: FSMContext):
+    """Название, выбранное кнопкой из подсказок suggest_catalog_names; None - подсказки устарели."""
+    data = await state.get_data()
+    suggestions = data.get('suggestions', [])
+    number = int(callback.data.rsplit("_", 1)[1])
+    await callback.answer()
+    if number >= len(suggestions):
+        return None
+    await state.update_data(suggestions=[])
+    return suggestions[number]
+
+
+def parse_bulk_add_lines(text):
+    """
+    Разбирает и проверяет все строки массового добавления до записи в БД.
+    Возвращает (строки для INSERT, отчет о добавленных, ошибки).
+    """
+    rows = []
+    added_items = []
+    errors = []
+    added_at = datetime.now().isoformat()
+    # Если каталог еще не загружен (рынок недоступен), названия не проверяем
+    check_catalog = bool(market_item_names)
+
+    for line_num, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+
+        # Название само содержит '|' (AK-47 | Redline), поэтому отделяем два последних поля справа
+        parts = [p.strip() for p in line.rsplit('|', 2)]
+        if len(parts) != 3 or not parts[0]:
+            errors.append(f"Строка {line_num}: Неверный формат")
+            continue
+
+        item_name, quantity_str, price_str = parts
+        try:
+            quantity = int(quantity_str)
+            price_uah = float(price_str.replace(',', '.'))
+        except ValueError:
+            errors.append(f"Строка {line_num}: Ошибка в числах")
+            continue
+
+        if quantity <= 0 or price_uah <= 0:
+            errors.append(f"Строка {line_num}: Неверные числовые значения")
+            continue
+
+        if check_catalog:
+            catalog_name = find_catalog_name(item_name)
+            if not catalog_name:
+                errors.append(f"Строка {line_num}: '{item_name}' не найден на рынке")
+                continue
+            item_name = catalog_name
+
+        rows.append((item_name, quantity, price_uah, round(price_uah / USD_TO_UAH, 2), added_at))
+        added_items.append(f"• {item_name} x{quantity} ({price_uah:,.0f}₴)")
+
+    return rows, added_items, errors
+
+
+@router.message(StateFilter(BulkStates.waiting_for_bulk_add))
+async def process_bulk_add(message: Message, state: FSMContext):
+    """Обработка массового добавления предметов."""
+    try:
+        if message.document:
+            file_buffer = await bot.download(message.document)
+            text = file_buffer.read().decode('utf-8-sig', errors='replace')
+        else:
+            text = message.text or ""
+
+        # Каталог рынка для проверки названий - из общих кэшей прайс-листов
+        await asyncio.gather(fetch_marketcsgo_prices(), fetch_skinport_prices())
+        rows, added_items, errors = parse_bulk_add_lines(text)
+
+        if rows:
+            # Оценка портфеля сбрасывается один раз на весь список
+            add_items_bulk(message.from_user.id, rows)
+        
+        # Формируем ответ
+        result = "🛒 <b>Результат массового добавления</b>\n\n"
+        
+        if added_items:
+            result += f"✅ <b>Добавлено {len(added_items)} предметов:</b>\n"
             result += '\n'.join(added_items[:10])  # Показываем первые 10
             if len(added_items) > 10:
                 result += f"\n... и еще {len(added_items) - 10}"
@@ -1523,28 +3641,36 @@ async def bulk_remove_callback(callback: CallbackQuery):
 
 @router.callback_query(lambda c: c.data == "bulk_update_prices")
 async def bulk_update_prices_callback(callback: CallbackQuery):
+    """Принудительное обновление всех цен в портфеле (фоновая задача)."""
+    await callback.answer()
+    await jobs.submit(callback.message, callback.from_user.id, 'prices', (),
+                      lambda job: run_bulk_update_prices(callback, job),
+                      status_message=callback.message)
+
+
+async def run_bulk_update_prices(callback: CallbackQuery, job):
     """Принудительное обновление всех цен в портфеле."""
-    await callback.message.edit_text("⏳ Обновляю все цены в портфеле...")
+    await job.progress("⏳ Обновляю все цены в портфеле...")
     
     try:
-        global portfolio_prices_cache, multisource_prices_cache
-        portfolio_prices_cache = {}
-        multisource_prices_cache = {}
-        
-        items = get_items_from_db()
+        items = get_items_from_db(callback.from_user.id)
         if not items:
             await callback.message.edit_text("❌ Портфель пуст.")
             return
+        # Сбрасываем кэш только для предметов этого пользователя
+        invalidate_user_prices(callback.from_user.id)
         
         updated_count = 0
-        for user_id, name, qty, buy_uah, buy_usd in items:
+        for index, (item_id, name, qty, buy_uah, buy_usd) in enumerate(items, 1):
             try:
-                # Принудительно обновляем цены для каждого предмета
-                result = await get_current_prices_and_steam(name)
-                if result and result[0]:  # Если получили цену
+                # Принудительно обновляем цены для каждого предмета (результат остается в кэше)
+                prices = await get_item_prices(name)
+                if prices['marketcsgo_usd']:  # Если получили цену
                     updated_count += 1
-            except:
-                continue
+            except Exception:
+                pass
+            if index % 10 == 0:
+                await job.progress(f"⏳ Обновляю все цены в портфеле... {index}/{len(items)}")
         
         await callback.message.edit_text(
             f"✅ <b>Цены обновлены!</b>\n\n"
@@ -1577,13 +3703,7 @@ async def bulk_clear_callback(callback: CallbackQuery):
 async def confirm_clear_callback(callback: CallbackQuery):
     """Подтвержденная очистка портфеля."""
     try:
-        with get_db_cursor() as (cur, conn):
-            cur.execute("DELETE FROM portfolio WHERE user_id = ?", (callback.from_user.id,))
-            deleted_count = cur.rowcount
-        
-        global portfolio_prices_cache, multisource_prices_cache
-        portfolio_prices_cache = {}
-        multisource_prices_cache = {}
+        deleted_count = delete_all_items(callback.from_user.id)
         
         await callback.message.edit_text(
             f"🗑 <b>Портфель очищен!</b>\n\n"
@@ -1602,6 +3722,251 @@ async def cancel_clear_callback(callback: CallbackQuery):
         "🛡 Твой портфель в безопасности."
     )
 
+# --- ИМПОРТ ИНВЕНТАРЯ STEAM ---
+class SteamImportError(Exception):
+    """Ошибка импорта, текст которой можно показать пользователю."""
+
+
+def parse_steam_profile(text):
+    """
+    Разбирает ссылку на профиль Steam или SteamID64.
+    Возвращает ('id', steamid64), ('vanity', имя) или None.
+    """
+    text = (text or "").strip()
+    if re.fullmatch(r"\d{17}", text):
+        return ('id', text)
+    match = re.search(r"steamcommunity\.com/profiles/(\d{17})", text)
+    if match:
+        return ('id', match.group(1))
+    match = re.search(r"steamcommunity\.com/id/([\w.-]+)", text)
+    if match:
+        return ('vanity', match.group(1))
+    return None
+
+
+async def steam_get(session, url, params=None):
+    """GET к Steam Community с повторами при ограничении частоты запросов (429)."""
+    for attempt in range(STEAM_RATE_LIMIT_RETRIES + 1):
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            async with session.get(url, params=params, timeout=aiohttp.ClientTimeout(total=20)) as response:
+                status = response.status
+                if response.status == 429 and attempt < STEAM_RATE_LIMIT_RETRIES:
+                    logging.warning(f"Steam ограничил частоту запросов, повтор через {STEAM_RATE_LIMIT_DELAY_SECONDS} с.")
+                else:
+                    return response.status, await response.read()
+        finally:
+            observe_price_source('steam_community', status, started)
+        await asyncio.sleep(STEAM_RATE_LIMIT_DELAY_SECONDS * (attempt + 1))
+
+
+async def resolve_steam_id(session, profile):
+    """Возвращает SteamID64 профиля; короткое имя (vanity URL) раскрывается через XML профиля."""
+    kind, value = profile
+    if kind == 'id':
+        return value
+    status, body = await steam_get(session, f"{STEAM_COMMUNITY_URL}/id/{value}", params={'xml': '1'})
+    match = re.search(rb"<steamID64>(\d{17})</steamID64>", body or b"") if status == 200 else None
+    if not match:
+        raise SteamImportError(f"Профиль Steam '{value}' не найден.")
+    return match.group(1).decode()
+
+
+def aggregate_steam_inventory_page(data, descriptions, quantities):
+    """
+    Добавляет страницу инвентаря в общий подсчет.
+    Одинаковые предметы (по market_hash_name) складываются в количество, непродаваемые пропускаются.
+    """
+    for description in data.get('descriptions') or []:
+        descriptions[(description.get('classid'), description.get('instanceid'))] = description
+
+    for asset in data.get('assets') or []:
+        description = descriptions.get((asset.get('classid'), asset.get('instanceid')))
+        if not description or not description.get('marketable'):
+            continue
+        name = description.get('market_hash_name')
+        if name:
+            quantities[name] = quantities.get(name, 0) + int(asset.get('amount', 1))
+
+
+async def fetch_steam_inventory(session, steam_id, progress):
+    """
+    Постранично загружает CS2 инвентарь через одну сессию (соединение переиспользуется).
+    Возвращает {market_hash_name: количество}.
+    """
+    url = f"{STEAM_COMMUNITY_URL}/inventory/{steam_id}/730/2"
+    params = {'l': 'english', 'count': str(STEAM_INVENTORY_PAGE_SIZE)}
+    descriptions = {}
+    quantities = {}
+    loaded_assets = 0
+
+    for page in range(1, STEAM_INVENTORY_MAX_PAGES + 1):
+        status, body = await steam_get(session, url, params=params)
+        if status == 403:
+            raise SteamImportError("Инвентарь скрыт. Открой его в настройках приватности Steam.")
+        if status != 200:
+            raise SteamImportError(f"Steam вернул ошибку {status}.")
+
+        data = json.loads(body) if body else None
+        if not data:
+            # Пустой инвентарь Steam отдает как null
+            break
+        if not data.get('success', 1):
+            raise SteamImportError("Steam не отдал инвентарь.")
+
+        aggregate_steam_inventory_page(data, descriptions, quantities)
+        loaded_assets += len(data.get('assets') or [])
+        await progress(f"⏳ Загружаю инвентарь Steam... {loaded_assets} предметов (страница {page})")
+
+        if not data.get('more_items') or not data.get('last_assetid'):
+            break
+        params['start_assetid'] = data['last_assetid']
+    else:
+        logging.warning(f"Инвентарь {steam_id}: достигнут лимит в {STEAM_INVENTORY_MAX_PAGES} страниц.")
+
+    return quantities
+
+
+def price_steam_inventory(quantities):
+    """
+    Оценивает инвентарь по массовым прайс-листам (без запросов по каждому предмету).
+    Возвращает ([(название, количество, цена_₴)], [названия без цены]).
+    """
+    priced = []
+    unpriced = []
+    for name, qty in sorted(quantities.items()):
+        price_usd = marketcsgo_prices_cache.get(name.lower()) or skinport_prices_cache.get(name.lower())
+        if price_usd:
+            priced.append((name, qty, round(price_usd * USD_TO_UAH, 2)))
+        else:
+            unpriced.append(name)
+    return priced, unpriced
+
+
+def upsert_imported_items(user_id, items):
+    """
+    Записывает импортированный инвентарь одной транзакцией.
+    Для уже добавленных предметов с общим количеством сверяется сумма по всем лотам:
+    недостача снимается с самых новых лотов (опустевшие удаляются), излишек добавляется
+    новым лотом. Цены покупки существующих лотов не меняются, новые лоты и предметы
+    получают текущую рыночную цену в качестве цены покупки.
+    Возвращает (добавлено, обновлено).
+    """
+    added_at = datetime.now().isoformat()
+    with get_db_cursor() as (cur, _):
+        cur.execute("SELECT id, name, quantity FROM items WHERE user_id = ? ORDER BY id", (user_id, ))
+        lots = {}
+        for item_id, name, quantity in cur.fetchall():
+            lots.setdefault(name.lower(), []).append((item_id, quantity))
+
+        inserts, updates, deletes = [], [], []
+        added = updated = 0
+        for name, qty, price_uah in items:
+            new_lot = (user_id, name, qty, price_uah, round(price_uah / USD_TO_UAH, 2), added_at)
+            item_lots = lots.get(name.lower())
+            if not item_lots:
+                inserts.append(new_lot)
+                added += 1
+                continue
+            held = sum(quantity for _, quantity in item_lots)
+            if held == qty:
+                continue
+            updated += 1
+            if qty > held:
+                inserts.append(new_lot[:2] + (qty - held, ) + new_lot[3:])
+                continue
+            excess = held - qty
+            for item_id, quantity in reversed(item_lots):
+                if excess <= 0:
+                    break
+                if quantity <= excess:
+                    deletes.append((item_id, ))
+                else:
+                    updates.append((quantity - excess, item_id))
+                excess -= quantity
+
+        cur.executemany("UPDATE items SET quantity = ? WHERE id = ?", updates)
+        cur.executemany("DELETE FROM items WHERE id = ?", deletes)
+        cur.executemany(
+            "INSERT INTO items (user_id, name, quantity, buy_price_uah, buy_price_usd, added_at) VALUES (?, ?, ?, ?, ?, ?)",
+            inserts)
+    mark_holdings_changed(user_id)
+    logging.info(f"Импорт Steam для {user_id}: добавлено {added}, обновлено {updated} позиций.")
+    return added, updated
+
+
+@router.message(F.text == "🎮 Steam импорт")
+async def steam_import_cmd(message: Message, state: FSMContext):
+    """Обработчик кнопки 'Steam импорт'."""
+    await state.set_state(BulkStates.waiting_for_steam_url)
+    await message.answer(
+        "🎮 <b>Импорт инвентаря Steam</b>\n\n"
+        "📝 Отправь ссылку на профиль или SteamID64:\n"
+        "<code>https://steamcommunity.com/id/nickname</code>\n"
+        "<code>https://steamcommunity.com/profiles/76561198000000000</code>\n\n"
+        "⚠️ <i>Инвентарь должен быть открытым</i>\n"
+        "🚫 Отправь /cancel для отмены"
+    )
+
+
+@router.message(StateFilter(BulkStates.waiting_for_steam_url))
+async def process_steam_url(message: Message, state: FSMContext):
+    """Запускает импорт инвентаря фоновой задачей."""
+    profile = parse_steam_profile(message.text)
+    if not profile:
+        await message.answer("❌ Не похоже на ссылку на профиль Steam. Попробуй еще раз или отправь /cancel.")
+        return
+    await state.clear()
+    await jobs.submit(message, message.from_user.id, 'import', profile,
+                      lambda job: run_steam_import(message, profile, job))
+
+
+async def run_steam_import(message: Message, profile, job):
+    """Импорт инвентаря Steam: загрузка страниц, оценка по прайс-листам и запись одной транзакцией."""
+    await job.progress("⏳ Загружаю инвентарь Steam...")
+
+    headers = {'User-Agent': 'CS-Portfolio-Bot/1.0'}
+    try:
+        async with aiohttp.ClientSession(headers=headers, connector=aiohttp.TCPConnector(limit=4)) as session:
+            steam_id = await resolve_steam_id(session, profile)
+            # Прайс-листы качаются параллельно с инвентарем
+            prices_task = asyncio.gather(fetch_marketcsgo_prices(), fetch_skinport_prices())
+            try:
+                quantities = await fetch_steam_inventory(session, steam_id, job.progress)
+            finally:
+                await prices_task
+    except SteamImportError as e:
+        await message.answer(f"❌ {e}")
+        return
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        logging.error(f"Ошибка загрузки инвентаря Steam: {e}")
+        await message.answer("❌ Не удалось загрузить инвентарь Steam. Попробуй позже.")
+        return
+
+    if not quantities:
+        await message.answer("📭 В инвентаре нет предметов, которые можно продать на рынке.")
+        return
+
+    priced, unpriced = price_steam_inventory(quantities)
+    added, updated = upsert_imported_items(message.from_user.id, priced) if priced else (0, 0)
+
+    total_uah = sum(qty * price_uah for _, qty, price_uah in priced)
+    result = (
+        f"🎮 <b>Импорт из Steam завершен</b>\n\n"
+        f"📦 Уникальных предметов: <b>{len(quantities)}</b> ({sum(quantities.values())} шт.)\n"
+        f"➕ Добавлено позиций: <b>{added}</b>\n"
+        f"🔄 Обновлено количество: <b>{updated}</b>\n"
+        f"💰 Оценка по рынку: <b>{total_uah:,.0f}₴</b>"
+    )
+    if unpriced:
+        result += f"\n\n⚠️ Без рыночной цены пропущено {len(unpriced)}:\n"
+        result += '\n'.join(f"• {name}" for name in unpriced[:5])
+        if len(unpriced) > 5:
+            result += f"\n... и еще {len(unpriced) - 5}"
+    await message.answer(result, reply_markup=get_main_keyboard())
+
+
 @router.message(F.text == "⚙️ Настройки уведомлений")
 async def notification_settings_cmd(message: Message):
     """Обработчик кнопки 'Настройки уведомлений'."""
@@ -1649,66 +4014,420 @@ async def notification_settings_cmd(message: Message):
 
 @router.callback_query(lambda c: (c.data or "").startswith("page_"))
 async def change_page(callback: CallbackQuery):
-    """Обработчик для кнопок пагинации отчета. Редактирует текущее сообщение."""
+    """Обработчик для кнопок пагинации отчета (page_<номер>[_<фильтр>]). Редактирует текущее сообщение."""
     if not callback.data:
         return
-    page = int(callback.data.split("_")[1])
-    await generate_portfolio_report(callback.message, page=page)
+    parts = callback.data.split("_")
+    page = int(parts[1])
+    report_filter = parts[2] if len(parts) > 2 else 'all'
+    await generate_portfolio_report(callback.message, callback.from_user.id, page=page,
+                                    report_filter=report_filter)
     await callback.answer()
 
 
-async def generate_portfolio_report_enhanced(message: Message, page: int):
-    """Улучшенная генерация отчета по портфелю с мультиисточниками и анализом роста."""
-    global portfolio_prices_cache, multisource_prices_cache
+@router.callback_query(lambda c: (c.data or "").startswith("report_jump_"))
+async def show_report_jump(callback: CallbackQuery):
+    """Меню перехода к странице отчета (report_jump_<страница>_<фильтр>); строится по кэшированной разметке."""
+    if not callback.data:
+        return
+    _, _, page, report_filter = callback.data.split("_")
+    page = int(page)
+    valuation = await get_report_valuation(callback.from_user.id)
+    layout = get_report_layout(valuation, report_filter)
+    total_pages = len(layout['pages'])
+
+    if total_pages > REPORT_JUMP_MAX_BUTTONS:
+        # Равномерная выборка страниц, первая и последняя всегда доступны
+        step = (total_pages - 1) / (REPORT_JUMP_MAX_BUTTONS - 1)
+        jump_pages = sorted({round(i * step) for i in range(REPORT_JUMP_MAX_BUTTONS)})
+    else:
+        jump_pages = list(range(total_pages))
+
+    buttons = [
+        InlineKeyboardButton(text=f"• {n + 1} •" if n == page else str(n + 1),
+                             callback_data=f"page_{n}_{layout['filter']}")
+        for n in jump_pages
+    ]
+    keyboard_buttons = [buttons[i:i + REPORT_JUMP_BUTTONS_PER_ROW]
+                        for i in range(0, len(buttons), REPORT_JUMP_BUTTONS_PER_ROW)]
+    keyboard_buttons.append(
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data=f"page_{page}_{layout['filter']}")])
+
+    await callback.message.edit_reply_markup(
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard_buttons))
+    await callback.answer()
+
+
+@router.callback_query(lambda c: (c.data or "").startswith("report_filter_"))
+async def show_report_filters(callback: CallbackQuery):
+    """Меню фильтров отчета (report_filter_<страница>_<фильтр>): по знаку профита и по категориям."""
+    if not callback.data:
+        return
+    _, _, page, report_filter = callback.data.split("_")
+    valuation = await get_report_valuation(callback.from_user.id)
+
+    filters = [('all', "📋 Все позиции"), ('profit', "🟢 В плюсе"), ('loss', "🔴 В минусе")]
+    filters += [(f"cat{index}", category) for index, category in enumerate(valuation['categories'])]
+
+    keyboard_buttons = [
+        [InlineKeyboardButton(text=f"✅ {label}" if key == report_filter else label,
+                              callback_data=f"page_0_{key}")]
+        for key, label in filters
+    ]
+    keyboard_buttons.append(
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data=f"page_{page}_{report_filter}")])
+
+    await callback.message.edit_reply_markup(
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard_buttons))
+    await callback.answer()
+
+
+# --- ОТЧЕТ ПО ПОРТФЕЛЮ: ФРАГМЕНТЫ И СТРАНИЦЫ ---
+# Каждая позиция рендерится в HTML один раз и берется из кэша, пока не изменились ее цены,
+# количество или цена закупки. Страницы собираются из готовых фрагментов по лимиту длины сообщения.
+def get_position_fragment(position):
+    """Готовый HTML позиции; ключ - ID, цены (версия цены позиции), количество и цена закупки."""
+    key = ('position', position['id'], position['marketcsgo_usd'], position['steam_usd'],
+           position['quantity'], position['buy_uah'])
+    fragment = report_fragments.get(key)
+    if fragment is None:
+        fragment = render_position_fragment(position)
+        report_fragments.set(key, fragment)
+    return fragment
+
+
+def pack_report_pages(fragments, budget):
+    """
+    Раскладывает фрагменты по страницам, чтобы текст страницы не превышал budget символов.
+    Возвращает границы страниц [(начало, конец)]; слишком длинный фрагмент занимает страницу целиком.
+    """
+    pages = []
+    start = 0
+    length = 0
+    for index, fragment in enumerate(fragments):
+        added = len(fragment) if index == start else len(REPORT_FRAGMENT_SEPARATOR) + len(fragment)
+        if index > start and length + added > budget:
+            pages.append((start, index))
+            start = index
+            length = len(fragment)
+        else:
+            length += added
+    pages.append((start, len(fragments)))
+    return pages
+
+
+def build_report_page(header, fragments, page, pages=None):
+    """
+    Собирает страницу отчета из заголовка и фрагментов.
+    pages - заранее посчитанные границы страниц; без них фрагменты раскладываются заново.
+    Возвращает (текст, номер страницы, всего страниц, границы позиций страницы);
+    номер ограничивается, если портфель уменьшился.
+    """
+    if pages is None:
+        pages = pack_report_pages(fragments, REPORT_MESSAGE_LIMIT - len(header) - REPORT_FOOTER_RESERVE)
+    page = max(0, min(page, len(pages) - 1))
+    start_index, end_index = pages[page]
+    text = header + REPORT_FRAGMENT_SEPARATOR.join(fragments[start_index:end_index])
+    if len(pages) > 1:
+        text += f"\n\n📄 Страница {page + 1} из {len(pages)}"
+    return text, page, len(pages), (start_index, end_index)
+
+
+def filter_report_positions(valuation, report_filter):
+    """
+    Позиции оценки по фильтру: all, profit/loss (знак профита позиции), cat<N> (N-я категория оценки).
+    Возвращает (нормализованный фильтр, подпись фильтра или None, позиции).
+    """
+    positions = valuation['positions']
+    if report_filter == 'profit':
+        return report_filter, "🟢 В плюсе", [
+            p for p in positions if p['now_uah'] > p['buy_uah'] * p['quantity']]
+    if report_filter == 'loss':
+        return report_filter, "🔴 В минусе", [
+            p for p in positions if p['now_uah'] < p['buy_uah'] * p['quantity']]
+    if report_filter.startswith('cat') and report_filter[3:].isdigit():
+        categories = list(valuation['categories'])
+        index = int(report_filter[3:])
+        # Категории могли измениться с момента отправки кнопки - тогда показываем все позиции
+        if index < len(categories):
+            category = categories[index]
+            return report_filter, category, [p for p in positions if p['category'] == category]
+    return 'all', None, positions
+
+
+@traced("render report_layout")
+def get_report_layout(valuation, report_filter):
+    """
+    Заголовок, фрагменты, позиции и границы страниц отчета для фильтра.
+    Считается один раз на оценку: листание, переход к странице и меню редактирования берут готовую разметку.
+    """
+    layout = valuation['layouts'].get(report_filter)
+    if layout is not None:
+        return layout
+
+    normalized_filter, label, positions = filter_report_positions(valuation, report_filter)
+    header = render_report_header(valuation)
+    if label:
+        header += f"🔎 Фильтр: {label} ({len(positions)} поз.)\n\n"
+    if positions:
+        fragments = [get_position_fragment(position) for position in positions]
+    else:
+        fragments = ["Нет позиций, подходящих под фильтр."]
+    layout = {
+        'filter': normalized_filter,
+        'header': header,
+        'positions': positions,
+        'fragments': fragments,
+        'pages': pack_report_pages(fragments, REPORT_MESSAGE_LIMIT - len(header) - REPORT_FOOTER_RESERVE)
+    }
+    valuation['layouts'][report_filter] = layout
+    return layout
+
+
+def render_report_header(valuation):
+    """Сводная часть отчета: итоги и статистика по категориям (одинакова на всех страницах)."""
+    total_buy_uah = valuation['total_buy_uah']
+    total_now_uah = valuation['total_now_uah']
+    category_stats = valuation['categories']
+
+    # Формирование итогового отчета (сводная часть)
+    total_profit_uah = total_now_uah - total_buy_uah
+    total_profit_usd = total_profit_uah / USD_TO_UAH
+    total_profit_pct = (total_profit_uah /
+                        total_buy_uah) * 100 if total_buy_uah > 0 else 0
+    total_buy_usd = total_buy_uah / USD_TO_UAH
+    total_now_usd = total_now_uah / USD_TO_UAH
+
+    total_profit_emoji = "🟢" if total_profit_uah >= 0 else "🔴"
+
+    final_report = (
+        f"<b>📊 Твой портфель:</b>\n"
+        f"<b>💰 Общая закупка:</b> {total_buy_uah:,.2f}₴ | {total_buy_usd:,.2f}$\n"
+        f"<b>📈 Текущая стоимость:</b> {total_now_uah:,.2f}₴ | {total_now_usd:,.2f}$\n"
+        f"<b>🚀 Общий профит:</b> {total_profit_emoji} {total_profit_uah:,.2f}₴ ({total_profit_usd:,.2f}$) ({total_profit_pct:+.2f}%)\n"
+    )
+
+    final_report += "\n--- <b>Статистика по категориям</b> ---\n"
+    for category, values in category_stats.items():
+        cat_profit = values['now_uah'] - values['buy_uah']
+        cat_profit_pct = (cat_profit / values['buy_uah']
+                          ) * 100 if values['buy_uah'] > 0 else 0
+        cat_profit_emoji = "🟢" if cat_profit >= 0 else "🔴"
+        final_report += f"{category}: {values['now_uah']:,.2f}₴ ({cat_profit_emoji} {cat_profit_pct:+.2f}%)\n"
+
+    final_report += "\n--- <b>Детализация по предметам</b> ---\n"
+    return final_report
+
+
+def render_position_fragment(position):
+    """HTML одной позиции отчета: стоимость, профит и цены за 1 шт."""
+    name = position['name']
+    qty = position['quantity']
+    buy_uah = position['buy_uah']
+    buy_usd = position['buy_usd']
+    marketcsgo_usd = position['marketcsgo_usd']
+    steam_usd = position['steam_usd']
+
+    report_lines = []
+    report_lines.append(f"<b>{name}</b>")
+    report_lines.append(f"📦 Количество: {qty}")
+
+    # Общая стоимость закупки
+    buy_total_uah = buy_uah * qty
+    buy_total_usd = buy_usd * qty
+    report_lines.append(
+        f"💰 Общая закупка: {buy_total_uah:,.2f}₴ | {buy_total_usd:,.2f}$")
+
+    # Текущая общая стоимость
+    current_total_uah = 0
+    current_total_usd = 0
+    if marketcsgo_usd:
+        current_total_uah = (marketcsgo_usd * USD_TO_UAH) * qty
+        current_total_usd = marketcsgo_usd * qty
+        report_lines.append(
+            f"📈 Текущая общая стоимость: {current_total_uah:,.2f}₴ | {current_total_usd:,.2f}$"
+        )
+    else:
+        report_lines.append("❌ Текущая общая стоимость: Нет данных")
+
+    # Профит
+    if marketcsgo_usd:
+        profit_uah = current_total_uah - buy_total_uah
+        profit_usd = current_total_usd - buy_total_usd
+        profit_pct = (profit_uah /
+                      buy_total_uah) * 100 if buy_total_uah > 0 else 0
+
+        profit_emoji = "🟢" if profit_pct >= 0 else "🔴"
+        report_lines.append(
+            f"📊 Общий профит: {profit_emoji} {profit_uah:,.2f}₴ ({profit_usd:,.2f}$) ({profit_pct:+.2f}%)"
+        )
+    else:
+        report_lines.append(f"❌ Нет данных для расчета профита.")
+
+    # Цена за 1 шт. и её профит - только если количество > 1
+    if qty > 1:
+        report_lines.append("")
+        report_lines.append(f"<b>Цены за 1 шт.:</b>")
+        report_lines.append(
+            f"💰 Закупка: {buy_uah:,.2f}₴ | {buy_usd:,.2f}$")
+
+        # Процент роста для 1 штуки MarketCSGO
+        if marketcsgo_usd:
+            current_uah_per_item = marketcsgo_usd * USD_TO_UAH
+            profit_pct_per_item_market = (
+                (current_uah_per_item - buy_uah) /
+                buy_uah) * 100 if buy_uah > 0 else 0
+            profit_emoji_per_item_market = "🟢" if profit_pct_per_item_market >= 0 else "🔴"
+            report_lines.append(
+                f"📈 MarketCSGO: {current_uah_per_item:,.2f}₴ | {marketcsgo_usd:,.2f}$ ({profit_emoji_per_item_market} {profit_pct_per_item_market:+.2f}%)"
+            )
+        else:
+            report_lines.append(f"❌ MarketCSGO: Нет данных")
+
+        # Процент роста для 1 штуки Steam
+        if steam_usd:
+            steam_uah_per_item = steam_usd * USD_TO_UAH
+            profit_pct_per_item_steam = (
+                (steam_uah_per_item - buy_uah) /
+                buy_uah) * 100 if buy_uah > 0 else 0
+            profit_emoji_per_item_steam = "🟢" if profit_pct_per_item_steam >= 0 else "🔴"
+            report_lines.append(
+                f"📈 Steam: {steam_uah_per_item:,.2f}₴ | {steam_usd:,.2f}$ ({profit_emoji_per_item_steam} {profit_pct_per_item_steam:+.2f}%)"
+            )
+        else:
+            report_lines.append(f"❌ Steam: Нет данных")
+
+    return "\n".join(report_lines)
+
+
+def render_multisource_fragment(name, qty, buy_uah, buy_usd, price_data):
+    """HTML одной позиции отчета по мультиисточникам."""
+    report_lines = []
+    report_lines.append(f"<b>{name}</b>")
+    report_lines.append(f"📦 Количество: {qty}")
+    
+    if not price_data:
+        report_lines.append("❌ Нет данных о ценах. Попробуйте обновить портфель.")
+        return "\n".join(report_lines)
+    
+    median_price = price_data.get('median')
+    sources = price_data.get('sources', {})
+    rejected = price_data.get('rejected', {})
+    confidence = price_data.get('confidence')
+    steam_price = price_data.get('steam')
     
-    items = get_items_from_db()
+    # Общая стоимость закупки
+    buy_total_uah = buy_uah * qty
+    buy_total_usd = buy_usd * qty
+    report_lines.append(f"💰 Общая закупка: {buy_total_uah:,.2f}₴ | {buy_total_usd:,.2f}$")
+    
+    # Текущая общая стоимость
+    if median_price:
+        current_total_uah = (median_price * USD_TO_UAH) * qty
+        current_total_usd = median_price * qty
+        report_lines.append(f"📈 Текущая стоимость: {current_total_uah:,.2f}₴ | {current_total_usd:,.2f}$")
+        
+        # Профит
+        profit_uah = current_total_uah - buy_total_uah
+        profit_usd = current_total_usd - buy_total_usd
+        profit_pct = (profit_uah / buy_total_uah) * 100 if buy_total_uah > 0 else 0
+        profit_emoji = "🟢" if profit_uah >= 0 else "🔴"
+        
+        report_lines.append(f"🚀 Профит: {profit_emoji} {profit_uah:,.2f}₴ ({profit_usd:,.2f}$) ({profit_pct:+.2f}%)")
+        
+        # Показываем источники
+        if len(sources) > 1:
+            sources_text = ", ".join([f"{src}: {price:.2f}$" for src, price in sources.items()])
+            report_lines.append(f"📡 Источники: {sources_text}")
+            report_lines.append(f"📊 Медиана: {median_price:.2f}$")
+        elif len(sources) == 1:
+            src, price = list(sources.items())[0]
+            report_lines.append(f"📡 Источник: {src} ({price:.2f}$)")
+        if rejected:
+            rejected_text = ", ".join([f"{src}: {price:.2f}$" for src, price in rejected.items()])
+            report_lines.append(f"⚠️ Отброшены как выбросы: {rejected_text}")
+        if confidence is not None and confidence < PRICE_MIN_CONFIDENCE:
+            reason = ("источники расходятся" if price_data.get('agreement', 1.0) < PRICE_MIN_CONFIDENCE
+                      else "данные источников устарели")
+            report_lines.append(f"❔ Низкая достоверность цены ({confidence:.0%}): {reason}")
+        
+        if steam_price:
+            report_lines.append(f"🔧 Steam: {steam_price:.2f}$ (справочно)")
+    else:
+        report_lines.append("❌ Цены недоступны")
+    
+    return "\n".join(report_lines)
+
+
+def get_multisource_fragment(item_id, name, qty, buy_uah, buy_usd):
+    """Готовый HTML позиции отчета по мультиисточникам; ключ включает все цены источников."""
+    price_data = multisource_prices_cache.get(name, {})
+    key = ('multisource', item_id, price_data.get('median'), tuple(sorted(price_data.get('sources', {}).items())),
+           tuple(sorted(price_data.get('rejected', {}).items())), price_data.get('confidence'), price_data.get('agreement'),
+           price_data.get('steam'), qty, buy_uah)
+    fragment = report_fragments.get(key)
+    if fragment is None:
+        fragment = render_multisource_fragment(name, qty, buy_uah, buy_usd, price_data)
+        report_fragments.set(key, fragment)
+    return fragment
+
+
+async def generate_portfolio_report_enhanced(message: Message, user_id: int, page: int):
+    """Улучшенная генерация отчета по портфелю с мультиисточниками и анализом роста."""
+
+    items = get_items_from_db(user_id)
     if not items:
         await message.answer(
             "❌ Портфель пуст. Добавь предметы, используя кнопку '➕ Добавить'.")
         return
     
-    # Прогресс бар для пользователя
-    progress_msg = await message.answer("⏳ Обновляю цены из мультиисточников...")
+    # Прогресс для пользователя: этапы склеиваются, итоговый отчет заменяет сообщение о прогрессе
+    progress = MessageUpdater(message.chat.id)
+    await progress.update("⏳ Обновляю цены из мультиисточников...")
     
-    # Если кэш пуст, делаем запросы к мультиисточникам
-    if not multisource_prices_cache:
-        await fetch_marketcsgo_prices()
-        
-        # Получаем цены из мультиисточников для всех предметов
-        for _, name, qty, buy_uah, buy_usd in items:
-            try:
-                multisource_data = await fetch_multisource_prices(name)
-                if multisource_data:
-                    multisource_prices_cache[name] = multisource_data
-                else:
-                    # Fallback к старому методу
-                    marketcsgo_price, steam_price = await get_current_prices_and_steam(name)
-                    multisource_prices_cache[name] = {
-                        'median': marketcsgo_price,
-                        'sources': {'marketcsgo': marketcsgo_price},
-                        'steam': steam_price
-                    }
-            except Exception as e:
-                logging.error(f"Ошибка получения цен для {name}: {e}")
-                # Fallback
-                multisource_prices_cache[name] = {
-                    'median': None,
-                    'sources': {},
-                    'steam': None
-                }
+    # Запрашиваем мультиисточники только для предметов, которых нет в кэше
+    await fetch_marketcsgo_prices()
+    missing = [name for name in {item[1] for item in items} if multisource_prices_cache.get(name) is None]
+    try:
+        # Медианы всех недостающих предметов считаются одним пакетом
+        multisource = await fetch_multisource_prices_batch(missing) if missing else {}
+    except Exception as e:
+        logging.error(f"Ошибка при получении мультиисточников цен: {e}")
+        multisource = {}
+    for name in missing:
+        try:
+            multisource_data = multisource.get(name)
+            if multisource_data:
+                multisource_prices_cache.set(name, multisource_data)
+            else:
+                # Fallback к старому методу
+                prices = await get_item_prices(name)
+                multisource_prices_cache.set(name, {
+                    'median': prices['marketcsgo_usd'],
+                    'sources': {'marketcsgo': prices['marketcsgo_usd']},
+                    'steam': prices['steam_usd']
+                })
+        except Exception as e:
+            logging.error(f"Ошибка получения цен для {name}: {e}")
+            # Fallback
+            multisource_prices_cache.set(name, {
+                'median': None,
+                'sources': {},
+                'steam': None
+            })
     
-    await progress_msg.edit_text("📊 Анализирую изменения цен...")
+    await progress.update("📊 Анализирую изменения цен...")
     
     # Сохраняем снимок портфеля для анализа
-    save_portfolio_snapshot()
+    save_portfolio_snapshot(user_id)
     
     # Находим предмет с наибольшим ростом
-    biggest_changes = get_biggest_price_changes(3)
+    biggest_changes = get_biggest_price_changes(user_id, 3)
     biggest_gainer = None
     if biggest_changes:
         biggest_gainer = biggest_changes[0]  # Первый элемент - максимальный рост
     
-    await progress_msg.edit_text("📈 Формирую отчет...")
+    await progress.update("📈 Формирую отчет...")
     
     # Считаем общую статистику по всему портфелю
     total_buy_uah = 0
@@ -1774,68 +4493,10 @@ async def generate_portfolio_report_enhanced(message: Message, page: int):
     
     final_report += "\n--- <b>Детализация по предметам</b> ---\n"
     
-    # Пагинация
-    total_pages = (len(items) + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
-    start_index = page * ITEMS_PER_PAGE
-    end_index = start_index + ITEMS_PER_PAGE
-    items_on_page = items[start_index:end_index]
-    
-    item_reports = []
-    for _, name, qty, buy_uah, buy_usd in items_on_page:
-        report_lines = []
-        report_lines.append(f"<b>{name}</b>")
-        report_lines.append(f"📦 Количество: {qty}")
-        
-        price_data = multisource_prices_cache.get(name, {})
-        if not price_data:
-            report_lines.append("❌ Нет данных о ценах. Попробуйте обновить портфель.")
-            item_reports.append("\n".join(report_lines))
-            continue
-        
-        median_price = price_data.get('median')
-        sources = price_data.get('sources', {})
-        steam_price = price_data.get('steam')
-        
-        # Общая стоимость закупки
-        buy_total_uah = buy_uah * qty
-        buy_total_usd = buy_usd * qty
-        report_lines.append(f"💰 Общая закупка: {buy_total_uah:,.2f}₴ | {buy_total_usd:,.2f}$")
-        
-        # Текущая общая стоимость
-        if median_price:
-            current_total_uah = (median_price * USD_TO_UAH) * qty
-            current_total_usd = median_price * qty
-            report_lines.append(f"📈 Текущая стоимость: {current_total_uah:,.2f}₴ | {current_total_usd:,.2f}$")
-            
-            # Профит
-            profit_uah = current_total_uah - buy_total_uah
-            profit_usd = current_total_usd - buy_total_usd
-            profit_pct = (profit_uah / buy_total_uah) * 100 if buy_total_uah > 0 else 0
-            profit_emoji = "🟢" if profit_uah >= 0 else "🔴"
-            
-            report_lines.append(f"🚀 Профит: {profit_emoji} {profit_uah:,.2f}₴ ({profit_usd:,.2f}$) ({profit_pct:+.2f}%)")
-            
-            # Показываем источники
-            if len(sources) > 1:
-                sources_text = ", ".join([f"{src}: {price:.2f}$" for src, price in sources.items()])
-                report_lines.append(f"📡 Источники: {sources_text}")
-                report_lines.append(f"📊 Медиана: {median_price:.2f}$")
-            elif len(sources) == 1:
-                src, price = list(sources.items())[0]
-                report_lines.append(f"📡 Источник: {src} ({price:.2f}$)")
-            
-            if steam_price:
-                report_lines.append(f"🔧 Steam: {steam_price:.2f}$ (справочно)")
-        else:
-            report_lines.append("❌ Цены недоступны")
-        
-        item_reports.append("\n".join(report_lines))
-    
-    final_report += "\n\n".join(item_reports)
-    
-    # Пагинация
-    if total_pages > 1:
-        final_report += f"\n\n📄 Страница {page + 1} из {total_pages}"
+    # Фрагменты позиций из кэша, страницы - по лимиту длины сообщения
+    fragments = [get_multisource_fragment(item_id, name, qty, buy_uah, buy_usd)
+                 for item_id, name, qty, buy_uah, buy_usd in items]
+    final_report, page, total_pages, _ = build_report_page(final_report, fragments, page)
     
     # Inline кнопки для навигации и управления
     buttons = []
@@ -1857,223 +4518,58 @@ async def generate_portfolio_report_enhanced(message: Message, page: int):
     
     markup = InlineKeyboardMarkup(inline_keyboard=buttons) if buttons else None
     
-    await progress_msg.delete()
-    await message.answer(final_report, reply_markup=markup)
-
-async def generate_portfolio_report(message: Message, page: int):
-    """Генерация и отправка/редактирование отчета по портфелю с пагинацией."""
-    global portfolio_prices_cache
+    await progress.finish(final_report, markup)
 
-    items = get_items_from_db()
-    if not items:
+async def generate_portfolio_report(message: Message, user_id: int, page: int, report_filter: str = 'all',
+                                    updater: MessageUpdater | None = None):
+    """
+    Генерация и отправка/редактирование отчета по портфелю с пагинацией и фильтром.
+    user_id передается явно: при листании message - сообщение бота, а не пользователя.
+    updater - апдейтер сообщения, в котором уже показан прогресс (кнопка 'Обновить').
+    """
+    # Оценка и разметка страниц из кэша: при листании БД и цены повторно не запрашиваются
+    valuation = await get_report_valuation(user_id)
+    if not valuation['positions']:
         await message.answer(
             "❌ Портфель пуст. Добавь предметы, используя кнопку '➕ Добавить'.")
         return
 
-    # Если кэш пуст, делаем запросы
-    if not portfolio_prices_cache:
-        await fetch_marketcsgo_prices()
-
-        tasks = {
-            item[1]: asyncio.create_task(get_current_prices_and_steam(item[1]))
-            for item in items
-        }
-        if tasks:
-            await asyncio.gather(*tasks.values())
-
-        for _, name, qty, buy_uah, buy_usd in items:
-            marketcsgo_price_usd, steam_price_usd = tasks[name].result()
-
-            portfolio_prices_cache[name] = {
-                'marketcsgo_usd': marketcsgo_price_usd,
-                'steam_usd': steam_price_usd,
-                'buy_uah': buy_uah,
-                'buy_usd': buy_usd,
-                'quantity': qty
-            }
-
-    # Считаем общую статистику по всему портфелю на основе кэша
-    total_buy_uah = 0
-    total_now_uah = 0.0
-    category_stats = {}
-
-    for name, data in portfolio_prices_cache.items():
-        qty = data['quantity']
-        buy_uah = data['buy_uah']
-        marketcsgo_price_usd = data['marketcsgo_usd']
+    layout = get_report_layout(valuation, report_filter)
+    report_filter = layout['filter']
+    final_report, page, total_pages, _ = build_report_page(
+        layout['header'], layout['fragments'], page, layout['pages'])
 
-        pos_buy_uah = buy_uah * qty
-        total_buy_uah += pos_buy_uah
-
-        if marketcsgo_price_usd:
-            current_price_uah = marketcsgo_price_usd * USD_TO_UAH
-            total_now_uah += current_price_uah * qty
-        else:
-            total_now_uah += pos_buy_uah
-
-        category = get_item_category(name)
-        if category not in category_stats:
-            category_stats[category] = {'buy_uah': 0, 'now_uah': 0}
-
-        category_stats[category]['buy_uah'] += pos_buy_uah
-        category_stats[category]['now_uah'] += (
-            marketcsgo_price_usd * USD_TO_UAH
-        ) * qty if marketcsgo_price_usd is not None else pos_buy_uah
-
-    # Формирование итогового отчета (сводная часть)
-    total_profit_uah = total_now_uah - total_buy_uah
-    total_profit_usd = total_profit_uah / USD_TO_UAH
-    total_profit_pct = (total_profit_uah /
-                        total_buy_uah) * 100 if total_buy_uah > 0 else 0
-    total_buy_usd = total_buy_uah / USD_TO_UAH
-    total_now_usd = total_now_uah / USD_TO_UAH
-
-    total_profit_emoji = "🟢" if total_profit_uah >= 0 else "🔴"
-
-    final_report = (
-        f"<b>📊 Твой портфель:</b>\n"
-        f"<b>💰 Общая закупка:</b> {total_buy_uah:,.2f}₴ | {total_buy_usd:,.2f}$\n"
-        f"<b>📈 Текущая стоимость:</b> {total_now_uah:,.2f}₴ | {total_now_usd:,.2f}$\n"
-        f"<b>🚀 Общий профит:</b> {total_profit_emoji} {total_profit_uah:,.2f}₴ ({total_profit_usd:,.2f}$) ({total_profit_pct:+.2f}%)\n"
-    )
-
-    final_report += "\n--- <b>Статистика по категориям</b> ---\n"
-    for category, values in category_stats.items():
-        cat_profit = values['now_uah'] - values['buy_uah']
-        cat_profit_pct = (cat_profit / values['buy_uah']
-                          ) * 100 if values['buy_uah'] > 0 else 0
-        cat_profit_emoji = "🟢" if cat_profit >= 0 else "🔴"
-        final_report += f"{category}: {values['now_uah']:,.2f}₴ ({cat_profit_emoji} {cat_profit_pct:+.2f}%)\n"
-
-    final_report += "\n--- <b>Детализация по предметам</b> ---\n"
-
-    # Пагинация
-    total_pages = (len(items) + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
-    start_index = page * ITEMS_PER_PAGE
-    end_index = start_index + ITEMS_PER_PAGE
-    items_on_page = items[start_index:end_index]
-
-    item_reports = []
-    for _, name, qty, buy_uah, buy_usd in items_on_page:
-
-        report_lines = []
-        report_lines.append(f"<b>{name}</b>")
-        report_lines.append(f"📦 Количество: {qty}")
-
-        prices = portfolio_prices_cache.get(name)
-        if not prices:
-            report_lines.append(
-                "❌ Нет данных о ценах. Попробуйте обновить портфель.")
-            item_reports.append("\n".join(report_lines))
-            continue
-
-        marketcsgo_usd = prices.get('marketcsgo_usd')
-        steam_usd = prices.get('steam_usd')
-        buy_uah = prices.get('buy_uah')
-        buy_usd = prices.get('buy_usd')
-
-        # Общая стоимость закупки
-        buy_total_uah = buy_uah * qty
-        buy_total_usd = buy_usd * qty
-        report_lines.append(
-            f"💰 Общая закупка: {buy_total_uah:,.2f}₴ | {buy_total_usd:,.2f}$")
-
-        # Текущая общая стоимость
-        current_total_uah = 0
-        current_total_usd = 0
-        if marketcsgo_usd:
-            current_total_uah = (marketcsgo_usd * USD_TO_UAH) * qty
-            current_total_usd = marketcsgo_usd * qty
-            report_lines.append(
-                f"📈 Текущая общая стоимость: {current_total_uah:,.2f}₴ | {current_total_usd:,.2f}$"
-            )
-        else:
-            report_lines.append("❌ Текущая общая стоимость: Нет данных")
-
-        # Профит
-        if marketcsgo_usd:
-            profit_uah = current_total_uah - buy_total_uah
-            profit_usd = current_total_usd - buy_total_usd
-            profit_pct = (profit_uah /
-                          buy_total_uah) * 100 if buy_total_uah > 0 else 0
-
-            profit_emoji = "🟢" if profit_pct >= 0 else "🔴"
-            report_lines.append(
-                f"📊 Общий профит: {profit_emoji} {profit_uah:,.2f}₴ ({profit_usd:,.2f}$) ({profit_pct:+.2f}%)"
-            )
-        else:
-            report_lines.append(f"❌ Нет данных для расчета профита.")
-
-        # Цена за 1 шт. и её профит - только если количество > 1
-        if qty > 1:
-            report_lines.append("")
-            report_lines.append(f"<b>Цены за 1 шт.:</b>")
-            report_lines.append(
-                f"💰 Закупка: {buy_uah:,.2f}₴ | {buy_usd:,.2f}$")
-
-            # Процент роста для 1 штуки MarketCSGO
-            if marketcsgo_usd:
-                current_uah_per_item = marketcsgo_usd * USD_TO_UAH
-                profit_pct_per_item_market = (
-                    (current_uah_per_item - buy_uah) /
-                    buy_uah) * 100 if buy_uah > 0 else 0
-                profit_emoji_per_item_market = "🟢" if profit_pct_per_item_market >= 0 else "🔴"
-                report_lines.append(
-                    f"📈 MarketCSGO: {current_uah_per_item:,.2f}₴ | {marketcsgo_usd:,.2f}$ ({profit_emoji_per_item_market} {profit_pct_per_item_market:+.2f}%)"
-                )
-            else:
-                report_lines.append(f"❌ MarketCSGO: Нет данных")
-
-            # Процент роста для 1 штуки Steam
-            if steam_usd:
-                steam_uah_per_item = steam_usd * USD_TO_UAH
-                profit_pct_per_item_steam = (
-                    (steam_uah_per_item - buy_uah) /
-                    buy_uah) * 100 if buy_uah > 0 else 0
-                profit_emoji_per_item_steam = "🟢" if profit_pct_per_item_steam >= 0 else "🔴"
-                report_lines.append(
-                    f"📈 Steam: {steam_uah_per_item:,.2f}₴ | {steam_usd:,.2f}$ ({profit_emoji_per_item_steam} {profit_pct_per_item_steam:+.2f}%)"
-                )
-            else:
-                report_lines.append(f"❌ Steam: Нет данных")
-
-        item_reports.append("\n".join(report_lines))
-
-    final_report += "\n\n---\n\n".join(item_reports)
-
-    # Создание кнопок пагинации и редактирования
+    # Создание кнопок пагинации, перехода к странице, фильтра и редактирования
     keyboard_buttons = []
     navigation_row = []
 
     if page > 0:
         navigation_row.append(
-            InlineKeyboardButton(text="⬅️", callback_data=f"page_{page-1}"))
+            InlineKeyboardButton(text="⬅️", callback_data=f"page_{page-1}_{report_filter}"))
+    if total_pages > 1:
+        navigation_row.append(
+            InlineKeyboardButton(text=f"📄 {page + 1}/{total_pages}",
+                                 callback_data=f"report_jump_{page}_{report_filter}"))
     if page < total_pages - 1:
         navigation_row.append(
-            InlineKeyboardButton(text="➡️", callback_data=f"page_{page+1}"))
+            InlineKeyboardButton(text="➡️", callback_data=f"page_{page+1}_{report_filter}"))
 
     if navigation_row:
         keyboard_buttons.append(navigation_row)
 
-    if items:
-        keyboard_buttons.append([
-            InlineKeyboardButton(text="✏️ Редактировать",
-                                 callback_data=f"edit_page_{page}")
-        ])
+    keyboard_buttons.append([
+        InlineKeyboardButton(text="🔎 Фильтр",
+                             callback_data=f"report_filter_{page}_{report_filter}"),
+        InlineKeyboardButton(text="✏️ Редактировать",
+                             callback_data=f"edit_page_{page}_{report_filter}")
+    ])
 
     markup = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
 
-    # Сохраняем текущую стоимость портфеля для уведомлений
-    save_portfolio_value(total_now_uah)
-
-    try:
-        # Пытаемся отредактировать сообщение
-        await message.edit_text(final_report, reply_markup=markup)
-    except Exception as e:
-        # Если не получилось (например, это первое сообщение), отправляем новое
-        logging.info(
-            f"Не удалось отредактировать сообщение, отправляю новое: {e}")
-        await message.answer(final_report, reply_markup=markup)
+    # Сообщение бота редактируется (без правки, если страница не изменилась), на сообщение пользователя - ответ
+    if updater is None:
+        updater = MessageUpdater.for_message(message)
+    await updater.finish(final_report, markup)
 
 
 @router.callback_query(lambda c: (c.data or "").startswith("edit_page_"))
@@ -2081,12 +4577,17 @@ async def show_edit_options(callback: CallbackQuery):
     """Показывает кнопки редактирования для предметов на выбранной странице, редактируя текущее сообщение."""
     if not callback.data:
         return
-    page = int(callback.data.split("_")[2])
-
-    items = get_items_from_db()
-    start_index = page * ITEMS_PER_PAGE
-    end_index = start_index + ITEMS_PER_PAGE
-    items_on_page = items[start_index:end_index]
+    parts = callback.data.split("_")
+    page = int(parts[2])
+    report_filter = parts[3] if len(parts) > 3 else 'all'
+
+    # Границы страницы те же, что в отчете (разметка берется из кэшированной оценки)
+    valuation = await get_report_valuation(callback.from_user.id)
+    layout = get_report_layout(valuation, report_filter)
+    report_filter = layout['filter']
+    page = max(0, min(page, len(layout['pages']) - 1))
+    start_index, end_index = layout['pages'][page]
+    items_on_page = [(position['id'], position['name']) for position in layout['positions'][start_index:end_index]]
 
     if not items_on_page:
         await callback.message.edit_text(
@@ -2096,7 +4597,7 @@ async def show_edit_options(callback: CallbackQuery):
         return
 
     keyboard_buttons = []
-    for item_id, name, _, _, _ in items_on_page:
+    for item_id, name in items_on_page:
         keyboard_buttons.append([
             InlineKeyboardButton(text=f"✏️ {name}",
                                  callback_data=f"edit_item_{item_id}"),
@@ -2106,7 +4607,7 @@ async def show_edit_options(callback: CallbackQuery):
 
     # Кнопка "Назад" для возврата к отчету
     keyboard_buttons.append(
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data=f"page_{page}")])
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data=f"page_{page}_{report_filter}")])
 
     await callback.message.edit_text(
         "👇 Выберите предмет для редактирования/удаления:",
@@ -2168,7 +4669,7 @@ async def process_new_quantity(message: Message, state: FSMContext):
             await state.clear()
             return
 
-        update_item_quantity(item_id, new_quantity)
+        update_item_quantity(message.from_user.id, item_id, new_quantity)
         await message.answer("✅ Количество предмета успешно обновлено!")
         await state.clear()
 
@@ -2197,7 +4698,7 @@ async def process_new_price(message: Message, state: FSMContext):
             await state.clear()
             return
 
-        update_item_price(item_id, new_price)
+        update_item_price(message.from_user.id, item_id, new_price)
         await message.answer("✅ Цена закупки предмета успешно обновлена!")
         await state.clear()
 
@@ -2209,7 +4710,7 @@ async def process_new_price(message: Message, state: FSMContext):
 @router.message(F.text == "🗑️ Удалить")
 async def delete_item_cmd(message: Message):
     """Обработчик кнопки 'Удалить предмет'."""
-    items = get_items_from_db()
+    items = get_items_from_db(message.from_user.id)
     if not items:
         await message.answer("❌ Портфель пуст. Нечего удалять.")
         return
@@ -2232,7 +4733,7 @@ async def delete_item_from_edit(callback: CallbackQuery):
     if not callback.data:
         return
     item_id = int(callback.data.split("_")[2])
-    if delete_item_by_id(item_id):
+    if delete_item_by_id(callback.from_user.id, item_id):
         await safe_edit_or_send(callback, text="✅ Предмет удален из портфеля!")
     else:
         await callback.answer("❌ Не удалось удалить предмет.")
@@ -2244,7 +4745,7 @@ async def delete_item_callback(callback: CallbackQuery):
     if not callback.data:
         return
     item_id = int(callback.data.split("_")[1])
-    if delete_item_by_id(item_id):
+    if delete_item_by_id(callback.from_user.id, item_id):
         await safe_edit_or_send(callback, text="✅ Предмет удален из портфеля!")
     else:
         await callback.answer("❌ Не удалось удалить предмет.")
@@ -2252,11 +4753,17 @@ async def delete_item_callback(callback: CallbackQuery):
 
 @router.message(F.text == "📈 График")
 async def history_cmd(message: Message):
+    """Обработчик кнопки 'График' (фоновая задача)."""
+    await jobs.submit(message, message.from_user.id, 'chart', ('history',),
+                      lambda job: run_history_chart(message, job))
+
+
+async def run_history_chart(message: Message, job):
     """
-    Обработчик кнопки 'График'.
     Собирает данные из истории портфеля и строит график.
+    Отрисовка matplotlib выполняется в рабочем потоке, чтобы не блокировать бота.
     """
-    items = get_items_from_db()
+    items = get_items_from_db(message.from_user.id)
     if not items:
         await message.answer(
             "❌ В вашем портфеле пока нет предметов. Добавьте их, чтобы построить график."
@@ -2264,13 +4771,13 @@ async def history_cmd(message: Message):
         return
 
     # 1. Сбор данных для графика
-    history = get_portfolio_history()
+    history = get_portfolio_history(message.from_user.id)
     dates = []
     values = []
 
     if not history:
         # Если истории еще нет, строим график только с одной точкой - общей ценой закупки
-        total_buy_price = get_total_buy_price()
+        total_buy_price = get_total_buy_price(message.from_user.id)
         await message.answer(
             f"❌ Пока нет данных для графика. Добавьте предметы и вызовите отчет '📊 Портфель', чтобы сохранить первую точку истории. \n\n Текущая общая цена закупки: {total_buy_price:,.2f}₴"
         )
@@ -2280,158 +4787,169 @@ async def history_cmd(message: Message):
         dates.append(datetime.fromisoformat(row[0]))
         values.append(row[1])
 
-    # --- 2. Стилизация графика 1в1 как в Steam Market ---
-    plt.style.use('dark_background')
-    fig = plt.figure(figsize=(14, 10), facecolor='#1b2838')
-
-    # Расчет статистики для заголовка - инициализируем переменные по умолчанию
-    price_change = 0.0
-    price_change_pct = 0.0
-    min_price = 0.0
-    max_price = 0.0
-    avg_price = 0.0
-    change_color = '#c7d5e0'
-    change_symbol = ''
+    await job.progress("📈 Строю график...")
+    png = await asyncio.to_thread(render_history_chart, dates, values)
+
+    await message.answer_photo(
+        photo=BufferedInputFile(png, filename="portfolio_graph.png"),
+        caption=
+        "📈 Вот твой красивый график портфеля! Точки - стоимость портфеля при каждом пересчете оценки: "
+        "после обновления цен или изменения предметов и при фоновом обновлении."
+    )
+
+
+@traced("render history_chart")
+def render_history_chart(dates, values):
+    """Рисует график стоимости портфеля в стиле Steam Market и возвращает PNG."""
+    # pyplot хранит глобальное состояние, поэтому одновременно рисует только один поток
+    with pyplot_lock:
+        # --- 2. Стилизация графика 1в1 как в Steam Market ---
+        plt = get_pyplot()
+        DateFormatter = lazy_import('matplotlib.dates').DateFormatter
+        FuncFormatter = lazy_import('matplotlib.ticker').FuncFormatter
+        plt.style.use('dark_background')
+        fig = plt.figure(figsize=(14, 10), facecolor='#1b2838')
+
+        # Расчет статистики для заголовка - инициализируем переменные по умолчанию
+        price_change = 0.0
+        price_change_pct = 0.0
+        min_price = 0.0
+        max_price = 0.0
+        avg_price = 0.0
+        change_color = '#c7d5e0'
+        change_symbol = ''
     
-    if len(values) > 1:
-        price_change = values[-1] - values[0]
-        price_change_pct = (price_change /
-                            values[0]) * 100 if values[0] != 0 else 0
-        min_price = min(values)
-        max_price = max(values)
-        avg_price = sum(values) / len(values)
-        change_color = '#90c53f' if price_change >= 0 else '#d75f36'
-        change_symbol = '+' if price_change >= 0 else ''
-
-    # Создаем верхнюю область для статистики
-    text_color = '#c7d5e0'
-
-    # Заголовок
-    fig.text(0.08,
-             0.95,
-             "Стоимость портфеля CS2",
-             fontsize=18,
-             color=text_color,
-             fontweight='bold')
-
-    if len(values) > 1:
-        # Изменение цены справа
-        fig.text(
-            0.92,
-            0.95,
-            f"Изменение: {change_symbol}{price_change:,.2f}₴ ({price_change_pct:+.1f}%)",
-            fontsize=14,
-            color=change_color,
-            fontweight='bold',
-            ha='right')
-
-        # Статистика в одну строку
-        stats_text = f"Текущая: {values[-1]:,.2f}₴  •  Максимум: {max_price:,.2f}₴  •  Минимум: {min_price:,.2f}₴  •  Средняя: {avg_price:,.2f}₴"
-        fig.text(0.08, 0.90, stats_text, fontsize=11, color=text_color)
-
-    # Создаем основную область графика
-    ax = fig.add_subplot(111)
-    ax.set_position((0.08, 0.12, 0.84, 0.75))  # [left, bottom, width, height]
-    ax.set_facecolor('#1b2838')
-
-    # Точные цвета Steam Market
-    line_color = '#66c0f4'  # Синий цвет Steam
-    fill_color = '#4c6b22'  # Зеленый для заливки
-    grid_color = '#316282'
-
-    # Убираем рамки как в Steam
-    for spine in ax.spines.values():
-        spine.set_visible(False)
-
-    # Сетка как в Steam - только горизонтальные линии
-    ax.grid(True,
-            axis='y',
-            linestyle='-',
-            linewidth=0.5,
-            color=grid_color,
-            alpha=0.6)
-    ax.set_axisbelow(True)
-
-    # Настройки тиков
-    ax.tick_params(axis='both', colors=text_color, labelsize=10)
-    ax.tick_params(axis='x', length=0)  # Убираем тики на оси X
-    ax.tick_params(axis='y', length=0)  # Убираем тики на оси Y
-
-    # Форматирование оси X с умным выбором интервалов
-    if len(dates) > 20:
-        formatter = DateFormatter('%d.%m')
-    elif len(dates) > 7:
-        formatter = DateFormatter('%d.%m\n%H:%M')
-    else:
-        formatter = DateFormatter('%d %b\n%H:%M')
-
-    ax.xaxis.set_major_formatter(formatter)
-
-    # Заливка области под графиком (градиент эффект)
-    ax.fill_between(dates, values, color=fill_color, alpha=0.3, zorder=1)
-    ax.fill_between(dates, values, color=line_color, alpha=0.1, zorder=2)
-
-    # Основная линия графика
-    ax.plot(dates,
-            values,
-            color=line_color,
-            linewidth=2.5,
-            zorder=5,
-            solid_capstyle='round')
-
-    # Точки на концах и важных моментах
-    if len(dates) <= 10:
-        ax.scatter(dates,
-                   values,
-                   color=line_color,
-                   s=35,
-                   zorder=10,
-                   edgecolors='white',
-                   linewidth=1)
-    else:
-        # Только первая и последняя точка если много данных
-        ax.scatter([dates[0], dates[-1]], [values[0], values[-1]],
-                   color=line_color,
-                   s=40,
-                   zorder=10,
-                   edgecolors='white',
-                   linewidth=1.5)
-
-    # Подсветка текущего значения
-    if dates and values:
-        # Вертикальная линия к последней точке
-        ax.axvline(x=dates[-1],
-                   color=text_color,
-                   linestyle='--',
-                   alpha=0.3,
-                   linewidth=1)
-
-        # Горизонтальная линия текущей цены
-        ax.axhline(y=values[-1],
-                   color=line_color,
-                   linestyle='--',
-                   alpha=0.4,
-                   linewidth=1)
-
-    # Форматирование осей
-    ax.yaxis.set_major_formatter(FuncFormatter(lambda x, p: f'{x:,.0f}₴'))
-
-    # Поворот меток X если нужно
-    if len(dates) > 10:
-        plt.xticks(rotation=45, ha='right')
-
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=200)
-    buf.seek(0)
+        if len(values) > 1:
+            price_change = values[-1] - values[0]
+            price_change_pct = (price_change /
+                                values[0]) * 100 if values[0] != 0 else 0
+            min_price = min(values)
+            max_price = max(values)
+            avg_price = sum(values) / len(values)
+            change_color = '#90c53f' if price_change >= 0 else '#d75f36'
+            change_symbol = '+' if price_change >= 0 else ''
+
+        # Создаем верхнюю область для статистики
+        text_color = '#c7d5e0'
+
+        # Заголовок
+        fig.text(0.08,
+                 0.95,
+                 "Стоимость портфеля CS2",
+                 fontsize=18,
+                 color=text_color,
+                 fontweight='bold')
+
+        if len(values) > 1:
+            # Изменение цены справа
+            fig.text(
+                0.92,
+                0.95,
+                f"Изменение: {change_symbol}{price_change:,.2f}₴ ({price_change_pct:+.1f}%)",
+                fontsize=14,
+                color=change_color,
+                fontweight='bold',
+                ha='right')
+
+            # Статистика в одну строку
+            stats_text = f"Текущая: {values[-1]:,.2f}₴  •  Максимум: {max_price:,.2f}₴  •  Минимум: {min_price:,.2f}₴  •  Средняя: {avg_price:,.2f}₴"
+            fig.text(0.08, 0.90, stats_text, fontsize=11, color=text_color)
+
+        # Создаем основную область графика
+        ax = fig.add_subplot(111)
+        ax.set_position((0.08, 0.12, 0.84, 0.75))  # [left, bottom, width, height]
+        ax.set_facecolor('#1b2838')
+
+        # Точные цвета Steam Market
+        line_color = '#66c0f4'  # Синий цвет Steam
+        fill_color = '#4c6b22'  # Зеленый для заливки
+        grid_color = '#316282'
+
+        # Убираем рамки как в Steam
+        for spine in ax.spines.values():
+            spine.set_visible(False)
+
+        # Сетка как в Steam - только горизонтальные линии
+        ax.grid(True,
+                axis='y',
+                linestyle='-',
+                linewidth=0.5,
+                color=grid_color,
+                alpha=0.6)
+        ax.set_axisbelow(True)
+
+        # Настройки тиков
+        ax.tick_params(axis='both', colors=text_color, labelsize=10)
+        ax.tick_params(axis='x', length=0)  # Убираем тики на оси X
+        ax.tick_params(axis='y', length=0)  # Убираем тики на оси Y
+
+        # Форматирование оси X с умным выбором интервалов
+        if len(dates) > 20:
+            formatter = DateFormatter('%d.%m')
+        elif len(dates) > 7:
+            formatter = DateFormatter('%d.%m\n%H:%M')
+        else:
+            formatter = DateFormatter('%d %b\n%H:%M')
+
+        ax.xaxis.set_major_formatter(formatter)
+
+        # Заливка области под графиком (градиент эффект)
+        ax.fill_between(dates, values, color=fill_color, alpha=0.3, zorder=1)
+        ax.fill_between(dates, values, color=line_color, alpha=0.1, zorder=2)
+
+        # Основная линия графика
+        ax.plot(dates,
+                values,
+                color=line_color,
+                linewidth=2.5,
+                zorder=5,
+                solid_capstyle='round')
+
+        # Точки на концах и важных моментах
+        if len(dates) <= 10:
+            ax.scatter(dates,
+                       values,
+                       color=line_color,
+                       s=35,
+                       zorder=10,
+                       edgecolors='white',
+                       linewidth=1)
+        else:
+            # Только первая и последняя точка если много данных
+            ax.scatter([dates[0], dates[-1]], [values[0], values[-1]],
+                       color=line_color,
+                       s=40,
+                       zorder=10,
+                       edgecolors='white',
+                       linewidth=1.5)
+
+        # Подсветка текущего значения
+        if dates and values:
+            # Вертикальная линия к последней точке
+            ax.axvline(x=dates[-1],
+                       color=text_color,
+                       linestyle='--',
+                       alpha=0.3,
+                       linewidth=1)
+
+            # Горизонтальная линия текущей цены
+            ax.axhline(y=values[-1],
+                       color=line_color,
+                       linestyle='--',
+                       alpha=0.4,
+                       linewidth=1)
+
+        # Форматирование осей
+        ax.yaxis.set_major_formatter(FuncFormatter(lambda x, p: f'{x:,.0f}₴'))
 
-    await message.answer_photo(
-        photo=BufferedInputFile(buf.getvalue(),
-                                filename="portfolio_graph.png"),
-        caption=
-        "📈 Вот твой красивый график портфеля! Каждая точка - это вызов отчета '📊 Портфель'."
-    )
+        # Поворот меток X если нужно
+        if len(dates) > 10:
+            plt.xticks(rotation=45, ha='right')
 
-    plt.close(fig)
+        buf = io.BytesIO()
+        plt.savefig(buf, format='png', dpi=200)
+        plt.close(fig)
+        return buf.getvalue()
 
 
 # --- ОБРАБОТЧИКИ ОТСЛЕЖИВАНИЯ ЦЕН ---
@@ -2450,7 +4968,23 @@ async def track_price_name(message: Message, state: FSMContext):
     """Обработчик ввода названия предмета для отслеживания."""
     if not message.text:
         return
-    item_name = message.text.strip()
+    # Название сверяется с каталогом рынка, иначе уведомление никогда не сработает
+    item_name = await suggest_catalog_names(message, state, message.text.strip(), "alert_pick_")
+    if item_name:
+        await set_alert_item(message, state, item_name)
+
+
+@router.callback_query(lambda c: (c.data or "").startswith("alert_pick_"),
+                       StateFilter(PriceAlertState.waiting_for_item_name))
+async def alert_pick_callback(callback: CallbackQuery, state: FSMContext):
+    """Выбор предмета для уведомления из подсказок."""
+    item_name = await pop_suggestion(callback, state)
+    if item_name:
+        await set_alert_item(callback.message, state, item_name)
+
+
+async def set_alert_item(message: Message, state: FSMContext, item_name):
+    """Запоминает предмет уведомления и запрашивает целевую цену."""
     await state.update_data(item_name=item_name)
     await state.set_state(PriceAlertState.waiting_for_target_price)
 
@@ -2785,9 +5319,22 @@ async def process_watchlist_item(message: Message, state: FSMContext):
     """Обработчик добавления предмета в список отслеживания."""
     if not message.text:
         return
-    item_name = message.text.strip()
-    user_id = message.from_user.id
+    item_name = await suggest_catalog_names(message, state, message.text.strip(), "watch_pick_")
+    if item_name:
+        await add_watchlist_item(message, state, message.from_user.id, item_name)
 
+
+@router.callback_query(lambda c: (c.data or "").startswith("watch_pick_"),
+                       StateFilter(NotificationSettingsState.waiting_for_watchlist_item))
+async def watch_pick_callback(callback: CallbackQuery, state: FSMContext):
+    """Выбор предмета для списка отслеживания из подсказок."""
+    item_name = await pop_suggestion(callback, state)
+    if item_name:
+        await add_watchlist_item(callback.message, state, callback.from_user.id, item_name)
+
+
+async def add_watchlist_item(message: Message, state: FSMContext, user_id, item_name):
+    """Добавляет предмет из каталога в список отслеживания пользователя с текущей ценой."""
     # Проверяем, что предмет существует и получаем его цену
     current_usd, _ = await get_current_prices_and_steam(item_name)
 
@@ -2810,6 +5357,119 @@ async def process_watchlist_item(message: Message, state: FSMContext):
     await state.clear()
 
 
+# --- INLINE-РЕЖИМ ---
+# Ответы строятся только из кэшей прайс-листов и индекса каталога: ни одного запроса к рынкам на нажатие клавиши.
+def inline_item_token(name):
+    """Короткий стабильный идентификатор предмета для deep link (параметр /start - до 64 символов)."""
+    return hashlib.md5(name.encode()).hexdigest()[:12]
+
+
+async def resolve_inline_item_token(token):
+    """market_hash_name по токену; после перезапуска бота токен ищется перебором каталога."""
+    name = inline_item_tokens.get(token)
+    if name is None:
+        await fetch_marketcsgo_prices()
+        name = next((name for name in market_item_names.values() if inline_item_token(name) == token), None)
+    return name
+
+
+def refresh_catalog_in_background():
+    """Обновляет устаревшие прайс-листы в фоне; inline-запрос это обновление не ждет."""
+    global catalog_refresh_task
+    if catalog_refresh_task is not None and not catalog_refresh_task.done():
+        return
+    if market_item_names and not should_update_cache():
+        return
+
+    async def refresh():
+        await asyncio.gather(fetch_marketcsgo_prices(), fetch_skinport_prices(), return_exceptions=True)
+
+    catalog_refresh_task = asyncio.create_task(refresh())
+
+
+def build_inline_result(name, bot_username):
+    """Результат inline-запроса: цены MarketCSGO и Skinport из кэша и кнопки добавления и отслеживания."""
+    prices = [(source, cache.get(name.lower())) for source, cache in
+              (("MarketCSGO", marketcsgo_prices_cache), ("Skinport", skinport_prices_cache))]
+    prices = [(source, price) for source, price in prices if price]
+    description = " · ".join(f"{source} {price:,.2f}$" for source, price in prices) or "Нет цены на рынках"
+    lines = [f"<b>{html.escape(name)}</b>"]
+    lines += [f"💰 {source}: {price:,.2f}$ ({price * USD_TO_UAH:,.0f}₴)" for source, price in prices]
+
+    token = inline_item_token(name)
+    inline_item_tokens[token] = name
+    kb = [[
+        InlineKeyboardButton(text="➕ В портфель", url=f"https://t.me/{bot_username}?start=add_{token}"),
+        InlineKeyboardButton(text="🔔 Следить за ценой", url=f"https://t.me/{bot_username}?start=track_{token}"),
+    ]]
+    return InlineQueryResultArticle(
+        id=token,
+        title=name,
+        description=description,
+        input_message_content=InputTextMessageContent(message_text="\n".join(lines)),
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
+
+
+@router.inline_query()
+async def inline_item_lookup(inline_query: InlineQuery):
+    """Inline-поиск предметов по каталогу рынка с текущими ценами."""
+    refresh_catalog_in_background()
+    query = item_search_key(inline_query.query)
+    if not market_item_names or len(query) < 2:
+        await inline_query.answer([], cache_time=INLINE_EMPTY_CACHE_SECONDS)
+        return
+
+    # Одинаковые запросы разных пользователей отвечаются готовыми результатами до обновления цен
+    key = (query, prices_version)
+    results = inline_results_cache.get(key)
+    if results is None:
+        index = await get_item_name_index()
+        bot_username = (await bot.me()).username
+        results = [build_inline_result(name, bot_username) for name in index.search(query, limit=INLINE_RESULTS_LIMIT)]
+        inline_results_cache.set(key, results)
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME_SECONDS, is_personal=False)
+
+
+async def open_inline_deep_link(message: Message, state: FSMContext, payload):
+    """Кнопки inline-результата: add_<токен> - добавить в портфель, track_<токен> - уведомление о цене."""
+    action, _, token = payload.partition("_")
+    item_name = await resolve_inline_item_token(token) if action in ("add", "track") else None
+    if not item_name:
+        await message.answer("❌ Предмет не найден. Найди его заново через inline-поиск.",
+                             reply_markup=get_main_keyboard())
+        return
+    await state.clear()
+    if action == "track":
+        await set_alert_item(message, state, item_name)
+        return
+    await state.set_state(QuickAddState.waiting_for_details)
+    await state.update_data(item_name=item_name)
+    await message.answer(f"➕ Предмет: <b>{item_name}</b>\n\n"
+                         "Напиши количество и цену закупки за штуку в гривнах через запятую:\n\n"
+                         "Пример: <code>2, 1500</code>\n🚫 Отправь /cancel для отмены")
+
+
+@router.message(StateFilter(QuickAddState.waiting_for_details))
+async def quick_add_details(message: Message, state: FSMContext):
+    """Количество и цена закупки предмета, выбранного в inline-режиме."""
+    try:
+        qty_str, price_str = [p.strip() for p in (message.text or "").split(",")]
+        qty = int(qty_str)
+        price = float(price_str)
+    except ValueError:
+        await message.answer("❌ Неверный формат. Напиши количество и цену через запятую: <code>2, 1500</code>")
+        return
+    if qty <= 0 or price <= 0:
+        await message.answer("⚠️ Количество и цена должны быть больше 0.")
+        return
+
+    data = await state.get_data()
+    add_item_to_db(message.from_user.id, data['item_name'], qty, price)
+    await state.clear()
+    await message.answer(f"✅ Предмет <b>{data['item_name']}</b> добавлен в портфель!",
+                         reply_markup=get_main_keyboard())
+
+
 # --- НОВЫЕ ФУНКЦИИ ДЛЯ РАСШИРЕННЫХ УВЕДОМЛЕНИЙ ---
 
 
@@ -2941,9 +5601,8 @@ async def check_individual_price_changes():
             portfolio_items = []
             watchlist_items = []
 
-            # Портфель пользователя (если у нас есть данные по пользователю)
-            items = get_items_from_db(
-            )  # Получаем все предметы (в текущей версии база общая)
+            # Только предметы портфеля этого пользователя
+            items = get_items_from_db(user_id)
 
             # Список отслеживания пользователя
             watchlist = get_user_watchlist(user_id)
@@ -3048,22 +5707,29 @@ async def check_individual_price_changes():
 
 
 def should_update_cache():
-    global last_cache_update
     return last_cache_update is None or (datetime.now() -
                                          last_cache_update) >= CACHE_TTL
 
 
 async def check_and_notify():
-    """Проверяет изменения портфеля и отправляет уведомления."""
+    """Проверяет изменения портфелей подписанных пользователей и отправляет уведомления."""
     logging.info("Проверка изменений портфеля...")
 
-    items = get_items_from_db()
+    await fetch_marketcsgo_prices()
+
+    for user_id in get_subscribed_users():
+        try:
+            await check_and_notify_user(user_id)
+        except Exception as e:
+            logging.error(f"Ошибка проверки портфеля пользователя {user_id}: {e}")
+
+
+async def check_and_notify_user(user_id):
+    """Сравнивает стоимость портфеля пользователя с последней известной и уведомляет при большом изменении."""
+    items = get_items_from_db(user_id)
     if not items:
-        logging.info("Портфель пуст, уведомления не отправляются.")
         return
 
-    await fetch_marketcsgo_prices()
-
     total_now_uah = 0.0
 
     for item_id, name, qty, buy_price_uah, buy_price_usd in items:
@@ -3076,7 +5742,7 @@ async def check_and_notify():
             # Если цена недоступна, используем закупочную
             total_now_uah += buy_price_uah * qty
 
-    last_value = get_last_known_value()
+    last_value = get_last_known_value(user_id)
 
     if last_value is not None and last_value != 0:
         change_pct = ((total_now_uah - last_value) / last_value) * 100
@@ -3091,25 +5757,36 @@ async def check_and_notify():
             message_text += f"\n\nТекущая стоимость: {total_now_uah:,.2f}₴"
             message_text += f"\nПоследняя стоимость: {last_value:,.2f}₴"
 
-            users = get_subscribed_users()
-            for user_id in users:
-                try:
-                    await bot.send_message(user_id, message_text)
-                except Exception as e:
-                    logging.error(
-                        f"Не удалось отправить уведомление пользователю {user_id}: {e}"
-                    )
+            try:
+                await bot.send_message(user_id, message_text)
+            except Exception as e:
+                logging.error(
+                    f"Не удалось отправить уведомление пользователю {user_id}: {e}"
+                )
+
+    save_last_known_value(user_id, total_now_uah)
 
-    save_last_known_value(total_now_uah)
 
+async def check_price_alerts(item_names=None):
+    """
+    Проверяет активные уведомления о ценах и отправляет сообщения, если условия выполнены.
+    item_names - проверить только эти предметы по уже загруженному прайс-листу (без его обновления).
+    """
+    # Уведомления сравниваются с ценой MarketCSGO, цена Steam здесь не нужна
+    if item_names is None:
+        await fetch_marketcsgo_prices()
+    async with price_alerts_lock:
+        await notify_price_alerts(item_names)
 
-async def check_price_alerts():
-    """Проверяет активные уведомления о ценах и отправляет сообщения, если условия выполнены."""
 
+async def notify_price_alerts(item_names):
+    """Отправляет сработавшие уведомления (вызывается под price_alerts_lock)."""
     alerts = get_all_price_alerts()
+    if item_names is not None:
+        wanted = {name.lower() for name in item_names}
+        alerts = [alert for alert in alerts if alert[2].lower() in wanted]
     for alert_id, user_id, item_name, target_price, direction in alerts:
-        marketcsgo_usd, steam_usd = await get_current_prices_and_steam(
-            item_name)
+        marketcsgo_usd = marketcsgo_prices_cache.get(item_name.lower())
 
         if marketcsgo_usd is None:
             continue
@@ -3137,17 +5814,24 @@ async def check_price_alerts():
                 )
 
 
-async def generate_portfolio_chart():
-    """Генерирует график стоимости портфеля с мультиисточниками."""
+async def generate_portfolio_chart(user_id):
+    """Генерирует график стоимости портфеля с мультиисточниками (в рабочем потоке)."""
+    return await asyncio.to_thread(render_portfolio_chart, user_id)
+
+
+@traced("render portfolio_chart")
+def render_portfolio_chart(user_id):
+    """Рисует график стоимости портфеля с мультиисточниками и возвращает буфер PNG."""
     try:
         # Получаем историю портфеля
         with get_db_cursor() as (cur, _):
             cur.execute("""
                 SELECT timestamp, value_uah 
                 FROM portfolio_history 
+                WHERE user_id = ?
                 ORDER BY timestamp 
                 LIMIT 100
-            """)
+            """, (user_id, ))
             history = cur.fetchall()
         
         if len(history) < 2:
@@ -3157,79 +5841,82 @@ async def generate_portfolio_chart():
         timestamps = [datetime.fromisoformat(row[0]) for row in history]
         values_uah = [float(row[1]) for row in history]
         
-        # Создаем график
-        plt.figure(figsize=(12, 8))
-        ax = plt.gca()
+        # Создаем график (pyplot - по одному потоку за раз)
+        with pyplot_lock:
+            plt = get_pyplot()
+            FuncFormatter = lazy_import('matplotlib.ticker').FuncFormatter
+            plt.figure(figsize=(12, 8))
+            ax = plt.gca()
         
-        # Основная линия портфеля
-        ax.plot([t for t in timestamps], values_uah, 
-               color='#2E86AB', linewidth=2.5, 
-               label='Портфель (общая стоимость)', marker='o', markersize=3)
+            # Основная линия портфеля
+            ax.plot([t for t in timestamps], values_uah, 
+                   color='#2E86AB', linewidth=2.5, 
+                   label='Портфель (общая стоимость)', marker='o', markersize=3)
         
-        # Получаем данные по Steam ценам если доступны
-        items = get_items_from_db()
-        if items and len(timestamps) > 1:
-            steam_values = []
-            marketcsgo_values = []
+            # Получаем данные по Steam ценам если доступны
+            items = get_items_from_db(user_id)
+            if items and len(timestamps) > 1:
+                steam_values = []
+                marketcsgo_values = []
             
-            # Рассчитываем приблизительные значения Steam и MarketCSGO
-            for i, timestamp in enumerate(timestamps):
-                steam_total = 0
-                marketcsgo_total = 0
+                # Рассчитываем приблизительные значения Steam и MarketCSGO
+                for i, timestamp in enumerate(timestamps):
+                    steam_total = 0
+                    marketcsgo_total = 0
                 
-                for _, name, qty, buy_uah, buy_usd in items:
-                    # Получаем цены из кэша если доступны
-                    price_data = multisource_prices_cache.get(name, {})
-                    steam_price = price_data.get('steam')
-                    sources = price_data.get('sources', {})
-                    marketcsgo_price = sources.get('marketcsgo')
+                    for _, name, qty, buy_uah, buy_usd in items:
+                        # Получаем цены из кэша если доступны
+                        price_data = multisource_prices_cache.get(name, {})
+                        steam_price = price_data.get('steam')
+                        sources = price_data.get('sources', {})
+                        marketcsgo_price = sources.get('marketcsgo')
                     
-                    if steam_price:
-                        steam_total += steam_price * USD_TO_UAH * qty
-                    if marketcsgo_price:
-                        marketcsgo_total += marketcsgo_price * USD_TO_UAH * qty
+                        if steam_price:
+                            steam_total += steam_price * USD_TO_UAH * qty
+                        if marketcsgo_price:
+                            marketcsgo_total += marketcsgo_price * USD_TO_UAH * qty
                 
-                steam_values.append(steam_total if steam_total > 0 else values_uah[i])
-                marketcsgo_values.append(marketcsgo_total if marketcsgo_total > 0 else values_uah[i])
+                    steam_values.append(steam_total if steam_total > 0 else values_uah[i])
+                    marketcsgo_values.append(marketcsgo_total if marketcsgo_total > 0 else values_uah[i])
             
-            # Добавляем дополнительные линии если есть данные
-            if any(v > 0 for v in steam_values):
-                ax.plot([t for t in timestamps], steam_values, 
-                       color='#FF6B35', linewidth=2, alpha=0.8,
-                       label='Steam цены', linestyle='--')
+                # Добавляем дополнительные линии если есть данные
+                if any(v > 0 for v in steam_values):
+                    ax.plot([t for t in timestamps], steam_values, 
+                           color='#FF6B35', linewidth=2, alpha=0.8,
+                           label='Steam цены', linestyle='--')
             
-            if any(v > 0 for v in marketcsgo_values):
-                ax.plot([t for t in timestamps], marketcsgo_values,
-                       color='#A23B72', linewidth=2, alpha=0.8, 
-                       label='MarketCSGO цены', linestyle=':')
+                if any(v > 0 for v in marketcsgo_values):
+                    ax.plot([t for t in timestamps], marketcsgo_values,
+                           color='#A23B72', linewidth=2, alpha=0.8, 
+                           label='MarketCSGO цены', linestyle=':')
         
-        # Настройка графика
-        ax.set_title('📈 История стоимости портфеля', fontsize=16, fontweight='bold', pad=20)
-        ax.set_xlabel('Время', fontsize=12)
-        ax.set_ylabel('Стоимость портфеля (₴)', fontsize=12)
+            # Настройка графика
+            ax.set_title('📈 История стоимости портфеля', fontsize=16, fontweight='bold', pad=20)
+            ax.set_xlabel('Время', fontsize=12)
+            ax.set_ylabel('Стоимость портфеля (₴)', fontsize=12)
         
-        # Форматирование осей
-        ax.yaxis.set_major_formatter(FuncFormatter(lambda x, p: f'{x:,.0f}₴'))
+            # Форматирование осей
+            ax.yaxis.set_major_formatter(FuncFormatter(lambda x, p: f'{x:,.0f}₴'))
         
-        # Поворот меток X если нужно
-        if len(timestamps) > 10:
-            plt.xticks(rotation=45, ha='right')
+            # Поворот меток X если нужно
+            if len(timestamps) > 10:
+                plt.xticks(rotation=45, ha='right')
         
-        # Сетка и легенда
-        ax.grid(True, alpha=0.3, linestyle='-', linewidth=0.5)
-        ax.legend(loc='upper left', framealpha=0.9)
+            # Сетка и легенда
+            ax.grid(True, alpha=0.3, linestyle='-', linewidth=0.5)
+            ax.legend(loc='upper left', framealpha=0.9)
         
-        # Настройка макета
-        plt.tight_layout()
+            # Настройка макета
+            plt.tight_layout()
         
-        # Сохраняем в буфер
-        buffer = io.BytesIO()
-        plt.savefig(buffer, format='png', dpi=150, bbox_inches='tight', 
-                   facecolor='white', edgecolor='none')
-        buffer.seek(0)
-        plt.close()
+            # Сохраняем в буфер
+            buffer = io.BytesIO()
+            plt.savefig(buffer, format='png', dpi=150, bbox_inches='tight', 
+                       facecolor='white', edgecolor='none')
+            buffer.seek(0)
+            plt.close()
         
-        return buffer
+            return buffer
         
     except Exception as e:
         logging.error(f"Ошибка генерации графика: {e}")
@@ -3238,36 +5925,40 @@ async def generate_portfolio_chart():
 async def update_background_charts():
     """Обновляет графики в фоне каждые 10 минут."""
     try:
-        items = get_items_from_db()
-        if not items:
-            return
-            
-        # Получаем текущие цены и сохраняем значение портфеля
-        total_value = 0
-        for _, name, qty, buy_uah, buy_usd in items:
-            try:
-                # Пытаемся получить цену из кэша или API
-                await fetch_marketcsgo_prices()
-                price_usd = marketcsgo_prices_cache.get(name.lower())
-                if price_usd:
-                    total_value += price_usd * USD_TO_UAH * qty
-                else:
-                    # Fallback к цене закупки
-                    total_value += buy_uah * qty
-            except Exception as e:
-                logging.warning(f"Ошибка получения цены для {name}: {e}")
-                total_value += buy_uah * qty
-        
-        # Сохраняем значение в историю
-        if total_value > 0:
-            save_portfolio_value(total_value)
-            logging.info(f"Фоновое обновление: стоимость портфеля {total_value:,.0f}₴")
-        
-        # Сохраняем снимок для анализа изменений
-        save_portfolio_snapshot()
-        
+        # Прайс-лист один на всех пользователей
+        await fetch_marketcsgo_prices()
     except Exception as e:
-        logging.error(f"Ошибка фонового обновления графиков: {e}")
+        logging.warning(f"Ошибка обновления прайс-листа MarketCSGO: {e}")
+
+    for user_id in get_portfolio_owners():
+        try:
+            update_user_portfolio_history(user_id)
+        except Exception as e:
+            logging.error(f"Ошибка фонового обновления графиков пользователя {user_id}: {e}")
+
+
+def update_user_portfolio_history(user_id):
+    """Сохраняет текущую стоимость и снимок портфеля пользователя по кэшу MarketCSGO."""
+    items = get_items_from_db(user_id)
+    if not items:
+        return
+
+    # Текущие цены из кэша, при отсутствии цены - цена закупки
+    total_value = 0
+    for _, name, qty, buy_uah, buy_usd in items:
+        price_usd = marketcsgo_prices_cache.get(name.lower())
+        if price_usd:
+            total_value += price_usd * USD_TO_UAH * qty
+        else:
+            total_value += buy_uah * qty
+
+    # Сохраняем значение в историю
+    if total_value > 0:
+        save_portfolio_value(user_id, total_value)
+        logging.info(f"Фоновое обновление: стоимость портфеля пользователя {user_id} {total_value:,.0f}₴")
+
+    # Сохраняем снимок для анализа изменений
+    save_portfolio_snapshot(user_id)
 
 async def keep_bot_alive():
     """Поддерживает бота активным, пингуя собственный URL."""
@@ -3298,21 +5989,633 @@ async def keep_bot_alive():
         logging.warning(f"Ошибка keep-alive: {e}")
 
 
+class ScheduledJob:
+    """
+    Фоновая задача планировщика с бюджетом времени и зависимостями.
+    Перед запуском выполняются зависимости (например, обновление прайс-листа перед задачами, которые его читают);
+    если зависимость уже выполняется по своему расписанию или для другой задачи, к ней присоединяются,
+    а не запускают второй раз. Бюджет времени задачи берется из SCHEDULER_JOB_BUDGETS.
+    """
+
+    def __init__(self, func, depends_on=()):
+        self.func = timed_job(func)
+        self.name = func.__name__
+        self.budget = SCHEDULER_JOB_BUDGETS[self.name]
+        self.depends_on = depends_on
+        self.task = None
+
+    async def run(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        # shield: отмена одного ожидающего не прерывает задачу для остальных
+        await asyncio.shield(self.task)
+
+    async def _run(self):
+        for dependency in self.depends_on:
+            try:
+                await dependency.run()
+            except Exception as e:
+                logging.warning(f"Зависимость {dependency.name} задачи {self.name} завершилась с ошибкой: {e}")
+        try:
+            await asyncio.wait_for(self.func(), self.budget)
+        except asyncio.TimeoutError:
+            job_timeouts.inc(self.name)
+            logging.warning(f"Фоновая задача {self.name} прервана: превышен бюджет {self.budget} с")
+        except Exception as e:
+            logging.error(f"Ошибка фоновой задачи {self.name}: {e}")
+
+
 def start_scheduled_jobs():
     """Запускает фоновые задачи для уведомлений."""
-    scheduler.add_job(fetch_marketcsgo_prices, 'interval', minutes=30)
-    scheduler.add_job(check_and_notify, CronTrigger(hour='8-23/4'))
-    scheduler.add_job(check_price_alerts, CronTrigger(hour='*', minute='*/30'))
-    # Добавляем новую систему проверки индивидуальных изменений цен каждые 30 минут
-    scheduler.add_job(check_individual_price_changes, 'interval', minutes=30)
-    # Добавляем keep-alive каждые 10 минут
-    scheduler.add_job(keep_bot_alive, 'interval', minutes=10)
-    # Добавляем фоновое обновление графиков каждые 10 минут
-    scheduler.add_job(update_background_charts, 'interval', minutes=10)
+    global scheduler
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+    from apscheduler.triggers.cron import CronTrigger
+    from apscheduler.triggers.interval import IntervalTrigger
+
+    from apscheduler.events import EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED
+
+    # Один экземпляр каждой задачи; пропущенные запуски сливаются в один
+    scheduler = AsyncIOScheduler(job_defaults={
+        'max_instances': 1,
+        'coalesce': True,
+        'misfire_grace_time': SCHEDULER_MISFIRE_GRACE_SECONDS,
+    })
+
+    # Прайс-лист MarketCSGO обновляется перед задачами, которые его читают
+    prices = ScheduledJob(fetch_marketcsgo_prices)
+    planned_jobs = [
+        (prices, timedelta(minutes=30)),
+        (ScheduledJob(check_price_alerts, depends_on=(prices,)), timedelta(minutes=30)),
+        # Проверка индивидуальных изменений цен
+        (ScheduledJob(check_individual_price_changes, depends_on=(prices,)), timedelta(minutes=30)),
+        # Фоновое обновление графиков
+        (ScheduledJob(update_background_charts, depends_on=(prices,)), timedelta(minutes=10)),
+        (ScheduledJob(keep_bot_alive), timedelta(minutes=10)),
+        # Цены Steam по адаптивному плану в пределах бюджета запросов
+        (ScheduledJob(refresh_steam_prices), timedelta(minutes=1)),
+    ]
+    # Первые запуски сдвинуты друг относительно друга, а jitter разносит последующие,
+    # чтобы задачи с одинаковым периодом не стартовали одновременно
+    now = datetime.now()
+    for index, (job, interval) in enumerate(planned_jobs):
+        first_run = now + interval + timedelta(seconds=SCHEDULER_STAGGER_SECONDS * index)
+        # Разброс не больше доли периода: минутная задача не должна запускаться то через 0, то через 120 с
+        jitter = min(SCHEDULER_JITTER_SECONDS, interval.total_seconds() * SCHEDULER_JITTER_FRACTION)
+        trigger = IntervalTrigger(seconds=interval.total_seconds(), start_date=first_run, jitter=jitter)
+        scheduler.add_job(job.run, trigger, id=job.name, name=job.name)
+    notify = ScheduledJob(check_and_notify, depends_on=(prices,))
+    scheduler.add_job(notify.run, CronTrigger(hour='8-23/4', jitter=SCHEDULER_JITTER_SECONDS),
+                      id=notify.name, name=notify.name)
+
+    def count_skipped_job(event):
+        """Запуск пропущен: предыдущий еще выполняется (max_instances) или время запуска упущено."""
+        job = scheduler.get_job(event.job_id)
+        reason = "max_instances" if event.code == EVENT_JOB_MAX_INSTANCES else "missed"
+        job_skipped.inc(job.name if job else event.job_id, reason)
+
+    scheduler.add_listener(count_skipped_job, EVENT_JOB_MAX_INSTANCES | EVENT_JOB_MISSED)
     scheduler.start()
     logging.info("Фоновые задачи запущены.")
 
 
+# --- ВЕБ-СЕРВЕР MINI APP ---
+# aiohttp-приложение работает в том же event loop, что и бот, поэтому
+# обработчики читают те же кэши цен без потоков и блокировок.
+web_routes = web.RouteTableDef()
+
+
+@web_routes.get('/')
+async def home(request):
+    return web.Response(text="Bot is alive!")
+
+
+@web_routes.get('/webapp')
+async def webapp(request):
+    """Telegram Mini App страница."""
+    return web.FileResponse(os.path.join(TEMPLATES_DIR, "webapp.html"))
+
+
+def render_metrics():
+    """Все метрики в текстовом формате Prometheus: зарегистрированные счетчики и снимок текущих значений."""
+    lines = []
+    for metric in metrics_registry:
+        lines += metric.render()
+
+    caches = {
+        'item_prices': item_prices_cache,
+        'multisource_prices': multisource_prices_cache,
+        'report_valuations': report_valuations,
+        'report_fragments': report_fragments,
+        'portfolio_valuations': portfolio_valuations,
+        'api_responses': api_response_cache,
+    }
+    lines += render_metric_family("cache_hits_total", "counter", "Попадания в кэш",
+                                  [([('cache', name)], cache.hits) for name, cache in caches.items()])
+    lines += render_metric_family("cache_misses_total", "counter", "Промахи кэша",
+                                  [([('cache', name)], cache.misses) for name, cache in caches.items()])
+    lines += render_metric_family(
+        "cache_hit_ratio", "gauge", "Доля попаданий в кэш с запуска процесса",
+        [([('cache', name)], round(cache.hits / (cache.hits + cache.misses), 4) if cache.hits + cache.misses else 0)
+         for name, cache in caches.items()])
+    lines += render_metric_family("cache_entries", "gauge", "Записей в кэше",
+                                  [([('cache', name)], len(cache)) for name, cache in caches.items()])
+    lines += render_metric_family(
+        "price_list_requests_total", "counter", "Условные запросы прайс-листов: 304 (не изменился) и 200",
+        [([('result', 'not_modified')], conditional_get_stats['hits']),
+         ([('result', 'modified')], conditional_get_stats['misses'])])
+    lines += render_metric_family("telegram_api_calls_total", "counter", "Вызовы Telegram Bot API",
+                                  [([('method', name)], count) for name, count in sorted(telegram_api_calls.items())])
+    lines += render_metric_family("message_updates_total", "counter", "Правки сообщений, которые не ушли в API",
+                                  [([('result', name)], count) for name, count in message_update_stats.items()])
+    lines += render_metric_family("scheduler_jobs_running", "gauge", "Выполняющиеся запуски задач планировщика",
+                                  [([('job', name)], count) for name, count in sorted(running_scheduled_jobs.items())])
+    job_counts = {job_class: 0 for job_class in JOB_CLASS_LIMITS}
+    for job in jobs.jobs.values():
+        job_counts[job.job_class] = job_counts.get(job.job_class, 0) + 1
+    lines += render_metric_family("user_jobs_active", "gauge", "Активные долгие команды пользователей",
+                                  [([('job_class', name)], count) for name, count in job_counts.items()])
+    lines += render_metric_family("stream_subscribers", "gauge", "Открытые потоки SSE Mini App",
+                                  [([], len(stream_subscribers))])
+    lines += render_metric_family("event_loop_lag_last_seconds", "gauge", "Последнее измеренное опоздание event loop",
+                                  [([], round(event_loop_lag_last, 6))])
+    return "\n".join(lines) + "\n"
+
+
+@web_routes.get('/metrics')
+async def metrics(request):
+    """Метрики для Prometheus; при заданном METRICS_TOKEN нужен Bearer-токен."""
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}"):
+        return web.Response(status=401, text="Unauthorized")
+    return web.Response(body=render_metrics().encode(), headers={
+        'Content-Type': 'text/plain; version=0.0.4; charset=utf-8',
+        'Cache-Control': 'no-store'
+    })
+
+
+def verify_webapp_init_data(init_data):
+    """
+    Проверяет подпись initData Telegram Mini App (HMAC-SHA256 с ключом от токена бота).
+    Возвращает ID пользователя или None, если данные поддельные или устарели.
+    """
+    if not init_data or not API_TOKEN:
+        return None
+    fields = dict(parse_qsl(init_data, keep_blank_values=True))
+    received_hash = fields.pop('hash', '')
+    data_check_string = "\n".join(f"{key}={value}" for key, value in sorted(fields.items()))
+    secret_key = hmac.new(b"WebAppData", API_TOKEN.encode(), hashlib.sha256).digest()
+    expected_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected_hash, received_hash):
+        return None
+    try:
+        auth_date = datetime.fromtimestamp(int(fields.get('auth_date', 0)))
+        user_id = int(json.loads(fields.get('user', '{}'))['id'])
+    except (ValueError, KeyError, TypeError):
+        return None
+    if datetime.now() - auth_date > WEBAPP_AUTH_MAX_AGE:
+        return None
+    return user_id
+
+
+def get_api_user_id(request):
+    """
+    Пользователь Mini App по initData из заголовка X-Telegram-Init-Data
+    (или параметра initData - EventSource не умеет отправлять заголовки).
+    """
+    init_data = request.headers.get('X-Telegram-Init-Data') or request.query.get('initData', '')
+    return verify_webapp_init_data(init_data)
+
+
+def unauthorized():
+    """JSON-ответ 401 для запросов без подписи Telegram."""
+    return web.json_response({'error': 'Требуется авторизация Telegram Mini App'}, status=401)
+
+
+def get_portfolio_version(user_id):
+    """Версия данных портфеля пользователя: меняется при изменении предметов или цен."""
+    return (holdings_versions.get(user_id, 0), prices_version)
+
+
+def get_portfolio_valuation(user_id):
+    """
+    Оценка портфеля пользователя по кэшу MarketCSGO.
+    Пересчитывается только когда изменился его портфель или обновились цены.
+    """
+    version = get_portfolio_version(user_id)
+    cached = portfolio_valuations.get(user_id)
+    if cached and cached['version'] == version:
+        return cached
+
+    positions = []
+    category_stats = {}
+    total_buy_uah = 0
+    total_now_uah = 0
+
+    for item_id, name, qty, buy_uah, buy_usd in get_items_from_db(user_id):
+        pos_buy_uah = buy_uah * qty
+        current_price_usd = marketcsgo_prices_cache.get(name.lower())
+        pos_now_uah = current_price_usd * USD_TO_UAH * qty if current_price_usd else pos_buy_uah
+        category = get_item_category(name)
+
+        total_buy_uah += pos_buy_uah
+        total_now_uah += pos_now_uah
+        if category not in category_stats:
+            category_stats[category] = {'buy_uah': 0, 'now_uah': 0, 'count': 0}
+        category_stats[category]['buy_uah'] += pos_buy_uah
+        category_stats[category]['now_uah'] += pos_now_uah
+        category_stats[category]['count'] += qty
+
+        positions.append({
+            'id': item_id,
+            'name': name,
+            'category': category,
+            'quantity': qty,
+            'buyPriceUah': round(buy_uah, 2),
+            'currentPriceUsd': current_price_usd,
+            'valueUah': round(pos_now_uah, 2),
+            'profitUah': round(pos_now_uah - pos_buy_uah, 2),
+            'profitPercent': round((pos_now_uah - pos_buy_uah) / pos_buy_uah * 100, 2) if pos_buy_uah > 0 else 0
+        })
+
+    categories = [{
+        'category': category,
+        'count': values['count'],
+        'valueUah': round(values['now_uah'], 2),
+        'profitPercent': round((values['now_uah'] - values['buy_uah']) / values['buy_uah'] * 100, 2) if values['buy_uah'] > 0 else 0
+    } for category, values in sorted(category_stats.items(), key=lambda x: x[1]['now_uah'], reverse=True)]
+
+    valuation = {
+        'version': version,
+        'positions': positions,
+        'categories': categories,
+        'total_buy_uah': total_buy_uah,
+        'total_now_uah': total_now_uah
+    }
+    portfolio_valuations.set(user_id, valuation)
+    return valuation
+
+
+def format_portfolio_summary(valuation):
+    """Итоги портфеля в формате, который показывает Mini App."""
+    if not valuation['positions']:
+        return {
+            'totalValue': '0₴',
+            'totalItems': '0',
+            'totalProfit': '0₴',
+            'profitPercent': '0%'
+        }
+    total_buy_uah = valuation['total_buy_uah']
+    total_now_uah = valuation['total_now_uah']
+    total_profit_uah = total_now_uah - total_buy_uah
+    profit_pct = (total_profit_uah / total_buy_uah) * 100 if total_buy_uah > 0 else 0
+    return {
+        'totalValue': f'{total_now_uah:,.0f}₴',
+        'totalItems': str(len(valuation['positions'])),
+        'totalProfit': f'{total_profit_uah:+,.0f}₴',
+        'profitPercent': f'{profit_pct:+.1f}%'
+    }
+
+
+def get_cached_api_body(key, version, build):
+    """Возвращает готовое тело ответа (JSON, gzip, ETag); build() вызывается только при смене версии."""
+    cached = api_response_cache.get(key)
+    if cached and cached['version'] == version:
+        return cached
+
+    body = json.dumps(build(), ensure_ascii=False).encode('utf-8')
+    entry = {
+        'version': version,
+        'body': body,
+        'gzip': gzip.compress(body),
+        # Сильный ETag: хеш точных байтов ответа
+        'etag': '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+    }
+    api_response_cache.set(key, entry)
+    return entry
+
+
+def cached_json_response(request, entry):
+    """Отдаёт закэшированное тело с учётом If-None-Match и Accept-Encoding."""
+    headers = {
+        'ETag': entry['etag'],
+        'Cache-Control': API_CACHE_CONTROL,
+        'Vary': 'Accept-Encoding, X-Telegram-Init-Data'
+    }
+    if_none_match = request.headers.get('If-None-Match', '')
+    if if_none_match:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        if '*' in tags or entry['etag'] in tags:
+            return web.Response(status=304, headers=headers)
+
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        headers['Content-Encoding'] = 'gzip'
+        return web.Response(body=entry['gzip'], content_type='application/json', charset='utf-8', headers=headers)
+    return web.Response(body=entry['body'], content_type='application/json', charset='utf-8', headers=headers)
+
+
+def encode_cursor(value):
+    """Кодирует позицию пагинации в непрозрачный курсор."""
+    return base64.urlsafe_b64encode(str(value).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Декодирует курсор пагинации; пустой курсор - начало списка."""
+    if not cursor:
+        return None
+    padded = cursor + '=' * (-len(cursor) % 4)
+    return base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+
+
+def parse_page_params(request):
+    """Читает cursor и limit из запроса. Бросает ValueError при неверных значениях."""
+    limit = int(request.query.get('limit', API_PAGE_LIMIT_DEFAULT))
+    if limit <= 0:
+        raise ValueError("limit должен быть больше 0")
+    return request.query.get('cursor', ''), min(limit, API_PAGE_LIMIT_MAX)
+
+
+def bad_request(message):
+    """JSON-ответ 400 для неверных параметров API."""
+    return web.json_response({'error': message}, status=400)
+
+
+@web_routes.get('/api/portfolio')
+async def api_portfolio(request):
+    """API endpoint для получения данных портфеля."""
+    user_id = get_api_user_id(request)
+    if user_id is None:
+        return unauthorized()
+    try:
+        # Общий кэш MarketCSGO: при истёкшем TTL его обновит только один запрос
+        await fetch_marketcsgo_prices()
+
+        entry = get_cached_api_body(('portfolio', user_id), get_portfolio_version(user_id),
+                                    lambda: format_portfolio_summary(get_portfolio_valuation(user_id)))
+        return cached_json_response(request, entry)
+
+    except Exception as e:
+        logging.error(f"Ошибка в /api/portfolio: {e}")
+        return web.json_response({
+            'totalValue': 'Ошибка',
+            'totalItems': '0',
+            'totalProfit': 'Ошибка',
+            'profitPercent': 'Ошибка'
+        })
+
+
+@web_routes.get('/api/positions')
+async def api_positions(request):
+    """Позиции портфеля постранично. Курсор - ID последней отданной позиции."""
+    user_id = get_api_user_id(request)
+    if user_id is None:
+        return unauthorized()
+    try:
+        cursor, limit = parse_page_params(request)
+        after_id = int(decode_cursor(cursor) or 0)
+    except ValueError:
+        return bad_request("Неверный cursor или limit")
+
+    await fetch_marketcsgo_prices()
+
+    def build():
+        positions = [p for p in get_portfolio_valuation(user_id)['positions'] if p['id'] > after_id]
+        page = positions[:limit]
+        has_more = len(positions) > limit
+        return {
+            'items': page,
+            'nextCursor': encode_cursor(page[-1]['id']) if has_more else None
+        }
+
+    entry = get_cached_api_body(('positions', user_id, after_id, limit), get_portfolio_version(user_id), build)
+    return cached_json_response(request, entry)
+
+
+@web_routes.get('/api/categories')
+async def api_categories(request):
+    """Статистика по категориям постранично. Курсор - смещение в списке категорий."""
+    user_id = get_api_user_id(request)
+    if user_id is None:
+        return unauthorized()
+    try:
+        cursor, limit = parse_page_params(request)
+        offset = int(decode_cursor(cursor) or 0)
+    except ValueError:
+        return bad_request("Неверный cursor или limit")
+
+    await fetch_marketcsgo_prices()
+
+    def build():
+        categories = get_portfolio_valuation(user_id)['categories']
+        page = categories[offset:offset + limit]
+        has_more = offset + limit < len(categories)
+        return {
+            'items': page,
+            'nextCursor': encode_cursor(offset + limit) if has_more else None
+        }
+
+    entry = get_cached_api_body(('categories', user_id, offset, limit), get_portfolio_version(user_id), build)
+    return cached_json_response(request, entry)
+
+
+@web_routes.get('/api/history')
+async def api_history(request):
+    """История стоимости портфеля постранично. Курсор - timestamp последней отданной точки."""
+    user_id = get_api_user_id(request)
+    if user_id is None:
+        return unauthorized()
+    try:
+        cursor, limit = parse_page_params(request)
+        after_timestamp = decode_cursor(cursor) or ''
+    except ValueError:
+        return bad_request("Неверный cursor или limit")
+
+    def build():
+        with get_db_cursor() as (cur, _):
+            cur.execute(
+                "SELECT timestamp, value_uah FROM portfolio_history WHERE user_id = ? AND timestamp > ? "
+                "ORDER BY timestamp LIMIT ?",
+                (user_id, after_timestamp, limit + 1))
+            rows = cur.fetchall()
+        page = rows[:limit]
+        has_more = len(rows) > limit
+        return {
+            'items': [{'timestamp': timestamp, 'valueUah': value_uah} for timestamp, value_uah in page],
+            'nextCursor': encode_cursor(page[-1][0]) if has_more else None
+        }
+
+    entry = get_cached_api_body(('history', user_id, after_timestamp, limit), history_versions.get(user_id, 0), build)
+    return cached_json_response(request, entry)
+
+
+# --- ПОТОК ЦЕН ДЛЯ MINI APP (SSE) ---
+def format_sse_event(event, payload):
+    """Кодирует одно событие Server-Sent Events."""
+    data = json.dumps(payload, ensure_ascii=False)
+    return f"event: {event}\ndata: {data}\n\n".encode('utf-8')
+
+
+def schedule_stream_update(user_id=None):
+    """
+    Планирует рассылку изменений подписчикам потока пользователя (None - всем, например при смене цен).
+    Несколько изменений подряд (например, массовое добавление) сливаются в одну рассылку.
+    """
+    global stream_update_scheduled
+    if not stream_subscribers:
+        return
+    if user_id is None:
+        stream_pending_users.update(stream_subscribers.values())
+    else:
+        stream_pending_users.add(user_id)
+    if stream_update_scheduled:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    stream_update_scheduled = True
+    loop.call_soon(publish_stream_update)
+
+
+def publish_stream_update():
+    """Рассылает накопившиеся изменения: оценка портфеля считается один раз на пользователя."""
+    global stream_update_scheduled
+    stream_update_scheduled = False
+    users = stream_pending_users & set(stream_subscribers.values())
+    stream_pending_users.clear()
+    for user_id in users:
+        publish_user_stream_update(user_id)
+
+
+def format_stream_position(position, previous_value=None):
+    """Позиция для потока Mini App; changeUah - изменение с прошлой отправки в это соединение."""
+    return {
+        'id': position['id'],
+        'name': position['name'],
+        'quantity': position['quantity'],
+        'valueUah': position['valueUah'],
+        'profitPercent': position['profitPercent'],
+        'changeUah': round(position['valueUah'] - previous_value, 2) if previous_value is not None else None
+    }
+
+
+def publish_user_stream_update(user_id):
+    """
+    Рассылает итоги и изменившиеся позиции всем потокам пользователя.
+    Изменения считаются для каждого соединения от того, что ушло именно в него:
+    вкладка, открытая позже, сравнивается со своим снимком, а не с чужими рассылками.
+    """
+    # Соединение без снимка пропускаем: снимок, который оно вот-вот получит, уже включит изменения
+    queues = [queue for queue, subscriber_id in stream_subscribers.items()
+              if subscriber_id == user_id and queue in stream_last_positions]
+    if not queues:
+        return
+    try:
+        valuation = get_portfolio_valuation(user_id)
+    except Exception as e:
+        logging.error(f"Ошибка оценки портфеля для потока Mini App: {e}")
+        return
+
+    current_positions = {p['id']: p for p in valuation['positions']}
+    current_values = {item_id: p['valueUah'] for item_id, p in current_positions.items()}
+    summary = format_portfolio_summary(valuation)
+    for queue in queues:
+        last_positions = stream_last_positions.get(queue, {})
+        deltas = [format_stream_position(position, last_positions.get(item_id))
+                  for item_id, position in current_positions.items()
+                  if last_positions.get(item_id) != position['valueUah']]
+        removed = [item_id for item_id in last_positions if item_id not in current_positions]
+        stream_last_positions[queue] = current_values
+        if not deltas and not removed:
+            continue
+        if queue.full():
+            # Клиент не успевает читать: выбрасываем самое старое событие
+            queue.get_nowait()
+        queue.put_nowait(format_sse_event('update', {
+            'summary': summary,
+            'positions': deltas,
+            'removed': removed
+        }))
+
+
+@web_routes.get('/api/stream')
+async def api_stream(request):
+    """Поток изменений портфеля (Server-Sent Events) вместо опроса /api/portfolio."""
+    user_id = get_api_user_id(request)
+    if user_id is None:
+        return unauthorized()
+    if len(stream_subscribers) >= MAX_STREAM_CONNECTIONS:
+        return web.json_response({'error': 'Слишком много подключений'}, status=503,
+                                 headers={'Retry-After': str(STREAM_KEEPALIVE_SECONDS)})
+
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    await response.prepare(request)
+
+    queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+    stream_subscribers[queue] = user_id
+    try:
+        await fetch_marketcsgo_prices()
+        # Первое событие - текущее состояние с позициями, от него считаются изменения этого соединения
+        valuation = get_portfolio_valuation(user_id)
+        stream_last_positions[queue] = {p['id']: p['valueUah'] for p in valuation['positions']}
+        await response.write(format_sse_event('snapshot', {
+            'summary': format_portfolio_summary(valuation),
+            'positions': [format_stream_position(position) for position in valuation['positions']]
+        }))
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=STREAM_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                event = b": keep-alive\n\n"
+            if event is None:
+                break
+            await response.write(event)
+    except ConnectionResetError:
+        pass
+    finally:
+        stream_subscribers.pop(queue, None)
+        stream_last_positions.pop(queue, None)
+    return response
+
+
+async def close_streams(app):
+    """При остановке сервера завершает открытые потоки, чтобы не ждать таймаута."""
+    for queue in list(stream_subscribers):
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+
+class ApiAccessLogger(aiohttp.abc.AbstractAccessLogger):
+    """
+    Журнал запросов без строки запроса: /api/stream получает подписанный initData в параметре,
+    и стандартный журнал aiohttp записывал бы действующие сутки учетные данные в лог.
+    """
+
+    def log(self, request, response, time):
+        self.logger.info(f'{request.remote} "{request.method} {request.path}" {response.status} '
+                         f'{response.body_length} {time:.3f}s')
+
+    @property
+    def enabled(self):
+        return self.logger.isEnabledFor(logging.INFO)
+
+
+async def start_web_server():
+    """Запускает веб-сервер Mini App в текущем event loop."""
+    web_app = web.Application()
+    web_app.add_routes(web_routes)
+    web_app.on_shutdown.append(close_streams)
+    runner = web.AppRunner(web_app, access_log_class=ApiAccessLogger)
+    await runner.setup()
+    site = web.TCPSite(runner, WEB_HOST, WEB_PORT)
+    await site.start()
+    logging.info(f"Веб-сервер Mini App запущен на {WEB_HOST}:{WEB_PORT}.")
+    return runner
+
+
 # --- ОСНОВНАЯ ФУНКЦИЯ ЗАПУСКА ---
 async def main():
     """Запускает бота."""
@@ -3320,10 +6623,33 @@ async def main():
         logging.error("TELEGRAM_BOT_TOKEN не найден в переменных окружения!")
         return
 
+    logging.info(f"Холодный старт: модуль загружен за {module_loaded_seconds:.2f} с.")
     init_db()
     start_scheduled_jobs()
-    await dp.start_polling(bot)
-
+    web_runner = await start_web_server()
+    warmup_task = asyncio.create_task(warmup_heavy_modules()) if WARMUP_MODULES else None
+    loop_lag_task = asyncio.create_task(monitor_event_loop_lag())
+    global loop_watchdog
+    loop_watchdog = LoopWatchdog(asyncio.get_running_loop(), LOOP_BLOCK_THRESHOLD_SECONDS,
+                                 LOOP_WATCHDOG_INTERVAL_SECONDS, LOOP_BLOCK_REPORT_SIZE)
+    loop_watchdog.start()
+    logging.info(f"Холодный старт: запуск поллинга через {time.perf_counter() - PROCESS_STARTED_AT:.2f} с.")
+    try:
+        await dp.start_polling(bot)
+    finally:
+        # Корректно закрываем соединения Mini App и фоновые задачи
+        if warmup_task:
+            warmup_task.cancel()
+        loop_lag_task.cancel()
+        loop_watchdog.stop()
+        await web_runner.cleanup()
+        if scheduler and scheduler.running:
+            scheduler.shutdown(wait=False)
+        logging.info("Бот остановлен.")
+
+
+# Время загрузки модуля (все импорты верхнего уровня и регистрация обработчиков)
+module_loaded_seconds = time.perf_counter() - PROCESS_STARTED_AT
 
 if __name__ == "__main__":
     asyncio.run(main())